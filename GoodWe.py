@@ -28,14 +28,23 @@ import json
 import requests
 import time
 import exceptions
+import units
 import logging
 import hashlib
 import base64
+import threading
+from array import array
+from datetime import date, timedelta
+from breaker import CircuitBreaker
+from metrics import Metrics
 
 OLD_LOGIN_URL = "https://www.semsportal.com/api/v3/Common/CrossLogin"
 NEW_LOGIN_URL = "https://semsplus.goodwe.com/web/sems/sems-user/api/v1/auth/cross-login"
 _PowerStationURLPart = "/v3/PowerStation/GetMonitorDetailByPowerstationId"
 _PowerControlURLPart = "/PowerStation/SaveRemoteControlInverter"
+_HistoryURLPart = "/PowerStationMonitor/GetInverterDataByColumn"
+_StationListURLPart = "/HistoryData/QueryPowerStationByHistory"
+_HistoryTimeFormats = ("%Y-%m-%d %H:%M:%S", "%m/%d/%Y %H:%M:%S", "%m/%d/%Y %H:%M")
 _RequestTimeout = 30
 _SuccessCodes = {0, "0", "00000"}
 _NewLoginHeaders = {
@@ -49,6 +58,15 @@ _DefaultHeaders = {
 }
 _NewLoginFallbackApi = "https://eu-gateway.semsportal.com/web/sems"
 _LegacyApiFallback = "https://eu.semsportal.com/api"
+_PoolConnections = 4 #number of hosts kept in the connection pool
+_PoolMaxSize = 4 #number of keep-alive connections per host
+_DefaultTokenLifetime = 2 * 3600 #assumed lifetime of a token until SEMS rejects one
+_MinTokenLifetime = 5 * 60
+_TokenRefreshMargin = 0.8 #refresh the token after this part of its lifetime
+_TokenRefreshRetryDelay = 60 #seconds before retrying a failed proactive refresh
+_MaxStrings = 4 #number of PV input strings of an inverter
+_NaN = float("nan") #value of a field missing in the SEMS data
+_MaxUnchangedAge = units.MaxUpdateInterval #seconds, unchanged station data is processed anyway after this time
 
 try:
     import DomoticzEx as Domoticz
@@ -57,34 +75,70 @@ except ImportError:
     import fakeDomoticz as Domoticz
     debug = True
 
+def _toFloat(value):
+    """convert a SEMS value like 231.5, '231.5' or '231.5V' to float, NaN when missing"""
+    if value is None:
+        return _NaN
+    if isinstance(value, (int, float)):
+        return float(value)
+    try:
+        return float(str(value).strip().rstrip("VAWHzvawhz"))
+    except ValueError:
+        return _NaN
+
+class InverterSnapshot:
+    """
+    A class to hold the values of one inverter of one poll, parsed once from the SEMS data.
+    Missing values are NaN, the per string values are arrays with one entry per PV input.
+    """
+    __slots__ = ("sn", "status", "temperature", "frequency", "outputCurrent", "outputVoltage", "outputPower",
+                 "etotal", "inputVoltage", "inputCurrent", "inputPower", "numStrings",
+                 "faultMessage", "battery", "bmsStatus", "batteryPower")
+
+    def __init__(self, inverterData):
+        self.sn = inverterData["sn"]
+        self.status = int(inverterData.get("status", -1))
+        self.temperature = _toFloat(inverterData.get("tempperature"))
+        self.frequency = _toFloat((inverterData.get("d") or {}).get("fac1"))
+        self.outputCurrent = _toFloat(inverterData.get("output_current"))
+        self.outputVoltage = _toFloat(inverterData.get("output_voltage"))
+        self.outputPower = _toFloat(inverterData.get("output_power"))
+        self.etotal = _toFloat(inverterData.get("etotal"))
+        self.inputVoltage = array('d', (_NaN,) * _MaxStrings)
+        self.inputCurrent = array('d', (_NaN,) * _MaxStrings)
+        self.inputPower = array('d', (_NaN,) * _MaxStrings)
+        self.numStrings = 0
+        for i in range(_MaxStrings):
+            inputValue = inverterData.get("pv_input_" + str(i + 1))
+            if not inputValue:
+                continue
+            inputVoltage, _, inputAmps = inputValue.partition('/')
+            self.inputVoltage[i] = _toFloat(inputVoltage)
+            self.inputCurrent[i] = _toFloat(inputAmps)
+            self.inputPower[i] = self.inputVoltage[i] * self.inputCurrent[i] #calculate the power based on P = I * V in Watt
+            self.numStrings = i + 1
+        self.faultMessage = inverterData.get("fault_message") or ""
+        self.battery = inverterData.get("battery")
+        self.bmsStatus = inverterData.get("bms_status")
+        self.batteryPower = inverterData.get("battery_power")
+
+    def __repr__(self):
+        return "InverterSnapshot(sn: '" + self.sn + "', status: " + str(self.status) + ", output power: " + str(self.outputPower) + ")"
+
+    def hasInput(self, index):
+        """True when PV input string index (0 based) is present"""
+        return self.inputVoltage[index] == self.inputVoltage[index]
+
 class Inverter:
     """
     A class to describe the methods and properties of a GoodWe inverter
     """
     domoticzDevices = 20
-    inverterTemperatureUnit = 1
-    inverterStateUnit = 9
-    outputCurrentUnit = 2
-    outputVoltageUnit = 3
-    outputPowerUnit = 4
-    inputVoltage1Unit = 5
-    inputAmps1Unit = 6
-    inputPower1Unit = 14
-    inputPower2Unit = 15
-    inputPower3Unit = 16
-    inputPower4Unit = 17
-    inputVoltage2Unit = 7
-    inputVoltage3Unit = 10
-    inputVoltage4Unit = 12
-    inputAmps2Unit = 8
-    inputAmps3Unit = 11
-    inputAmps4Unit = 13
-    outputFreq1Unit = 18
-    inverterStateCommand = 19
 
     def __init__(self, inverterData):
         self._sn = inverterData["sn"]
         self._name = inverterData["name"]
+        self.snapshot = InverterSnapshot(inverterData)
 
     def __repr__(self):
         return "Inverter type: '" + self._name + "' with serial number: '" + self._sn + "'"
@@ -97,6 +151,18 @@ class Inverter:
     def type(self):
         return self._name
 
+#unit numbers of the Domoticz units of an inverter, defined in the units table
+for _key, _unit in units.unitNumbers().items():
+    setattr(Inverter, _key, _unit)
+
+def stationFingerprint(stationData):
+    """
+    Return a digest of the inverter section of the station data, to detect data SEMS did not refresh yet.
+    The info section is left out, it contains the time of the request.
+    """
+    inverterData = json.dumps(stationData.get("inverter"), separators=(",", ":")).encode()
+    return hashlib.blake2b(inverterData, digest_size=16).digest()
+
 class PowerStation:
     """
     A class to describe the methods and properties of a GoodWe PowerStation.
@@ -118,7 +184,7 @@ class PowerStation:
             self._name = stationData["info"]["stationname"]
             self._address = stationData["info"]["address"]
             self._id = stationData["info"]["powerstation_id"]
-            logging.debug("create station with id: '" + self._id + "' and inverters: " + str(len(stationData["inverter"])) )
+            logging.debug("create station with id: '%s' and inverters: %d", self._id, len(stationData["inverter"]))
             self.createInverters(stationData["inverter"])
             
     def __repr__(self):
@@ -127,7 +193,7 @@ class PowerStation:
     def createInverters(self, inverterData):
         for inverter in inverterData:
             self.inverters[inverter['sn']] = Inverter(inverter)
-            logging.debug("inverter created: '" + str(inverter['sn']) + "'")
+            logging.debug("inverter created: '%s'", inverter['sn'])
             self._firstDevice += self.inverters[inverter['sn']].domoticzDevices
   
     @property
@@ -156,6 +222,58 @@ class PowerStation:
             _maxDeviceNum += inv.domoticzDevices
         return _maxDeviceNum
 
+def _historyTime(text):
+    for timeFormat in _HistoryTimeFormats:
+        try:
+            return time.mktime(time.strptime(text, timeFormat))
+        except ValueError:
+            continue
+    return None
+
+def _historySamples(responseData):
+    """Return the samples [(time, value)] of a GetInverterDataByColumn response, [] when it has none"""
+    if not isinstance(responseData, dict) or not isinstance(responseData.get("data"), dict):
+        return []
+    samples = []
+    for key, points in responseData["data"].items():
+        if not key.startswith("column") or not isinstance(points, list):
+            continue
+        for point in points:
+            stamp = _historyTime(str(point.get("date")))
+            value = _toFloat(point.get("column"))
+            if stamp is not None and value == value:
+                samples.append((stamp, value))
+        break
+    return samples
+
+def createSession(hosts=_PoolConnections):
+    """
+    Return a keep-alive HTTP session. The adapter only sizes the connection pool, requests are not retried:
+    every SEMS call is a POST which must not be sent twice, a failed poll is retried by the next poll.
+    hosts: number of hosts kept in the connection pool, a session shared by several accounts needs more
+    """
+    adapter = requests.adapters.HTTPAdapter(
+        pool_connections=hosts,
+        pool_maxsize=_PoolMaxSize,
+    )
+    session = requests.Session()
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    logging.debug("created HTTP session for %d hosts with pool size %s", hosts, _PoolMaxSize)
+    return session
+
+def _stationIds(responseData):
+    """Return the power station IDs of a station list response, the list is data.list or data itself"""
+    data = responseData.get("data") if isinstance(responseData, dict) else None
+    if isinstance(data, dict):
+        data = data.get("list")
+    stationIds = []
+    for station in data if isinstance(data, list) else []:
+        stationId = station.get("id") or station.get("powerstation_id") if isinstance(station, dict) else None
+        if stationId and stationId not in stationIds:
+            stationIds.append(stationId)
+    return stationIds
+
 class GoodWe:
     """
     A class to describe the methods and properties of a GoodWe account.
@@ -165,7 +283,10 @@ class GoodWe:
     tokenAvailable = False
     Address = ""
     Port = ""
-    token = ""
+    _token = ""
+    _headers = None
+    _baseUrl = ""
+    _apiUrls = None
     default_token = {
         "client": "web",
         "version": "v3.1",
@@ -182,33 +303,209 @@ class GoodWe:
     powerStationList = {}
     powerStationIndex = 0
 
-    def __init__(self, Address, Port, User, Password):
+    def __init__(self, Address, Port, User, Password, session=None):
         self.Address = "https://" + Address + "/api"
         self.Port = Port
         self.Username = User
         self.Password = Password
         self.base_url = self.Address 
         self.token = self.default_token
+        self._session = session #shared by all accounts of a plugin when given, owned by the plugin then
+        self._sharedSession = session is not None
+        self._sessionHost = None
+        self.breaker = CircuitBreaker()
+        self.metrics = Metrics()
+        self._tokenLock = threading.Lock()
+        self.tokenTimestamp = None #time of the login which provided the token
+        self.tokenLifetime = _DefaultTokenLifetime
+        self.tokenLastValid = None #time of the last request SEMS accepted with the token
+        self._tokenRefreshFailed = None
+        self.powerStationList = {}
+        self.stationIds = [] #power station IDs polled for this account
+        self._stationFingerprints = {} #station id: (fingerprint, time processed)
+        self.unchangedStations = 0 #number of polls skipped because SEMS returned the same data
         return
 
     @property
     def numStations(self):
         return len(self.powerStationList)
         
+    def stationChanged(self, stationId, stationData, now=None):
+        """False when SEMS returned the same inverter data as the last processed poll of the station"""
+        if now is None:
+            now = time.monotonic()
+        fingerprint = stationFingerprint(stationData)
+        last = self._stationFingerprints.get(stationId)
+        if last is not None and last[0] == fingerprint and now - last[1] < _MaxUnchangedAge:
+            self.unchangedStations += 1
+            logging.debug("data of station '%s' not refreshed by SEMS, skipped %d times", stationId, self.unchangedStations)
+            return False
+        self._stationFingerprints[stationId] = (fingerprint, now)
+        return True
+
     def createStationV2(self, stationData):
         powerStation = PowerStation(stationData=stationData)
-        self.powerStationList.update({1 : powerStation})
-        logging.debug("PowerStation created: '" + powerStation.id + "'")
+        self.powerStationList.update({powerStation.id : powerStation})
+        logging.debug("PowerStation created: '%s'", powerStation.id)
+        return powerStation
+
+    def timedTokenRequest(self):
+        """Request a token, recording the login time in the metrics."""
+        start = time.perf_counter()
+        try:
+            return self.tokenRequest()
+        finally:
+            self.metrics.record("login", time.perf_counter() - start)
+
+    def refreshToken(self, expiredToken):
+        """Request a new token, unless another request already replaced the expired one."""
+        with self._tokenLock:
+            if self.token is expiredToken or not self.tokenAvailable:
+                self.timedTokenRequest()
+            else:
+                logging.debug("token already refreshed by another request")
+
+    @property
+    def session(self):
+        """Return the pooled keep-alive HTTP session of this account, creating it when needed."""
+        if self._session is None:
+            self._session = createSession()
+        return self._session
+
+    def closeSession(self):
+        """Close the HTTP session and drop all pooled connections, a shared session is closed by its owner."""
+        if self._session is not None and not self._sharedSession:
+            self._session.close()
+            self._session = None
+            logging.debug("HTTP session closed")
+
+    def _checkSessionHost(self, api_base):
+        """Rebuild the HTTP session when the API base host changes, so no stale connections are kept."""
+        host = api_base.split("//", 1)[-1].split("/", 1)[0] if api_base else None
+        if self._sessionHost is not None and host != self._sessionHost and not self._sharedSession:
+            logging.debug("API host changed from %s to %s, rebuilding HTTP session", self._sessionHost, host)
+            self.closeSession()
+        self._sessionHost = host
+
+    @property
+    def tokenAge(self):
+        """Seconds since the token was received, None when unknown."""
+        if not self.tokenAvailable or self.tokenTimestamp is None:
+            return None
+        return time.time() - self.tokenTimestamp
+
+    def tokenNeedsRefresh(self):
+        """True when the token is close to its expected expiry and should be refreshed ahead of the next request."""
+        age = self.tokenAge
+        if age is None or age < self.tokenLifetime * _TokenRefreshMargin:
+            return False
+        if self._tokenRefreshFailed is not None and time.time() - self._tokenRefreshFailed < _TokenRefreshRetryDelay:
+            return False
+        return True
+
+    def learnTokenLifetime(self):
+        """
+        SEMS rejected the token, it expired between its last accepted request and now. Use the time it was known
+        to be valid as the expected lifetime of the next tokens, at most the default: an idle or restored token
+        can be rejected long after it expired.
+        """
+        age = self.tokenAge
+        if age is None:
+            return
+        validFor = 0
+        if self.tokenLastValid is not None and self.tokenLastValid >= self.tokenTimestamp:
+            validFor = self.tokenLastValid - self.tokenTimestamp
+        self.tokenLifetime = min(_DefaultTokenLifetime, max(_MinTokenLifetime, validFor))
+        logging.debug("token rejected after %d seconds, valid for at least %d seconds, expected token lifetime is now %d seconds", age, validFor, self.tokenLifetime)
+
+    def refreshExpiringToken(self):
+        """Replace a token before it expires, keeping the current one when the login fails."""
+        with self._tokenLock:
+            if not self.tokenNeedsRefresh():
+                return
+            logging.info("SEMS token is %d seconds old, refreshing it ahead of expiry", self.tokenAge)
+            oldToken, oldBaseUrl, oldTimestamp = self.token, self.base_url, self.tokenTimestamp
+            try:
+                self.timedTokenRequest()
+            except exceptions.GoodweException as exp:
+                logging.error("Failed to refresh token: %s", exp)
+                self.tokenAvailable = False
+            if self.tokenAvailable and self.tokenTimestamp != oldTimestamp:
+                self._tokenRefreshFailed = None
+                return
+            self._tokenRefreshFailed = time.time()
+            if time.time() - oldTimestamp < self.tokenLifetime:
+                logging.info("SEMS token refresh failed, keep using the current token")
+                self.token, self.base_url, self.tokenTimestamp = oldToken, oldBaseUrl, oldTimestamp
+                self.tokenAvailable = True
+
+    def exportToken(self):
+        """Return the token state to be stored between restarts, None when no token is available."""
+        if not self.tokenAvailable or not self.token:
+            return None
+        return {
+            "account": self.Username,
+            "client": type(self).__name__,
+            "token": self.token,
+            "base_url": self.base_url,
+            "timestamp": self.tokenTimestamp,
+            "lifetime": self.tokenLifetime,
+        }
+
+    def importToken(self, tokenState):
+        """Reuse a token stored by exportToken, it will be replaced when SEMS rejects it."""
+        if not isinstance(tokenState, dict):
+            return False
+        if tokenState.get("account") != self.Username or tokenState.get("client") != type(self).__name__:
+            logging.debug("stored token belongs to another account or API, ignoring it")
+            return False
+        if not isinstance(tokenState.get("token"), dict) or not tokenState["token"] or not tokenState.get("base_url"):
+            logging.debug("stored token is incomplete, ignoring it")
+            return False
+        self.token = tokenState["token"]
+        self.base_url = tokenState["base_url"]
+        self.tokenTimestamp = tokenState.get("timestamp")
+        self.tokenLifetime = min(_DefaultTokenLifetime, max(_MinTokenLifetime, tokenState.get("lifetime", _DefaultTokenLifetime)))
+        self.tokenAvailable = True
+        self._checkSessionHost(self.base_url)
+        logging.info("Reusing stored SEMS token for API %s", self.base_url)
+        return True
+
+    @property
+    def token(self):
+        return self._token
+
+    @token.setter
+    def token(self, value):
+        self._token = value
+        self._headers = None #request headers are rebuilt for the new token
+        self._apiUrls = {} #endpoint URLs are resolved again for the new token
+
+    @property
+    def base_url(self):
+        return self._baseUrl
+
+    @base_url.setter
+    def base_url(self, value):
+        if value != self._baseUrl:
+            self._apiUrls = {}
+        self._baseUrl = value
 
     def apiRequestHeadersV2(self):
-        logging.debug("build apiRequestHeaders with token: '" + json.dumps(self.token) + "'" )
+        """Return the request headers for the current token, built once per token."""
+        if self._headers is None:
+            self._headers = self._buildRequestHeaders()
+        return self._headers
+
+    def _buildRequestHeaders(self):
+        logging.debug("build apiRequestHeaders with token: '%s'", self.token)
         return {
             'User-Agent': 'Domoticz/1.0',
             'token': json.dumps(self.token)
         }
 
     def tokenRequest(self):
-        logging.debug("build tokenRequest with UN: '" + self.Username + "', pwd: '" + self.Password +"'")
+        logging.debug("build tokenRequest with username: '%s'", self.Username)
         url = '/v2/Common/CrossLogin'
         loginPayload = {
             'account': self.Username,
@@ -216,33 +513,27 @@ class GoodWe:
         }
 
         try:
-            r = requests.post(self.base_url + url, headers=self.apiRequestHeadersV2(), data=loginPayload, timeout=10)
+            r = self.session.post(self.base_url + url, headers=self.apiRequestHeadersV2(), data=loginPayload, timeout=10)
         except requests.exceptions.RequestException as exp:
-            logging.error("TokenRequestException: " + str(exp))
+            logging.error("TokenRequestException: %s", exp)
             Domoticz.Error("TokenRequestException: " + str(exp))
             self.tokenAvailable = False
             return
 
         #r.raise_for_status()
-        logging.debug("building token request on URL: " + r.url + " which returned status code: " + str(r.status_code) + " and response length = " + str(len(r.text)))
+        logging.debug("building token request on URL: %s which returned status code: %s and response length = %d", r.url, r.status_code, len(r.content))
         try:
             apiResponse = r.json()
         except json.decoder.JSONDecodeError as exp:
-            logging.error("TokenRequestException: " + str(exp))
+            logging.error("TokenRequestException: %s", exp)
             Domoticz.Error("TokenRequestException: " + str(exp))
             self.tokenAvailable = False
             return
 
-        try:
-            with open("/tmp/goodwe_token_response.json", "w") as f:
-                json.dump(apiResponse, f, indent=2)
-            logging.info("Saved raw token response to /tmp/goodwe_token_response.json")
-            logging.debug("token response: " + json.dumps(apiResponse))
-        except Exception as exp:
-            logging.error("Failed to save token response: " + str(exp))
+        logging.debug("token response: %s", apiResponse)
 
         if apiResponse.get("code") == 100005:
-            raise exceptions.GoodweException("invalid password or username")
+            raise exceptions.AuthenticationFailure("invalid password or username")
 
         # Adaptation robuste pour trouver l'URL API
         apiUrl = None
@@ -263,49 +554,134 @@ class GoodWe:
             self.tokenAvailable = False
         else:
             self.token = apiResponse.get('data', {})
-            logging.debug("SEMS API Token received: " + json.dumps(self.token))
+            logging.debug("SEMS API Token received: %s", self.token)
             self.tokenAvailable = True
+            self.tokenTimestamp = time.time()
             self.base_url = apiUrl + "/v2"
+            self._checkSessionHost(self.base_url)
         
         return r.status_code
 
+    def discoverStations(self):
+        """Return the IDs of all power stations of the account."""
+        return _stationIds(self._checkedRequest(self.stationListRequest, "the station list"))
+
+    def changeInverterStatus(self, stationId, inverterSn, mode):
+        """Send an inverter control command, see setInverterStatus."""
+        self._checkedRequest(lambda: self.setInverterStatus(stationId, inverterSn, mode), "the inverter control")
+
+    def _checkedRequest(self, request, description):
+        """
+        Call request() and return the response when SEMS accepted it. A rejected token is refreshed and the
+        request repeated once, failures are raised as AuthenticationFailure, TransientFailure or PermanentFailure.
+        """
+        for attempt in range(1, 3):
+            usedToken = self.token
+            try:
+                responseData = request()
+            except requests.exceptions.RequestException as exp:
+                raise exceptions.TransientFailure("Failed to request " + description + ": " + str(exp))
+            try:
+                code = int(responseData['code'])
+            except (ValueError, KeyError, TypeError):
+                raise exceptions.FailureWithoutErrorCode
+            if code == 0:
+                self.tokenLastValid = time.time()
+                return responseData
+            elif code == 100001 or code == 100002:
+                logging.info("Failed to request %s (no valid token), will be refreshed", description)
+                self.refreshToken(usedToken)
+            else:
+                raise exceptions.FailureWithErrorCode(code)
+        raise exceptions.AuthenticationFailure("Failed to request " + description + " (token rejected after refresh)")
+
     def stationListRequest(self):
         logging.debug("build stationListRequest")
-        url = '/HistoryData/QueryPowerStationByHistory'
-        r = requests.post(self.base_url + url, headers=self.apiRequestHeadersV2(), timeout=5)
- 
-        logging.debug("building station list on URL: " + r.url + " which returned status code: " + str(r.status_code) + " and response length = " + str(len(r.text)))
-
-        return r.status_code
+        r = self.session.post(self.base_url + _StationListURLPart, headers=self.apiRequestHeadersV2(), timeout=10)
+        logging.debug("building station list on URL: %s which returned status code: %s and response length = %d", r.url, r.status_code, len(r.content))
+        try:
+            return r.json()
+        except json.decoder.JSONDecodeError as exp:
+            logging.error("station list request JSONDecodeError: %s", exp)
+            return None
 
     def stationDataRequestV2(self, stationId):
-        for i in range(1, 4):
+        """
+        Request the data of a station, one attempt per poll. A rejected token is refreshed and the
+        request repeated once. Failures are raised as AuthenticationFailure, TransientFailure or
+        PermanentFailure, the next poll is the retry.
+        """
+        for attempt in range(1, 3):
+            logging.debug("build stationDataRequest for station '%s', attempt: %d", stationId, attempt)
+            usedToken = self.token
             try:
-                logging.debug("build stationDataRequest for 1 station, attempt: " + str(i))
-
                 responseData = self.stationDataRequest(stationId)
-                if not responseData:
-                    return
-                try:
-                    code = int(responseData['code'])
-                except (ValueError, KeyError):
-                    raise exceptions.FailureWithoutErrorCode
-
-                if code == 0 and responseData['data'] is not None:
-                    #data successfully received
-                    return responseData['data']
-                elif code == 100001 or code == 100002:
-                    #token has expired or is not valid
-                    logging.info("Failed to call GoodWe API (no valid token), will be refreshed")
-                    self.tokenRequest()
-                else:
-                    raise exceptions.FailureWithErrorCode(code)
             except requests.exceptions.RequestException as exp:
-                logging.error("RequestException: " + str(exp))
-                Domoticz.Error("RequestException: " + str(exp))
-            time.sleep(i ** 3)
-        else:
-            raise exceptions.TooManyRetries
+                logging.error("RequestException: %s", exp)
+                raise exceptions.TransientFailure("Failed to call GoodWe API: " + str(exp))
+            if not responseData:
+                raise exceptions.TransientFailure("Failed to call GoodWe API (invalid response)")
+            try:
+                code = int(responseData['code'])
+            except (ValueError, KeyError):
+                raise exceptions.FailureWithoutErrorCode
+
+            if code == 0 and responseData['data'] is not None:
+                #data successfully received
+                self.tokenLastValid = time.time()
+                return responseData['data']
+            elif code == 100001 or code == 100002:
+                #token has expired or is not valid
+                logging.info("Failed to call GoodWe API (no valid token), will be refreshed")
+                if self.token is usedToken:
+                    self.learnTokenLifetime()
+                self.refreshToken(usedToken)
+            else:
+                raise exceptions.FailureWithErrorCode(code)
+        raise exceptions.AuthenticationFailure("Failed to call GoodWe API (token rejected after refresh)")
+
+    def inverterHistory(self, serialNumber, column, start, end, stopEvent=None):
+        """
+        Return the samples [(time, value)] of one history column of an inverter between start and end (epoch),
+        for example 'Vpv1'. SEMS reports the time in the time zone of the station, assumed to be the local one.
+        One request is made per day, no more requests are made once stopEvent is set.
+        """
+        samples = []
+        day, lastDay = date.fromtimestamp(start), date.fromtimestamp(end)
+        while day <= lastDay:
+            if stopEvent is not None and stopEvent.is_set():
+                break
+            dayStart = day.strftime("%Y-%m-%d 00:00:00")
+            try:
+                responseData = self._checkedRequest(lambda: self.historyRequest(serialNumber, column, dayStart), "the history of " + serialNumber)
+            except exceptions.GoodweException as exp:
+                logging.error("history request for '%s' failed: %s", serialNumber, exp)
+                break
+            samples.extend(_historySamples(responseData))
+            day += timedelta(days=1)
+        return [(stamp, value) for stamp, value in samples if start <= stamp <= end]
+
+    def stringPowerHistory(self, serialNumber, index, start, end, stopEvent=None):
+        """Return the power samples [(time, W)] of PV input string index (0 based), calculated from voltage and current"""
+        currents = dict(self.inverterHistory(serialNumber, "Ipv" + str(index + 1), start, end, stopEvent))
+        if not currents:
+            return []
+        return [(stamp, voltage * currents[stamp]) for stamp, voltage in self.inverterHistory(serialNumber, "Vpv" + str(index + 1), start, end, stopEvent)
+                if stamp in currents]
+
+    def historyRequest(self, serialNumber, column, date):
+        payload = {
+            'id': serialNumber,
+            'date': date,
+            'column': column
+        }
+        r = self.session.post(self.base_url + _HistoryURLPart, headers=self.apiRequestHeadersV2(), data=payload, timeout=10)
+        logging.debug("building history request on URL: %s which returned status code: %s and response length = %d", r.url, r.status_code, len(r.content))
+        try:
+            return r.json()
+        except json.decoder.JSONDecodeError as exp:
+            logging.error("history request JSONDecodeError: %s", exp)
+            return None
 
     def stationDataRequest(self, stationId):
         url = '/PowerStation/GetMonitorDetailByPowerstationId'
@@ -313,15 +689,19 @@ class GoodWe:
             'powerStationId' : stationId
         }
 
-        r = requests.post(self.base_url + url, headers=self.apiRequestHeadersV2(), data=payload, timeout=10)
-        logging.debug("building station data request on URL: " + r.url + " which returned status code: " + str(r.status_code) + " and response length = " + str(len(r.text)))
+        start = time.perf_counter()
+        r = self.session.post(self.base_url + url, headers=self.apiRequestHeadersV2(), data=payload, timeout=10)
+        fetched = time.perf_counter()
+        self.metrics.record("fetch", fetched - start)
+        logging.debug("building station data request on URL: %s which returned status code: %s and response length = %d", r.url, r.status_code, len(r.content))
         try:
             apiResponse = r.json()
         except json.decoder.JSONDecodeError as exp:
-            logging.error("RequestException: " + str(exp))
+            logging.error("RequestException: %s", exp)
             Domoticz.Error("RequestException: " + str(exp))
             return False
-        logging.debug("response station data request : " + json.dumps(r.json()))
+        self.metrics.record("decode", time.perf_counter() - fetched)
+        logging.debug("response station data request : %s", apiResponse)
         return apiResponse
         
     def setInverterStatus(self, stationId, inverterSn, mode):
@@ -336,15 +716,15 @@ class GoodWe:
             'InverterStatus': mode
         }
 
-        r = requests.post(self.base_url + url, headers=self.apiRequestHeadersV2(), data=payload, timeout=10)
-        logging.debug("building inverter mode post on URL: " + r.url + " and payload: '"+str(payload)+ "' which returned status code: " + str(r.status_code) + " and response length = " + str(len(r.text)))
+        r = self.session.post(self.base_url + url, headers=self.apiRequestHeadersV2(), data=payload, timeout=10)
+        logging.debug("building inverter mode post on URL: %s and payload: '%s' which returned status code: %s and response length = %d", r.url, payload, r.status_code, len(r.content))
         try:
             apiResponse = r.json()
         except json.decoder.JSONDecodeError as exp:
-            logging.error("RequestException: " + str(exp))
+            logging.error("RequestException: %s", exp)
             Domoticz.Error("RequestException: " + str(exp))
             return False
-        logging.debug("response inverter mode post : " + json.dumps(r.json()))
+        logging.debug("response inverter mode post : %s", apiResponse)
         return apiResponse
 
 
@@ -353,9 +733,11 @@ class GoodWeSEMSPlus(GoodWe):
     A class to handle GoodWe SEMS+ API, similar to GoodWe but using the new endpoint.
     """
 
+    loginFlow = None #login flow which last succeeded: "new" or "legacy"
+
     def _is_powerstation_route(self, url_part):
         """Return whether the route should use the legacy PowerStation host."""
-        return url_part.startswith("/PowerStation") or url_part.startswith("/v3/PowerStation")
+        return url_part.startswith(("/PowerStation", "/v2/PowerStation", "/v3/PowerStation", "/v2/HistoryData"))
 
     def _extract_gateway_region(self, api_base):
         """Return the SEMS region prefix from a gateway API base."""
@@ -401,6 +783,14 @@ class GoodWeSEMSPlus(GoodWe):
         """Return the effective API base for a given endpoint path."""
         return self._normalize_powerstation_api_base(api_base, url_part)
 
+    def _apiUrl(self, url_part):
+        """Return the full URL of an endpoint, resolved once per token and API base."""
+        apiUrl = self._apiUrls.get(url_part)
+        if apiUrl is None:
+            apiUrl = self._resolve_api_base_for_url_part(self.base_url, url_part) + url_part
+            self._apiUrls[url_part] = apiUrl
+        return apiUrl
+
     def _hash_password_for_new_login(self, password):
         md5_hex = hashlib.md5(password.encode("utf-8")).hexdigest()
         return base64.b64encode(md5_hex.encode("utf-8")).decode("utf-8")
@@ -452,7 +842,7 @@ class GoodWeSEMSPlus(GoodWe):
             "isLocal": False,
         }
         try:
-            r = requests.post(NEW_LOGIN_URL, headers=_NewLoginHeaders, json=login_data, timeout=_RequestTimeout)
+            r = self.session.post(NEW_LOGIN_URL, headers=_NewLoginHeaders, json=login_data, timeout=_RequestTimeout)
         except requests.exceptions.RequestException as exp:
             logging.error("SEMS+ new login request failed: %s", exp)
             Domoticz.Error("SEMS+ new login request failed: " + str(exp))
@@ -470,7 +860,7 @@ class GoodWeSEMSPlus(GoodWe):
     def _get_legacy_login_token(self):
         login_data = json.dumps({"account": self.Username, "pwd": self.Password})
         try:
-            r = requests.post(OLD_LOGIN_URL, headers=_DefaultHeaders, data=login_data, timeout=_RequestTimeout)
+            r = self.session.post(OLD_LOGIN_URL, headers=_DefaultHeaders, data=login_data, timeout=_RequestTimeout)
         except requests.exceptions.RequestException as exp:
             logging.error("SEMS legacy login request failed: %s", exp)
             Domoticz.Error("SEMS legacy login request failed: " + str(exp))
@@ -485,8 +875,21 @@ class GoodWeSEMSPlus(GoodWe):
 
         return self._extract_login_token(apiResponse, _LegacyApiFallback)
 
-    def apiRequestHeadersV2(self):
-        logging.debug("build SEMS+ apiRequestHeaders with token: '%s'", json.dumps(self.token))
+    def exportToken(self):
+        tokenState = super().exportToken()
+        if tokenState is not None:
+            tokenState["login_flow"] = self.loginFlow
+        return tokenState
+
+    def importToken(self, tokenState):
+        if not super().importToken(tokenState):
+            return False
+        if tokenState.get("login_flow") in ("new", "legacy"):
+            self.loginFlow = tokenState["login_flow"]
+        return True
+
+    def _buildRequestHeaders(self):
+        logging.debug("build SEMS+ apiRequestHeaders with token: '%s'", self.token)
         return {
             'User-Agent': 'Domoticz/1.0',
             'Content-Type': 'application/json',
@@ -494,21 +897,36 @@ class GoodWeSEMSPlus(GoodWe):
             'token': json.dumps(self.token)
         }
 
+    def _loginFlows(self):
+        """Return the login flows as (name, method), the flow which last succeeded first."""
+        flows = [("new", self._get_new_login_token), ("legacy", self._get_legacy_login_token)]
+        if self.loginFlow == "legacy":
+            flows.reverse()
+        return flows
+
+    def _sequentialLogin(self):
+        for name, login in self._loginFlows():
+            token_data = login()
+            if token_data is not None:
+                return name, token_data
+            logging.info("SEMS+ %s login failed, trying the next login flow", name)
+        return None, None
+
     def tokenRequest(self):
-        logging.debug("build SEMS+ tokenRequest with username: '%s'", self.Username)
-        token_data = self._get_new_login_token()
-        if token_data is None:
-            logging.info("SEMS+ new login failed, trying legacy SEMS login")
-            token_data = self._get_legacy_login_token()
+        logging.debug("build SEMS+ tokenRequest with username: '%s', last login flow: %s", self.Username, self.loginFlow)
+        flow, token_data = self._sequentialLogin()
 
         if token_data is None:
             self.tokenAvailable = False
             return
 
+        self.loginFlow = flow
         self.token = token_data
         self.tokenAvailable = True
+        self.tokenTimestamp = time.time()
         self.base_url = self.token.get("api")
-        logging.debug("SEMS+ API Token received: %s", json.dumps(self.token))
+        self._checkSessionHost(self.base_url)
+        logging.debug("SEMS+ API Token received: %s", self.token)
         return 200
 
     def stationDataRequest(self, stationId):
@@ -517,18 +935,44 @@ class GoodWeSEMSPlus(GoodWe):
             'powerStationId': stationId
         }
 
-        api_base = self._resolve_api_base_for_url_part(self.base_url, url)
-        r = requests.post(api_base + url, headers=self.apiRequestHeadersV2(), json=payload, timeout=10)
-        logging.debug("building SEMS+ station data request on URL: %s which returned status code: %s and response length = %s", r.url, r.status_code, len(r.text))
+        start = time.perf_counter()
+        r = self.session.post(self._apiUrl(url), headers=self.apiRequestHeadersV2(), json=payload, timeout=10)
+        fetched = time.perf_counter()
+        self.metrics.record("fetch", fetched - start)
+        logging.debug("building SEMS+ station data request on URL: %s which returned status code: %s and response length = %d", r.url, r.status_code, len(r.content))
         try:
             apiResponse = r.json()
         except json.decoder.JSONDecodeError as exp:
             logging.error("SEMS+ station data request JSONDecodeError: %s", exp)
             Domoticz.Error("SEMS+ station data request JSONDecodeError: " + str(exp))
             return False
-        logging.debug("response station data request : %s", json.dumps(apiResponse))
+        self.metrics.record("decode", time.perf_counter() - fetched)
+        logging.debug("response station data request : %s", apiResponse)
         return apiResponse
 
+    def stationListRequest(self):
+        r = self.session.post(self._apiUrl("/v2" + _StationListURLPart), headers=self.apiRequestHeadersV2(), json={}, timeout=10)
+        logging.debug("building SEMS+ station list on URL: %s which returned status code: %s and response length = %d", r.url, r.status_code, len(r.content))
+        try:
+            return r.json()
+        except json.decoder.JSONDecodeError as exp:
+            logging.error("SEMS+ station list request JSONDecodeError: %s", exp)
+            return None
+
+    def historyRequest(self, serialNumber, column, date):
+        payload = {
+            'id': serialNumber,
+            'date': date,
+            'column': column
+        }
+        r = self.session.post(self._apiUrl("/v2" + _HistoryURLPart), headers=self.apiRequestHeadersV2(), json=payload, timeout=10)
+        logging.debug("building SEMS+ history request on URL: %s which returned status code: %s and response length = %d", r.url, r.status_code, len(r.content))
+        try:
+            return r.json()
+        except json.decoder.JSONDecodeError as exp:
+            logging.error("SEMS+ history request JSONDecodeError: %s", exp)
+            return None
+
     def setInverterStatus(self, stationId, inverterSn, mode):
         url = _PowerControlURLPart
         payload = {
@@ -538,15 +982,14 @@ class GoodWeSEMSPlus(GoodWe):
             'InverterStatus': mode
         }
 
-        api_base = self._resolve_api_base_for_url_part(self.base_url, url)
-        r = requests.post(api_base + url, headers=self.apiRequestHeadersV2(), json=payload, timeout=10)
-        logging.debug("building SEMS+ inverter mode post on URL: %s and payload: '%s' which returned status code: %s and response length = %s", r.url, str(payload), r.status_code, len(r.text))
+        r = self.session.post(self._apiUrl(url), headers=self.apiRequestHeadersV2(), json=payload, timeout=10)
+        logging.debug("building SEMS+ inverter mode post on URL: %s and payload: '%s' which returned status code: %s and response length = %d", r.url, payload, r.status_code, len(r.content))
         try:
             apiResponse = r.json()
         except json.decoder.JSONDecodeError as exp:
             logging.error("SEMS+ inverter mode post JSONDecodeError: %s", exp)
             Domoticz.Error("SEMS+ inverter mode post JSONDecodeError: " + str(exp))
             return False
-        logging.debug("response inverter mode post : %s", json.dumps(apiResponse))
+        logging.debug("response inverter mode post : %s", apiResponse)
         return apiResponse
         
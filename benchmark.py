@@ -0,0 +1,299 @@
+# Copyright 2021 Jan-Jaap Kostelijk
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is furnished
+# to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS
+# FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR
+# COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN
+# AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION
+# WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+
+# this module measures the plugin without the SEMS cloud and without Domoticz.
+# The plugin runs on the fake Domoticz classes of manual_test.py, the SEMS portal is
+# the local stand-in of fakeSEMS.py running in a separate process, so the CPU time
+# measured is the CPU time of the plugin only. Run:
+#     python benchmark.py cycle --stations 2 --inverters 3 --strings 4 --latency 0.05
+# The scaling benchmark measures parsing, unit creation and unit updates for synthetic stations
+# of up to 200 inverters without HTTP, its results are appended to benchmark_results.jsonl:
+#     python benchmark.py scaling --inverters 1 50 200 --strings 1 4
+
+import argparse
+import json
+import logging
+import os
+import platform
+import re
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+import urllib.request
+
+import manual_test
+from fakeSEMS import FakeStation
+from metrics import percentile
+
+_Here = os.path.dirname(os.path.abspath(__file__))
+_PollWait = 0.0005 #seconds between checks whether the poller finished
+_ResultsFile = os.path.join(_Here, "benchmark_results.jsonl")
+_RegressionThreshold = 1.2 #report a result this much slower than the previous run of the same version
+
+class QuietUnit(manual_test.FakeUnit):
+    """FakeUnit without printing, printing would dominate the measured time"""
+
+    def Create(self):
+        devices = sys.modules["plugin"].Devices
+        if self.DeviceID not in devices:
+            devices[self.DeviceID] = manual_test.FakeDevice(self.DeviceID)
+        devices[self.DeviceID].Units[self.Unit] = self
+
+    def Update(self):
+        self.update_called += 1
+
+def summarize(values):
+    ordered = sorted(values)
+    return {"mean": sum(values) / len(values) if values else 0.0, "p50": percentile(ordered, 0.5),
+            "p95": percentile(ordered, 0.95), "max": max(values, default=0.0)}
+
+def loadPlugin(parameters):
+    """Load plugin.py on the fake Domoticz classes, only errors are printed"""
+    plugin = manual_test.load_plugin_module()
+    manual_test.setup_plugin_environment(plugin)
+    plugin.Domoticz.Unit = QuietUnit
+    plugin.Domoticz.Log = plugin.Domoticz.Status = lambda message: None
+    plugin.Parameters.update(parameters)
+    return plugin
+
+def closeLogFiles(folder):
+    """close the log files the plugin opened in folder, so the folder can be removed"""
+    root = logging.getLogger()
+    for handler in list(root.handlers):
+        if isinstance(handler, logging.FileHandler) and os.path.realpath(os.path.dirname(handler.baseFilename)) == os.path.realpath(folder):
+            root.removeHandler(handler)
+            handler.close()
+
+class FakeSEMSProcess:
+    """fakeSEMS.py running in a child process, the portal URL is read from its first output line"""
+
+    def __init__(self, arguments):
+        self._process = subprocess.Popen([sys.executable, os.path.join(_Here, "fakeSEMS.py"), "--port", "0"] + arguments,
+                                         stdout=subprocess.PIPE, text=True)
+        self.url = self._process.stdout.readline().strip()
+        if not self.url:
+            raise RuntimeError("fakeSEMS.py did not start")
+
+    def stats(self):
+        with urllib.request.urlopen(self.url + "/stats") as response:
+            return json.loads(response.read())
+
+    def requestCount(self):
+        return sum(self.stats()["requests"].values())
+
+    def stop(self):
+        self._process.terminate()
+        self._process.wait()
+
+def runCycles(plugin, portal, cycles):
+    """
+    Drive the plugin with heartbeats: one heartbeat starts a poll, the next one after the poller
+    finished processes its results. Return the latency, CPU time and requests of each cycle.
+    """
+    accounts = plugin._plugin.accounts
+    results = []
+    for cycle in range(cycles):
+        requests = portal.requestCount()
+        cpu = time.process_time()
+        start = time.perf_counter()
+        plugin._plugin.runAgain = 1
+        plugin.onHeartbeat()
+        while plugin._plugin.poller.busy:
+            time.sleep(_PollWait)
+        plugin._plugin.runAgain = 2 #Mode2 is 2 heartbeats, so this heartbeat only processes the results
+        plugin.onHeartbeat()
+        results.append((time.perf_counter() - start, time.process_time() - cpu, portal.requestCount() - requests))
+    for account in accounts:
+        if account.breaker.state != "closed":
+            print("warning: SEMS circuit", account.breaker.state, "- requests failed during the benchmark")
+    return results
+
+def benchmarkCycle(args):
+    stations = ["bench-%02d:%d:%d" % (i + 1, args.inverters, args.strings) for i in range(args.stations)]
+    portalArguments = ["--stations"] + stations + ["--latency", str(args.latency), "--token-requests", str(args.token_requests)]
+    if args.fail_login:
+        portalArguments += ["--fail-login", args.fail_login]
+    portal = FakeSEMSProcess(portalArguments)
+    workingFolder = os.getcwd()
+    try:
+        with tempfile.TemporaryDirectory(prefix="goodwe-benchmark-") as workdir:
+            os.chdir(workdir) #the plugin writes its log file in the working directory
+            try:
+                plugin = loadPlugin({"Name": "Benchmark", "Mode1": ";".join(station.split(":")[0] for station in stations),
+                                     "Mode2": "2", "Mode4": "Yes", "Mode6": "Normal"})
+                import GoodWe
+                GoodWe.NEW_LOGIN_URL = portal.url + "/web/sems/sems-user/api/v1/auth/cross-login"
+                GoodWe.OLD_LOGIN_URL = portal.url + "/api/v3/Common/CrossLogin"
+                plugin.onStart()
+                try:
+                    first = runCycles(plugin, portal, 1)[0]
+                    cycles = runCycles(plugin, portal, args.cycles)
+                finally:
+                    plugin.onStop()
+            finally:
+                closeLogFiles(workdir)
+                os.chdir(workingFolder)
+    finally:
+        portal.stop()
+    report = {
+        "benchmark": "cycle", "stations": args.stations, "inverters": args.inverters, "strings": args.strings,
+        "latency": args.latency, "cycles": args.cycles,
+        "first cycle ms": first[0] * 1000,
+        "cycle ms": summarize([latency * 1000 for latency, cpu, requests in cycles]),
+        "cpu ms per cycle": summarize([cpu * 1000 for latency, cpu, requests in cycles]),
+        "requests per cycle": sum(requests for latency, cpu, requests in cycles) / len(cycles),
+    }
+    for phase, stats in plugin._plugin.metrics.summary().items():
+        report[phase + " ms"] = {"p50": stats.p50 * 1000, "p95": stats.p95 * 1000, "max": stats.max * 1000}
+    return report
+
+def measureScaling(inverters, strings, polls):
+    """
+    Measure one station of inverters with strings each, without HTTP: the first poll creates the units,
+    the next polls parse the station data and update the units. Return a report with times in ms.
+    """
+    plugin = loadPlugin({"Name": "Benchmark", "Mode4": "Yes"})
+    import GoodWe
+    instance = plugin._plugin
+    station = FakeStation("scaling", inverters, strings)
+    payloads = [station.data(sample) for sample in range(2 * polls + 1)]
+
+    start = time.perf_counter()
+    instance.updateDevices(GoodWe.PowerStation(stationData=payloads[0]))
+    firstPoll = time.perf_counter() - start
+
+    parseTimes, updateTimes = [], []
+    for payload in payloads[1:polls + 1]:
+        start = time.perf_counter()
+        parsed = GoodWe.PowerStation(stationData=payload)
+        parsedAt = time.perf_counter()
+        instance.updateDevices(parsed)
+        parseTimes.append((parsedAt - start) * 1000)
+        updateTimes.append((time.perf_counter() - parsedAt) * 1000)
+
+    #allocations are measured in separate polls, tracing slows down the code measured
+    peaks, retained = [], []
+    tracemalloc.start()
+    for payload in payloads[polls + 1:]:
+        tracemalloc.reset_peak()
+        before = tracemalloc.get_traced_memory()[0]
+        instance.updateDevices(GoodWe.PowerStation(stationData=payload))
+        current, peak = tracemalloc.get_traced_memory()
+        peaks.append((peak - before) / 1024)
+        retained.append(float(current - before))
+    tracemalloc.stop()
+
+    return {
+        "benchmark": "scaling", "inverters": inverters, "strings": strings, "polls": polls,
+        "units": sum(len(device.Units) for device in plugin.Devices.values()),
+        "first poll ms": firstPoll * 1000,
+        "parse ms": summarize(parseTimes),
+        "update ms": summarize(updateTimes),
+        "peak KiB per poll": summarize(peaks),
+        "retained bytes per poll": summarize(retained),
+        "unit writes": plugin._updateCache.written,
+        "unit writes skipped": plugin._updateCache.skipped,
+    }
+
+def pluginVersion():
+    with open(os.path.join(_Here, "plugin.py")) as f:
+        match = re.search(r'<plugin key="GoodWeSEMS"[^>]* version="([^"]+)"', f.read())
+    return match.group(1) if match else "unknown"
+
+def previousResults(path):
+    """Return the stored results by (benchmark, configuration), the latest result of each"""
+    previous = {}
+    if not os.path.exists(path):
+        return previous
+    with open(path) as f:
+        for line in f:
+            try:
+                report = json.loads(line)
+            except json.decoder.JSONDecodeError:
+                continue
+            previous[resultKey(report)] = report
+    return previous
+
+def resultKey(report):
+    return (report.get("benchmark"), report.get("stations"), report.get("inverters"), report.get("strings"), report.get("latency"))
+
+def compareResults(report, previous):
+    """print the p50 times which got slower than the previous stored run"""
+    if previous is None:
+        return
+    for key, value in report.items():
+        if key.endswith(" ms") and isinstance(value, dict) and isinstance(previous.get(key), dict):
+            before, now = previous[key]["p50"], value["p50"]
+            if before > 0 and now > before * _RegressionThreshold:
+                print("regression: %s p50 %.3f -> %.3f ms (version %s -> %s)" % (
+                    key, before, now, previous.get("version"), report.get("version")))
+
+def saveReport(report, path):
+    """append the report to the results file, after comparing it with the previous run"""
+    report["version"] = pluginVersion()
+    report["python"] = platform.python_version()
+    report["date"] = time.strftime("%Y-%m-%d %H:%M:%S")
+    compareResults(report, previousResults(path).get(resultKey(report)))
+    with open(path, "a") as f:
+        f.write(json.dumps(report) + "\n")
+
+def printReport(report):
+    for key, value in report.items():
+        if isinstance(value, dict):
+            print("%-24s %s" % (key, "  ".join("%s %.2f" % item for item in value.items())))
+        elif isinstance(value, float):
+            print("%-24s %.2f" % (key, value))
+        else:
+            print("%-24s %s" % (key, value))
+
+def main():
+    parser = argparse.ArgumentParser(description="GoodWe SEMS plugin benchmarks")
+    commands = parser.add_subparsers(dest="command", required=True)
+    cycle = commands.add_parser("cycle", help="full poll cycles against the local SEMS stand-in")
+    cycle.add_argument("--stations", type=int, default=1)
+    cycle.add_argument("--inverters", type=int, default=1, help="inverters per station")
+    cycle.add_argument("--strings", type=int, default=2, help="PV input strings per inverter")
+    cycle.add_argument("--latency", type=float, default=0.0, help="seconds added to each SEMS response")
+    cycle.add_argument("--cycles", type=int, default=20)
+    cycle.add_argument("--fail-login", choices=("new", "legacy", "both"), help="login flows that fail")
+    cycle.add_argument("--token-requests", type=int, default=0, help="data requests per token, 0 for no limit")
+    cycle.add_argument("--output", help="append the report as a JSON line to this file")
+    scaling = commands.add_parser("scaling", help="parsing and unit updates of large stations, without HTTP")
+    scaling.add_argument("--inverters", type=int, nargs="+", default=[1, 10, 50, 100, 200])
+    scaling.add_argument("--strings", type=int, nargs="+", default=[1, 2, 3, 4], help="PV input strings per inverter")
+    scaling.add_argument("--polls", type=int, default=20)
+    scaling.add_argument("--output", default=_ResultsFile, help="append the reports as JSON lines to this file")
+    args = parser.parse_args()
+
+    output = os.path.abspath(args.output) if args.output else None
+    if args.command == "cycle":
+        reports = [benchmarkCycle(args)]
+    else:
+        reports = [measureScaling(inverters, strings, args.polls) for inverters in args.inverters for strings in args.strings]
+    for report in reports:
+        printReport(report)
+        print()
+        if output:
+            saveReport(report, output)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,114 @@
+# Copyright 2021 Jan-Jaap Kostelijk
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is furnished
+# to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS
+# FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR
+# COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN
+# AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION
+# WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+
+# this module protects the SEMS portal and the plugin against each other during an outage.
+# After a number of failed polls the circuit opens and no requests are made until a
+# jittered, exponentially growing delay has passed. Then one poll is let through (half-open),
+# its result closes the circuit again or reopens it with a longer delay.
+
+import logging
+import random
+import threading
+import time
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half-open"
+
+_FailureThreshold = 3 #consecutive failures before the circuit opens
+_BaseDelay = 60 #seconds the circuit stays open the first time
+_MaxDelay = 30 * 60 #seconds, max time the circuit stays open
+
+class CircuitBreaker:
+    """
+    A class to stop calling a failing service for a while.
+    failureThreshold: consecutive failures before the circuit opens
+    baseDelay: seconds the circuit stays open the first time, doubled on each reopen
+    maxDelay: max seconds the circuit stays open
+    """
+
+    def __init__(self, failureThreshold=_FailureThreshold, baseDelay=_BaseDelay, maxDelay=_MaxDelay):
+        self.failureThreshold = failureThreshold
+        self.baseDelay = baseDelay
+        self.maxDelay = maxDelay
+        self._lock = threading.Lock()
+        self._state = CLOSED
+        self._failures = 0
+        self._openings = 0
+        self._retryAt = 0.0
+
+    def __repr__(self):
+        return "CircuitBreaker(state: " + self._state + ", failures: " + str(self._failures) + ")"
+
+    @property
+    def state(self):
+        return self._state
+
+    def retryIn(self, now=None):
+        """Return the seconds until the open circuit lets a request through"""
+        if now is None:
+            now = time.monotonic()
+        return max(0.0, self._retryAt - now) if self._state == OPEN else 0.0
+
+    def allowRequest(self, now=None):
+        """True when a request may be made, an open circuit lets one request through once its delay has passed"""
+        if now is None:
+            now = time.monotonic()
+        with self._lock:
+            if self._state == CLOSED:
+                return True
+            if self._state == OPEN and now >= self._retryAt:
+                self._state = HALF_OPEN
+                logging.info("SEMS circuit half-open, trying a request")
+                return True
+            return False
+
+    def recordSuccess(self):
+        with self._lock:
+            if self._state != CLOSED:
+                logging.info("SEMS circuit closed, requests succeed again")
+            self._state = CLOSED
+            self._failures = 0
+            self._openings = 0
+
+    def releaseProbe(self):
+        """The poll let through by a half-open circuit made no request, let the next poll try again"""
+        with self._lock:
+            if self._state == HALF_OPEN:
+                self._state = OPEN
+
+    def recordFailure(self, now=None):
+        if now is None:
+            now = time.monotonic()
+        with self._lock:
+            self._failures += 1
+            if self._state == OPEN:
+                return
+            if self._state == HALF_OPEN or self._failures >= self.failureThreshold:
+                self._open(now)
+
+    def _open(self, now):
+        delay = min(self.maxDelay, self.baseDelay * 2 ** self._openings)
+        #equal jitter: spread the retries of many installations over the second half of the delay
+        delay = delay / 2 + random.uniform(0, delay / 2)
+        self._openings += 1
+        self._state = OPEN
+        self._retryAt = now + delay
+        logging.warning("SEMS circuit open after %d failures, next request in %d seconds", self._failures, delay)
@@ -0,0 +1,78 @@
+# Copyright 2021 Jan-Jaap Kostelijk
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is furnished
+# to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS
+# FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR
+# COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN
+# AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION
+# WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+
+
+# this module queues the inverter control commands given in Domoticz.
+# Commands are sent to SEMS off the Domoticz thread. Repeated selector presses for an inverter
+# are coalesced into the last one and writes to the portal are spaced by a min interval.
+
+import collections
+import time
+
+_MinCommandInterval = 30 #seconds between two writes to the SEMS portal
+
+InverterCommand = collections.namedtuple("InverterCommand", ["serialNumber", "mode", "queuedAt"])
+
+class CommandQueue:
+    """
+    A class to hold the commands waiting to be sent, at most one per inverter.
+    minInterval: min seconds between two commands taken from the queue
+    """
+
+    def __init__(self, minInterval=_MinCommandInterval):
+        self.minInterval = minInterval
+        self._pending = collections.OrderedDict() #serial number: InverterCommand, in order of the first press
+        self._inFlight = set() #serial numbers of the commands being sent
+        self._lastSent = None
+        self.coalesced = 0 #number of commands replaced by a later one before being sent
+
+    def __len__(self):
+        return len(self._pending)
+
+    def submit(self, serialNumber, mode, now=None):
+        """queue a command, a command still waiting for the same inverter is replaced. True when one was replaced"""
+        if now is None:
+            now = time.monotonic()
+        replaced = serialNumber in self._pending
+        if replaced:
+            self.coalesced += 1
+            queuedAt = self._pending[serialNumber].queuedAt
+        else:
+            queuedAt = now
+        self._pending[serialNumber] = InverterCommand(serialNumber, mode, queuedAt)
+        return replaced
+
+    def next(self, now=None):
+        """Return the next command to send, None when the queue is empty or the min interval has not passed"""
+        if now is None:
+            now = time.monotonic()
+        if self._lastSent is not None and now - self._lastSent < self.minInterval:
+            return None
+        for serialNumber in self._pending:
+            if serialNumber not in self._inFlight:
+                command = self._pending.pop(serialNumber)
+                self._inFlight.add(serialNumber)
+                self._lastSent = now
+                return command
+        return None
+
+    def done(self, serialNumber):
+        """the command of an inverter was sent or failed, a next command for it may be taken"""
+        self._inFlight.discard(serialNumber)
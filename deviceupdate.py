@@ -0,0 +1,104 @@
+# Copyright 2021 Jan-Jaap Kostelijk
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is furnished
+# to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS
+# FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR
+# COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN
+# AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION
+# WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+
+# this module decides which Domoticz unit updates are written to the Domoticz database.
+# Every write costs a database transaction, so values are compared against the last
+# written value kept in memory and only written when they changed enough or got too old.
+
+import string
+import time
+
+class UpdatePolicy:
+    """
+    A class to describe when a Domoticz unit should be written:
+    deadband: minimal change of the (first) numeric value before it is written
+    minInterval: minimal number of seconds between two writes
+    maxInterval: maximal number of seconds between two writes, None for no maximum
+    forceOnStateChange: a change of nValue is always written, also within minInterval
+    """
+    __slots__ = ("deadband", "minInterval", "maxInterval", "forceOnStateChange")
+
+    def __init__(self, deadband=0.0, minInterval=0, maxInterval=None, forceOnStateChange=False):
+        self.deadband = deadband
+        self.minInterval = minInterval
+        self.maxInterval = maxInterval
+        self.forceOnStateChange = forceOnStateChange
+
+    def __repr__(self):
+        return "UpdatePolicy(deadband={}, minInterval={}, maxInterval={}, forceOnStateChange={})".format(
+            self.deadband, self.minInterval, self.maxInterval, self.forceOnStateChange)
+
+#write whenever the value differs from the last written value
+ExactPolicy = UpdatePolicy()
+
+def numericValue(sValue):
+    """Return the first numeric field of a sValue like '123.4', '231.5V' or '500;1234000', None when not numeric."""
+    try:
+        return float(sValue.split(";", 1)[0].strip().rstrip(string.ascii_letters))
+    except ValueError:
+        return None
+
+class UpdateCache:
+    """
+    A class to remember the last written value of each Domoticz unit
+    and to decide with an UpdatePolicy if a new value should be written.
+    """
+
+    def __init__(self):
+        self._lastWritten = {} #(DeviceID, Unit): (nValue, sValue, numeric value, time written)
+        self.written = 0
+        self.skipped = 0
+
+    def shouldWrite(self, key, nValue, sValue, policy=ExactPolicy, now=None):
+        last = self._lastWritten.get(key)
+        if last is None:
+            return True
+        if now is None:
+            now = time.monotonic()
+        lastN, lastS, lastNumeric, lastTime = last
+        elapsed = now - lastTime
+        if nValue != lastN and policy.forceOnStateChange:
+            return True
+        if elapsed < policy.minInterval:
+            return False
+        if policy.maxInterval is not None and elapsed >= policy.maxInterval:
+            return True
+        if nValue != lastN:
+            return True
+        if sValue == lastS:
+            return False
+        if policy.deadband > 0 and lastNumeric is not None:
+            numeric = numericValue(sValue)
+            if numeric is not None and abs(numeric - lastNumeric) < policy.deadband:
+                return False
+        return True
+
+    def remember(self, key, nValue, sValue, now=None):
+        if now is None:
+            now = time.monotonic()
+        self._lastWritten[key] = (nValue, sValue, numericValue(sValue), now)
+
+    def forget(self, DeviceID, Unit=None):
+        """Drop remembered values of a removed device or unit."""
+        if Unit is not None:
+            self._lastWritten.pop((DeviceID, Unit), None)
+            return
+        for key in [key for key in self._lastWritten if key[0] == DeviceID]:
+            del self._lastWritten[key]
@@ -0,0 +1,150 @@
+# Copyright 2021 Jan-Jaap Kostelijk
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is furnished
+# to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS
+# FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR
+# COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN
+# AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION
+# WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+
+# this module calculates the energy produced by a PV input string.
+# SEMS only reports the momentary power of a string, the energy (Wh) is the integral
+# of the power over time. The state is kept in memory on a monotonic clock and only
+# rebuilt from the Domoticz unit (or a stored checkpoint) when the plugin starts.
+# A gap between two samples that is too long to average (plugin or SEMS down) is not integrated,
+# it is filled afterwards from the power samples in the SEMS history (backfill).
+
+import logging
+import time
+from array import array
+
+_LastUpdateFormat = "%Y-%m-%d %H:%M:%S"
+
+class EnergyIntegrator:
+    """
+    A class to integrate the power (W) of one PV string into energy (Wh).
+    power: last power sample in Watt
+    energy: energy counter in Wh
+    stamp: time.monotonic() of the last power sample
+    """
+    __slots__ = ("power", "energy", "stamp")
+
+    def __init__(self, power=0.0, energy=0.0, stamp=None):
+        self.power = power
+        self.energy = energy
+        self.stamp = time.monotonic() if stamp is None else stamp
+
+    def __repr__(self):
+        return "EnergyIntegrator(power: {:.1f} W, energy: {:.2f} Wh)".format(self.power, self.energy)
+
+    def update(self, power, now=None):
+        """add the energy since the previous sample, averaging previous and current power, and return the counter"""
+        if now is None:
+            now = time.monotonic()
+        elapsed = now - self.stamp
+        if elapsed > 0:
+            self.energy += (self.power + power) / 2 * elapsed / 3600
+        self.power = power
+        self.stamp = now
+        return self.energy
+
+    def restart(self, power, now=None):
+        """continue from a new sample without adding energy, used after a gap which is filled by a backfill"""
+        self.power = power
+        self.stamp = time.monotonic() if now is None else now
+
+    def checkpoint(self):
+        """return the state as [power, energy, wall clock time] to be stored between restarts"""
+        return [self.power, self.energy, time.time() - (time.monotonic() - self.stamp)]
+
+    @classmethod
+    def fromCheckpoint(cls, checkpoint):
+        power, energy, wallclock = checkpoint
+        return cls(float(power), float(energy), _monotonicFromWallclock(wallclock))
+
+    @classmethod
+    def fromUnit(cls, sValue, lastUpdate):
+        """rebuild the state from a Domoticz kWh unit with sValue 'power;energy' and LastUpdate 'YYYY-mm-dd HH:MM:SS'"""
+        try:
+            previousPower, currentCount = sValue.split(";")
+            power = float(previousPower.strip().rstrip("wW"))
+            energy = float(currentCount)
+        except ValueError:
+            #in case no values there, just assume zero
+            power = 0.0 #Watt
+            energy = 0.0 #Wh
+        try:
+            wallclock = time.mktime(time.strptime(lastUpdate, _LastUpdateFormat))
+        except (TypeError, ValueError):
+            wallclock = time.time()
+        return cls(power, energy, _monotonicFromWallclock(wallclock))
+
+class EnergyGap:
+    """
+    A class to describe a period without power samples of one PV string:
+    device, unit: the Domoticz unit of the string
+    start, end: wall clock time of the samples before and after the gap
+    startPower, endPower: power (W) of these samples
+    """
+    __slots__ = ("device", "unit", "start", "end", "startPower", "endPower")
+
+    def __init__(self, device, unit, start, end, startPower, endPower):
+        self.device = device
+        self.unit = unit
+        self.start = start
+        self.end = end
+        self.startPower = startPower
+        self.endPower = endPower
+
+    def __repr__(self):
+        return "EnergyGap({} unit {}: {:.0f} seconds)".format(self.device, self.unit, self.end - self.start)
+
+def integrate(times, powers):
+    """Return the energy (Wh) of power samples (W) at times (seconds), trapezoid rule in one pass"""
+    return sum((p0 + p1) * (t1 - t0) for t0, t1, p0, p1 in zip(times, times[1:], powers, powers[1:])) / 7200
+
+def backfillEnergy(gap, samples):
+    """
+    Return the energy (Wh) produced during a gap from history samples [(time, power)].
+    Without samples this is the average of the power before and after the gap, as without backfill.
+    """
+    times, powers = array("d", [gap.start]), array("d", [gap.startPower])
+    for stamp, power in sorted(samples):
+        if gap.start < stamp < gap.end:
+            times.append(stamp)
+            powers.append(power)
+    times.append(gap.end)
+    powers.append(gap.endPower)
+    return integrate(times, powers)
+
+def coversGap(gap, samples, maxInterval):
+    """True when the samples [(time, power)] leave no period longer than maxInterval seconds in the gap"""
+    times = [gap.start] + sorted(stamp for stamp, power in samples if gap.start < stamp < gap.end) + [gap.end]
+    return all(t1 - t0 <= maxInterval for t0, t1 in zip(times, times[1:]))
+
+def _monotonicFromWallclock(wallclock):
+    return time.monotonic() - max(0.0, time.time() - wallclock)
+
+def coldStart(sValue, lastUpdate, checkpoint=None):
+    """rebuild an integrator on start, from a stored checkpoint when it is more recent than the Domoticz unit"""
+    fromUnit = EnergyIntegrator.fromUnit(sValue, lastUpdate)
+    if checkpoint is not None:
+        try:
+            fromCheckpoint = EnergyIntegrator.fromCheckpoint(checkpoint)
+        except (TypeError, ValueError) as exp:
+            logging.debug("ignoring invalid energy checkpoint %s: %s", checkpoint, exp)
+        else:
+            if fromCheckpoint.stamp >= fromUnit.stamp and fromCheckpoint.energy >= fromUnit.energy:
+                return fromCheckpoint
+    return fromUnit
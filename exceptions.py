@@ -10,31 +10,46 @@ class GoodweException(Exception):
     def __str(self):
         return str(self.message)
         
-class TooManyRetries(GoodweException):
+class AuthenticationFailure(GoodweException):
+    """The SEMS portal rejected the login or the token"""
+
+class TransientFailure(GoodweException):
+    """The SEMS portal could not be reached or gave an invalid response, a later poll may succeed"""
+
+class PermanentFailure(GoodweException):
+    """The SEMS portal rejected the request, retrying will not help"""
+
+class CircuitOpen(TransientFailure):
+    """Requests are suspended after repeated failures"""
+    def __init__(self, retryIn):
+        self.message = "SEMS requests suspended for {:.0f} seconds after repeated failures".format(retryIn)
+        super().__init__(self.message)
+
+class TooManyRetries(TransientFailure):
     """Too many retries to call API"""
     def __init__(self):
         self.message = "Failed to call GoodWe API (too many retries)"
         super().__init__(self.message)
 
-class FailureWithMessage(GoodweException):
+class FailureWithMessage(PermanentFailure):
     """Too many retries to call API"""
     def __init__(self, code):
         self.message = "Failed to call GoodWe API (return message = {})".format(code)
         super().__init__(self.message)
 
-class FailureWithoutMessage(GoodweException):
+class FailureWithoutMessage(TransientFailure):
     """Too many retries to call API"""
     def __init__(self):
         self.message = "Failed to call GoodWe API (no return message )"
         super().__init__(self.message)
 
-class FailureWithErrorCode(GoodweException):
+class FailureWithErrorCode(PermanentFailure):
     """Too many retries to call API"""
     def __init__(self, code):
         self.message = "Failed to call GoodWe API (return code = {})".format(code)
         super().__init__(self.message)
 
-class FailureWithoutErrorCode(GoodweException):
+class FailureWithoutErrorCode(TransientFailure):
     """Too many retries to call API"""
     def __init__(self):
         self.message = "Failed to call GoodWe API (no return code )"
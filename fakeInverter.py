@@ -0,0 +1,141 @@
+# Copyright 2021 Jan-Jaap Kostelijk
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is furnished
+# to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS
+# FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR
+# COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN
+# AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION
+# WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+
+
+# this module simulates a GoodWe inverter on the local network, for tests of the local transport without hardware.
+# It answers the Modbus read requests of localinverter.py over UDP with the registers of its register map,
+# the values vary with each read like the stations of fakeSEMS.py. Run it on its own with:
+#     python fakeInverter.py --port 8899 --serial 5010KDTU000001 --strings 2
+# and enter 127.0.0.1 as local inverter address in the hardware configuration.
+
+import argparse
+import itertools
+import socketserver
+import struct
+import threading
+import localinverter
+
+_ShutdownPoll = 0.05 #seconds, how often the server thread checks for a shutdown
+
+class FakeInverter:
+    """
+    A class to run a simulated inverter on a local UDP port in a background thread.
+    serialNumber: serial number in the device info registers
+    strings: number of PV input strings with a voltage (1.. 4)
+    address: Modbus address answered to
+    """
+
+    def __init__(self, serialNumber="5010KDTU000001", strings=2, port=0, address=localinverter.DefaultAddress):
+        self.serialNumber = serialNumber
+        self.strings = strings
+        self.address = address
+        self.silent = False #True to drop all requests, like an inverter switched off at night
+        self.requests = 0
+        self._samples = itertools.count()
+        self._lock = threading.Lock()
+        self._server = socketserver.ThreadingUDPServer(("127.0.0.1", port), self._handler())
+        self._server.daemon_threads = True
+        self._thread = None
+
+    @property
+    def host(self):
+        return self._server.server_address[0]
+
+    @property
+    def port(self):
+        return self._server.server_address[1]
+
+    def start(self):
+        self._thread = threading.Thread(name="FakeInverter", target=self._server.serve_forever, args=(_ShutdownPoll,), daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def values(self, sample):
+        """Return the values of the register map, varying with the sample number"""
+        variation = sample % 10
+        values = {"vgrid1": 231.0 + variation / 10, "igrid1": 7.0 + variation / 10, "fgrid1": 50.0 + variation / 100,
+                  "power": 1600 + variation * 10, "workMode": 1, "temperature": 40.0 + variation / 10,
+                  "etotal": 12345.6 + sample / 10}
+        for string in range(4):
+            present = string < self.strings
+            values["vpv" + str(string + 1)] = 350.0 + variation if present else 0.0
+            values["ipv" + str(string + 1)] = 2.5 + variation / 10 if present else 0.0
+        return values
+
+    def registers(self, sample):
+        """Return the registers {register: 16 bit value} of the device info and running data"""
+        registers = {}
+        serial = self.serialNumber.encode("ascii")[:16].ljust(16, b"\0")
+        for i in range(8):
+            registers[localinverter.SerialNumberRegister + i] = struct.unpack(">H", serial[2 * i:2 * i + 2])[0]
+        values = self.values(sample)
+        for field, register, words, divisor, signed in localinverter.REGISTER_MAP:
+            raw = round(values[field] * divisor).to_bytes(2 * words, "big", signed=signed)
+            for i in range(words):
+                registers[register + i] = struct.unpack(">H", raw[2 * i:2 * i + 2])[0]
+        return registers
+
+    def _respond(self, request):
+        """Return the answer to a read request, None for requests which are not answered"""
+        if len(request) != 8 or struct.unpack("<H", request[-2:])[0] != localinverter.crc16(request[:-2]):
+            return None
+        address, function, register, count = struct.unpack(">BBHH", request[:6])
+        if address != self.address or function != 0x03 or count > 125:
+            return None
+        with self._lock:
+            self.requests += 1
+            sample = next(self._samples) if register == localinverter.RunningDataRegister else 0
+        registers = self.registers(sample)
+        data = b"".join(struct.pack(">H", registers.get(register + i, 0)) for i in range(count))
+        return localinverter.readResponse(self.address, data)
+
+    def _handler(self):
+        inverter = self
+
+        class Handler(socketserver.BaseRequestHandler):
+            def handle(self):
+                request, sock = self.request
+                if inverter.silent:
+                    return
+                response = inverter._respond(request)
+                if response is not None:
+                    sock.sendto(response, self.client_address)
+
+        return Handler
+
+def main():
+    parser = argparse.ArgumentParser(description="Local simulated GoodWe inverter")
+    parser.add_argument("--port", type=int, default=localinverter.DefaultPort)
+    parser.add_argument("--serial", default="5010KDTU000001", help="serial number of the inverter")
+    parser.add_argument("--strings", type=int, default=2, help="number of PV input strings, 1.. 4")
+    args = parser.parse_args()
+    inverter = FakeInverter(args.serial, args.strings, args.port)
+    print("%s:%d" % (inverter.host, inverter.port), flush=True)
+    try:
+        inverter._server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+if __name__ == "__main__":
+    main()
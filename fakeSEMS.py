@@ -0,0 +1,287 @@
+# Copyright 2021 Jan-Jaap Kostelijk
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is furnished
+# to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS
+# FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR
+# COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN
+# AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION
+# WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+
+# this module is a local stand-in for the GoodWe SEMS portal, for benchmarks and tests without the cloud.
+# It implements both cross-login flows, GetMonitorDetailByPowerstationId, QueryPowerStationByHistory,
+# GetInverterDataByColumn and SaveRemoteControlInverter with a configurable latency, error codes and station sizes. Run it on its own with:
+#     python fakeSEMS.py --port 8080 --stations st-1:2:4 --latency 0.2
+# and point GoodWe.NEW_LOGIN_URL / GoodWe.OLD_LOGIN_URL to the printed URLs.
+
+import argparse
+import itertools
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs
+
+NEW_LOGIN_PATH = "/web/sems/sems-user/api/v1/auth/cross-login"
+OLD_LOGIN_PATH = "/api/v3/Common/CrossLogin"
+API_PATH = "/api"
+TOKEN_INVALID = 100001 #token not known to the portal
+TOKEN_EXPIRED = 100002
+LOGIN_FAILED = 100005 #invalid password or username
+HISTORY_VALUES = {"Vpv": 350.0, "Ipv": 2.0} #values of the history columns of each string
+_ShutdownPoll = 0.05 #seconds, how often the server thread checks for a shutdown
+
+class FakeStation:
+    """
+    A class to describe a simulated power station:
+    id: power station id
+    inverters: number of inverters
+    strings: number of PV input strings of each inverter (1.. 4)
+    """
+
+    def __init__(self, id, inverters=1, strings=2):
+        self.id = id
+        self.inverters = inverters
+        self.strings = strings
+
+    def __repr__(self):
+        return "FakeStation(" + self.id + ": " + str(self.inverters) + " inverters, " + str(self.strings) + " strings)"
+
+    @classmethod
+    def parse(cls, text):
+        """parse 'id:inverters:strings', the numbers are optional"""
+        fields = text.split(":")
+        return cls(fields[0], *(int(field) for field in fields[1:3]))
+
+    def data(self, sample):
+        """Return the data of a GetMonitorDetailByPowerstationId response, values vary with the sample number"""
+        inverters = []
+        for i in range(self.inverters):
+            variation = (sample + i) % 10
+            inverter = {
+                "sn": "%s-inv%03d" % (self.id, i + 1),
+                "name": "GW5000-DT",
+                "status": 1,
+                "fault_message": "",
+                "tempperature": 40.0 + variation / 10,
+                "d": {"fac1": 50.0 + variation / 100},
+                "output_current": 7.0 + variation / 10,
+                "output_voltage": 231.0 + variation / 10,
+                "output_power": 1600 + variation * 10,
+                "etotal": 12345.6 + sample / 100,
+                "battery": "0",
+                "bms_status": "",
+                "battery_power": 0,
+            }
+            for string in range(self.strings):
+                inverter["pv_input_" + str(string + 1)] = "%.1fV/%.1fA" % (350.0 + variation, 2.5 + variation / 10)
+            inverters.append(inverter)
+        return {
+            "info": {"powerstation_id": self.id, "stationname": "Fake " + self.id, "address": "Localhost",
+                     "status": 1, "time": time.strftime("%m/%d/%Y %H:%M:%S")},
+            "inverter": inverters,
+        }
+
+class FakeSEMS:
+    """
+    A class to run the stand-in portal on a local port in a background thread.
+    stations: FakeStation list
+    latency: seconds added to each response
+    failLogin: login flows answering LOGIN_FAILED: None, "new", "legacy" or "both"
+    tokenRequests: number of data requests a token is valid for, after that TOKEN_EXPIRED is answered, 0 for no limit
+    """
+
+    def __init__(self, stations, latency=0.0, failLogin=None, tokenRequests=0, port=0):
+        self.stations = {station.id: station for station in stations}
+        self.latency = latency
+        self.failLogin = failLogin
+        self.tokenRequests = tokenRequests
+        self._tokens = {} #token: number of data requests made with it
+        self._tokenNumbers = itertools.count(1)
+        self._samples = itertools.count()
+        self._lock = threading.Lock()
+        self.requests = {} #path: number of requests
+        self.commands = [] #(station id, inverter serial number, mode) received
+        self._server = ThreadingHTTPServer(("127.0.0.1", port), self._handler())
+        self._server.daemon_threads = True
+        self._thread = None
+
+    @property
+    def url(self):
+        return "http://127.0.0.1:" + str(self._server.server_address[1])
+
+    @property
+    def newLoginUrl(self):
+        return self.url + NEW_LOGIN_PATH
+
+    @property
+    def oldLoginUrl(self):
+        return self.url + OLD_LOGIN_PATH
+
+    @property
+    def requestCount(self):
+        return sum(self.requests.values())
+
+    def start(self):
+        self._thread = threading.Thread(name="FakeSEMS", target=self._server.serve_forever, args=(_ShutdownPoll,), daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def expireTokens(self):
+        """let all issued tokens expire, the next data request answers TOKEN_EXPIRED"""
+        with self._lock:
+            for token in self._tokens:
+                self._tokens[token] = float("inf")
+
+    def stats(self):
+        with self._lock:
+            return {"requests": dict(self.requests), "tokens": len(self._tokens), "commands": len(self.commands)}
+
+    def _handler(self):
+        portal = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1" #keep-alive, like the real portal
+            disable_nagle_algorithm = True #headers and body are written separately
+
+            def log_message(self, format, *args):
+                pass
+
+            def do_GET(self):
+                if self.path == "/stats":
+                    self._reply(portal.stats())
+                else:
+                    self.send_error(404)
+
+            def do_POST(self):
+                body = self.rfile.read(int(self.headers.get("Content-Length") or 0)).decode("utf-8")
+                try:
+                    payload = json.loads(body) if body else {}
+                except json.decoder.JSONDecodeError:
+                    payload = {key: values[0] for key, values in parse_qs(body).items()}
+                if portal.latency:
+                    time.sleep(portal.latency)
+                response = portal._respond(self.path, payload, self.headers.get("token"))
+                if response is None:
+                    self.send_error(404)
+                else:
+                    self._reply(response)
+
+            def _reply(self, response):
+                data = json.dumps(response).encode("utf-8")
+                self.send_response(200)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+        return Handler
+
+    def _count(self, path):
+        with self._lock:
+            self.requests[path] = self.requests.get(path, 0) + 1
+
+    def _issueToken(self):
+        token = "fake-token-" + str(next(self._tokenNumbers))
+        with self._lock:
+            self._tokens[token] = 0
+        return {"uid": "fake-uid", "timestamp": int(time.time() * 1000), "token": token,
+                "client": "web", "version": "", "language": "en", "region": "local"}
+
+    def _checkToken(self, header):
+        """Return None when the token in the request header is valid, else the error code"""
+        try:
+            token = json.loads(header or "{}").get("token")
+        except (json.decoder.JSONDecodeError, AttributeError):
+            return TOKEN_INVALID
+        with self._lock:
+            if token not in self._tokens:
+                return TOKEN_INVALID
+            self._tokens[token] += 1
+            if self.tokenRequests and self._tokens[token] > self.tokenRequests:
+                return TOKEN_EXPIRED
+        return None
+
+    def _respond(self, path, payload, tokenHeader):
+        self._count(path)
+        if path == NEW_LOGIN_PATH:
+            if self.failLogin in ("new", "both"):
+                return {"code": LOGIN_FAILED, "msg": "Email or password error.", "data": None}
+            return {"code": "00000", "msg": "success", "data": self._issueToken(), "api": self.url + API_PATH}
+        if path.endswith("/Common/CrossLogin"):
+            if self.failLogin in ("legacy", "both"):
+                return {"code": LOGIN_FAILED, "msg": "Email or password error.", "data": None, "hasError": True}
+            return {"code": 0, "msg": "success", "data": self._issueToken(), "api": self.url + API_PATH, "hasError": False}
+        if path.endswith("/PowerStation/GetMonitorDetailByPowerstationId"):
+            error = self._checkToken(tokenHeader)
+            if error is not None:
+                return {"code": error, "msg": "The authorization has expired, please log in again.", "data": None}
+            station = self.stations.get(payload.get("powerStationId"))
+            if station is None:
+                return {"code": 1, "msg": "Power station not found", "data": None}
+            return {"code": 0, "msg": "success", "data": station.data(next(self._samples))}
+        if path.endswith("/HistoryData/QueryPowerStationByHistory"):
+            error = self._checkToken(tokenHeader)
+            if error is not None:
+                return {"code": error, "msg": "The authorization has expired, please log in again.", "data": None}
+            return {"code": 0, "msg": "success", "data": {"list": [{"id": station.id, "pw_name": "name " + station.id} for station in self.stations.values()]}}
+        if path.endswith("/PowerStationMonitor/GetInverterDataByColumn"):
+            error = self._checkToken(tokenHeader)
+            if error is not None:
+                return {"code": error, "msg": "The authorization has expired, please log in again.", "data": None}
+            return {"code": 0, "msg": "success", "data": {"column1": self._history(payload.get("column", ""), payload.get("date", ""))}}
+        if path.endswith("/PowerStation/SaveRemoteControlInverter"):
+            error = self._checkToken(tokenHeader)
+            if error is not None:
+                return {"code": error, "msg": "The authorization has expired, please log in again.", "data": None}
+            serialNumber = payload.get("InverterSN", payload.get("inverterSN"))
+            with self._lock:
+                self.commands.append((payload.get("powerStationId"), serialNumber, payload.get("InverterStatus")))
+            return {"code": 0, "msg": "success", "data": None}
+        return None
+
+    def _history(self, column, date):
+        """Return the points of a history column of a day, every 5 minutes, a constant string voltage and current"""
+        try:
+            day = time.mktime(time.strptime(date[:10], "%Y-%m-%d"))
+        except ValueError:
+            return []
+        value = HISTORY_VALUES.get(column.rstrip("0123456789"))
+        if value is None:
+            return []
+        return [{"date": time.strftime("%m/%d/%Y %H:%M:%S", time.localtime(day + minute * 60)), "column": value}
+                for minute in range(0, 24 * 60, 5)]
+
+def main():
+    parser = argparse.ArgumentParser(description="Local stand-in for the GoodWe SEMS portal")
+    parser.add_argument("--port", type=int, default=8080)
+    parser.add_argument("--stations", nargs="+", default=["fake-station:1:2"], help="id:inverters:strings")
+    parser.add_argument("--latency", type=float, default=0.0, help="seconds added to each response")
+    parser.add_argument("--fail-login", choices=("new", "legacy", "both"), help="login flows answering %d" % LOGIN_FAILED)
+    parser.add_argument("--token-requests", type=int, default=0, help="data requests per token before %d, 0 for no limit" % TOKEN_EXPIRED)
+    args = parser.parse_args()
+    portal = FakeSEMS([FakeStation.parse(station) for station in args.stations], args.latency, args.fail_login,
+                      args.token_requests, args.port)
+    print(portal.url, flush=True)
+    print("new login:", portal.newLoginUrl, "legacy login:", portal.oldLoginUrl, flush=True)
+    try:
+        portal._server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+if __name__ == "__main__":
+    main()
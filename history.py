@@ -0,0 +1,141 @@
+# Copyright 2021 Jan-Jaap Kostelijk
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is furnished
+# to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS
+# FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR
+# COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN
+# AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION
+# WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+
+# this module keeps the recent inverter snapshots in a fixed size file, used as a ring buffer.
+# The file is memory-mapped: a poll writes its records in place and a reader reads single records
+# by offset, without loading the file. After a restart the history of the previous run is available,
+# so diagnostics and filling of gaps can work from local data instead of requesting SEMS again.
+#
+# layout: header (magic, version, record size, capacity, next slot, record count), followed by
+# capacity records of: timestamp, serial number, status, 4x string voltage, current and power,
+# output power and total energy, all little endian.
+
+import collections
+import logging
+import mmap
+import os
+import struct
+import threading
+import time
+
+_Magic = b"GWSR"
+_Version = 1
+_Header = struct.Struct("<4sHHIII")
+_HeaderSize = 32
+_Strings = 4 #PV input strings per record, matches GoodWe._MaxStrings
+_Record = struct.Struct("<d24sb3x" + "d" * (3 * _Strings + 2)) #serial numbers are truncated to 24 bytes
+DefaultCapacity = 8192 #records, about 1.2 MB
+
+HistoryRecord = collections.namedtuple("HistoryRecord", ("timestamp", "sn", "status", "inputVoltage",
+                                                         "inputCurrent", "inputPower", "outputPower", "etotal"))
+
+class SnapshotRing:
+    """
+    A class to store inverter snapshots in a memory-mapped ring buffer file.
+    path: the file, created or resized when needed
+    capacity: number of records kept, older records are overwritten
+    """
+
+    def __init__(self, path, capacity=DefaultCapacity):
+        self.path = path
+        self.capacity = capacity
+        self._lock = threading.Lock()
+        self._file = None
+        self._map = None
+        self._next = 0
+        self._count = 0
+        self._open()
+
+    def __repr__(self):
+        return "SnapshotRing('" + self.path + "', records: " + str(self._count) + "/" + str(self.capacity) + ")"
+
+    def __len__(self):
+        return self._count
+
+    def _open(self):
+        size = _HeaderSize + self.capacity * _Record.size
+        exists = os.path.exists(self.path) and os.path.getsize(self.path) == size
+        self._file = open(self.path, "r+b" if exists else "w+b")
+        if not exists:
+            self._file.truncate(size)
+        self._map = mmap.mmap(self._file.fileno(), size)
+        magic, version, recordSize, capacity, nextSlot, count = _Header.unpack_from(self._map, 0)
+        if (magic, version, recordSize, capacity) == (_Magic, _Version, _Record.size, self.capacity) and count <= capacity:
+            self._next, self._count = nextSlot % capacity, count
+            logging.debug("snapshot history '%s' opened with %d records", self.path, count)
+        else:
+            self._next, self._count = 0, 0
+            self._writeHeader()
+            logging.info("snapshot history '%s' created for %d records", self.path, self.capacity)
+
+    def _writeHeader(self):
+        _Header.pack_into(self._map, 0, _Magic, _Version, _Record.size, self.capacity, self._next, self._count)
+
+    def close(self):
+        with self._lock:
+            if self._map is not None:
+                self._map.flush()
+                self._map.close()
+                self._file.close()
+                self._map = None
+
+    def append(self, snapshot, timestamp=None):
+        """store a GoodWe.InverterSnapshot, the header is updated after the record so readers never see a partial record"""
+        if timestamp is None:
+            timestamp = time.time()
+        values = [timestamp, snapshot.sn.encode("utf-8"), snapshot.status]
+        values.extend(snapshot.inputVoltage[:_Strings])
+        values.extend(snapshot.inputCurrent[:_Strings])
+        values.extend(snapshot.inputPower[:_Strings])
+        values.extend((snapshot.outputPower, snapshot.etotal))
+        with self._lock:
+            if self._map is None:
+                return
+            _Record.pack_into(self._map, _HeaderSize + self._next * _Record.size, *values)
+            self._next = (self._next + 1) % self.capacity
+            self._count = min(self._count + 1, self.capacity)
+            self._writeHeader()
+
+    def record(self, age):
+        """Return the record written age appends ago, 0 is the newest"""
+        if not 0 <= age < self._count:
+            raise IndexError("history record out of range")
+        with self._lock:
+            values = _Record.unpack_from(self._map, _HeaderSize + ((self._next - 1 - age) % self.capacity) * _Record.size)
+        s = 3
+        return HistoryRecord(values[0], values[1].rstrip(b"\0").decode("utf-8", "replace"), values[2],
+                             values[s:s + _Strings], values[s + _Strings:s + 2 * _Strings],
+                             values[s + 2 * _Strings:s + 3 * _Strings], values[-2], values[-1])
+
+    def records(self, since=None, sn=None):
+        """Return the records from new to old, down to timestamp since, only of inverter sn when given"""
+        for age in range(self._count):
+            record = self.record(age)
+            if since is not None and record.timestamp < since:
+                return
+            if sn is None or record.sn == sn:
+                yield record
+
+    def stringPower(self, sn, index, start, end):
+        """Return the power samples [(time, W)] of PV input string index (0 based) of inverter sn between start and end"""
+        samples = [(record.timestamp, record.inputPower[index]) for record in self.records(since=start, sn=sn)
+                   if record.timestamp <= end and record.inputPower[index] == record.inputPower[index]]
+        samples.reverse()
+        return samples
@@ -0,0 +1,191 @@
+# Copyright 2021 Jan-Jaap Kostelijk
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is furnished
+# to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS
+# FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR
+# COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN
+# AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION
+# WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+
+
+# this module reads a GoodWe inverter directly on the local network, as an alternative to the SEMS portal.
+# The inverter answers Modbus RTU read requests over UDP on port 8899, wrapped in an 'AA55' header.
+# The registers are mapped into the same InverterSnapshot as the SEMS data, so the units are updated alike.
+# Caveat: the register map below is the one of the three phase DT family (also D-NS/XS with address 0x7F).
+# Other families (ES/EM/ET) and some firmware versions use other registers or protocols, check the values
+# of a new model against SEMS before relying on them. fakeInverter.py simulates this map.
+
+import logging
+import socket
+import struct
+import time
+from GoodWe import InverterSnapshot
+import exceptions
+
+DefaultPort = 8899
+DefaultAddress = 0x7F #Modbus address of the DT family
+_ReadRegisters = 0x03 #Modbus function code
+_ResponseHeader = b"\xaa\x55"
+_Timeout = 1.0 #seconds to wait for an answer
+_Retries = 2 #extra attempts, UDP packets get lost on busy WiFi
+_MaxFrame = 512
+_Strings = 4 #PV inputs in the register map
+
+DeviceInfoRegister = 30001
+DeviceInfoCount = 40
+SerialNumberRegister = 30004 #8 registers, ASCII
+RunningDataRegister = 30100
+RunningDataCount = 73
+
+#field: register, number of 16 bit registers, divisor, signed
+REGISTER_MAP = (
+    ("vpv1", 30103, 1, 10, False),
+    ("ipv1", 30104, 1, 10, False),
+    ("vpv2", 30105, 1, 10, False),
+    ("ipv2", 30106, 1, 10, False),
+    ("vpv3", 30107, 1, 10, False),
+    ("ipv3", 30108, 1, 10, False),
+    ("vpv4", 30109, 1, 10, False),
+    ("ipv4", 30110, 1, 10, False),
+    ("vgrid1", 30118, 1, 10, False),
+    ("igrid1", 30121, 1, 10, False),
+    ("fgrid1", 30124, 1, 100, False),
+    ("power", 30127, 2, 1, True),
+    ("workMode", 30129, 1, 1, False),
+    ("temperature", 30141, 1, 10, True),
+    ("etotal", 30144, 2, 10, False),
+)
+_WorkModes = {0: 0, 1: 1, 2: 2, 4: 0} #inverter work mode: SEMS status (wait, normal, fault, check)
+
+def crc16(data):
+    """Return the Modbus CRC-16 of data"""
+    crc = 0xFFFF
+    for byte in data:
+        crc ^= byte
+        for _ in range(8):
+            crc = (crc >> 1) ^ 0xA001 if crc & 1 else crc >> 1
+    return crc
+
+def readRequest(address, register, count):
+    """Return the Modbus RTU frame reading count registers from register"""
+    frame = struct.pack(">BBHH", address, _ReadRegisters, register, count)
+    return frame + struct.pack("<H", crc16(frame))
+
+def readResponse(address, data):
+    """Return the answer to a read request: header, address, function, byte count, register data and CRC"""
+    frame = struct.pack(">BBB", address, _ReadRegisters, len(data)) + data
+    return _ResponseHeader + frame + struct.pack("<H", crc16(frame))
+
+def parseResponse(frame, address, count):
+    """Return the register data of an answer to a read request of count registers, None when it is not valid"""
+    if len(frame) != 7 + 2 * count or frame[:2] != _ResponseHeader:
+        return None
+    if frame[2] != address or frame[3] != _ReadRegisters or frame[4] != 2 * count:
+        return None
+    if struct.unpack("<H", frame[-2:])[0] != crc16(frame[2:-2]):
+        return None
+    return frame[5:-2]
+
+def decodeRegisters(data, firstRegister):
+    """Return the values of the register map from the register data read from firstRegister"""
+    values = {}
+    for field, register, words, divisor, signed in REGISTER_MAP:
+        offset = 2 * (register - firstRegister)
+        values[field] = int.from_bytes(data[offset:offset + 2 * words], "big", signed=signed) / divisor
+    return values
+
+class LocalInverter:
+    """
+    A class to read one inverter on the local network.
+    host, port: network address of the inverter
+    address: Modbus address of the inverter
+    """
+
+    def __init__(self, host, port=DefaultPort, address=DefaultAddress, timeout=_Timeout, retries=_Retries):
+        self.host = host
+        self.port = port
+        self.address = address
+        self.timeout = timeout
+        self.retries = retries
+        self.serialNumber = None #read from the inverter on first contact
+        self.numStrings = 0 #highest PV input that had a voltage, unused inputs read 0
+        self.lastSuccess = None #time.monotonic() of the last snapshot read
+        self._socket = None
+
+    def __repr__(self):
+        return "LocalInverter(" + self.host + ":" + str(self.port) + ", SN: " + str(self.serialNumber) + ")"
+
+    def isFresh(self, maxAge, now=None):
+        """True when a snapshot was read in the last maxAge seconds"""
+        if now is None:
+            now = time.monotonic()
+        return self.lastSuccess is not None and now - self.lastSuccess <= maxAge
+
+    def _connect(self):
+        if self._socket is None:
+            self._socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            self._socket.settimeout(self.timeout)
+            self._socket.connect((self.host, self.port))
+        return self._socket
+
+    def close(self):
+        if self._socket is not None:
+            self._socket.close()
+            self._socket = None
+
+    def readRegisters(self, register, count):
+        """Return the data of count registers, raises TransientFailure when the inverter does not answer"""
+        request = readRequest(self.address, register, count)
+        error = "no answer"
+        for attempt in range(1 + self.retries):
+            try:
+                sock = self._connect()
+                sock.send(request)
+                while True:
+                    #skip late answers to a request which timed out before
+                    data = parseResponse(sock.recv(_MaxFrame), self.address, count)
+                    if data is not None:
+                        return data
+            except socket.timeout:
+                logging.debug("inverter %s:%d did not answer the read of register %d, attempt %d", self.host, self.port, register, attempt + 1)
+            except OSError as exp:
+                error = str(exp)
+                self.close()
+        raise exceptions.TransientFailure("Failed to read inverter " + self.host + ": " + error)
+
+    def readSnapshot(self):
+        """Read the running data and return it as an InverterSnapshot"""
+        if self.serialNumber is None:
+            info = self.readRegisters(DeviceInfoRegister, DeviceInfoCount)
+            offset = 2 * (SerialNumberRegister - DeviceInfoRegister)
+            self.serialNumber = info[offset:offset + 16].decode("ascii", "replace").strip("\x00 ")
+            logging.info("local inverter %s:%d has serial number '%s'", self.host, self.port, self.serialNumber)
+        values = decodeRegisters(self.readRegisters(RunningDataRegister, RunningDataCount), RunningDataRegister)
+        for i in range(_Strings):
+            if values["vpv" + str(i + 1)] > 0:
+                self.numStrings = max(self.numStrings, i + 1)
+        inverterData = {
+            "sn": self.serialNumber,
+            "status": _WorkModes.get(int(values["workMode"]), -1),
+            "tempperature": values["temperature"],
+            "d": {"fac1": values["fgrid1"]},
+            "output_current": values["igrid1"],
+            "output_voltage": values["vgrid1"],
+            "output_power": values["power"],
+            "etotal": values["etotal"],
+        }
+        for i in range(self.numStrings):
+            inverterData["pv_input_" + str(i + 1)] = "%.1fV/%.1fA" % (values["vpv" + str(i + 1)], values["ipv" + str(i + 1)])
+        self.lastSuccess = time.monotonic()
+        return InverterSnapshot(inverterData)
@@ -183,9 +183,67 @@ def test_calculate_new_energy(plugin_module):
         "sn_energy", plugin_module._plugin.inputPower1Unit, 20.0
     )
     assert abs(new_counter - 115.0) < 0.5, f"Expected about 115.0, got {new_counter}"
+
+    # later samples come from memory, the values on display are not parsed again
+    unit.sValue = "garbage"
+    unit.LastUpdate = ""
+    new_counter = plugin_module.calculateNewEnergy(
+        "sn_energy", plugin_module._plugin.inputPower1Unit, 20.0
+    )
+    assert abs(new_counter - 115.0) < 0.5, f"Expected about 115.0, got {new_counter}"
+
+    plugin_module.saveEnergyCheckpoints()
+    checkpoints = fakeDomoticz_module.configuration_store.get("energy checkpoints")
+    key = plugin_module.energyKey("sn_energy", plugin_module._plugin.inputPower1Unit)
+    assert checkpoints is not None and key in checkpoints, "Energy checkpoint should be stored"
+    assert abs(checkpoints[key][1] - new_counter) < 0.01, "Checkpoint should hold the energy counter"
     print("test_calculate_new_energy passed")
 
 
+def test_energy_backfill(plugin_module):
+    print("\nRunning test_energy_backfill()")
+    plugin_module.Devices = {"sn_gap": FakeDevice("sn_gap")}
+    plugin = plugin_module._plugin
+    unit = FakeUnit("Input Power 1", "sn_gap", plugin.inputPower1Unit)
+    unit.sValue = "100;1000"
+    unit.LastUpdate = (datetime.now() - timedelta(hours=2)).strftime("%Y-%m-%d %H:%M:%S")
+    plugin_module.Devices["sn_gap"].Units[plugin.inputPower1Unit] = unit
+
+    new_counter = plugin_module.calculateNewEnergy("sn_gap", plugin.inputPower1Unit, 300.0, maxGap=900)
+    assert abs(new_counter - 1000.0) < 0.01, "A gap should not be integrated"
+    gaps = plugin_module.takeEnergyGaps()
+    assert len(gaps) == 1 and abs(gaps[0].end - gaps[0].start - 7200) < 5, f"Unexpected gaps: {gaps}"
+
+    class HistoryAccount:
+        def stringPowerHistory(self, serialNumber, index, start, end, stopEvent=None):
+            return [(start + 3600, 500.0)]
+    plugin.inverterAccounts["sn_gap"] = HistoryAccount()
+    plugin.backfill(gaps)
+    plugin.applyBackfills()
+    assert abs(float(unit.sValue.split(";")[1]) - 1700.0) < 1, f"Backfilled counter should be about 1700 Wh, got {unit.sValue}"
+
+    import tempfile
+    from GoodWe import InverterSnapshot
+    from history import SnapshotRing
+    class UnusedAccount:
+        def stringPowerHistory(self, serialNumber, index, start, end, stopEvent=None):
+            raise AssertionError("SEMS should not be asked for a gap covered by the snapshot history")
+    plugin.inverterAccounts["sn_gap"] = UnusedAccount()
+    plugin.maxEnergyGap = 900
+    with tempfile.TemporaryDirectory() as folder:
+        plugin.history = SnapshotRing(plugin_module.os.path.join(folder, "history.ring"), capacity=64)
+        try:
+            for minutes in range(10, 120, 10):
+                plugin.history.append(InverterSnapshot({"sn": "sn_gap", "status": 1, "pv_input_1": "250V/2A"}), gaps[0].start + minutes * 60)
+            plugin.backfill(gaps)
+            plugin.applyBackfills()
+        finally:
+            plugin.history.close()
+            plugin.history = None
+    assert abs(float(unit.sValue.split(";")[1]) - 2650.0) < 1, f"Counter backfilled from the snapshot history should be about 2650 Wh, got {unit.sValue}"
+    print("test_energy_backfill passed")
+
+
 def test_create_devices(plugin_module):
     print("\nRunning test_create_devices()")
     plugin_module.Devices = {}
@@ -195,9 +253,231 @@ def test_create_devices(plugin_module):
     assert plugin_module._plugin.inverterTemperatureUnit in created_units, "Temperature unit must be created"
     assert plugin_module._plugin.outputPowerUnit in created_units, "Output power unit must be created"
     print(f"Created {len(created_units)} units for serial sn_device")
+
+    del created_units[plugin_module._plugin.inverterTemperatureUnit]
+    plugin_module._plugin.createDevices("sn_device")
+    assert plugin_module._plugin.inverterTemperatureUnit not in created_units, "Units should only be checked once per serial"
+    plugin_module._energyIntegrators[("sn_device", plugin_module._plugin.inputPower1Unit)] = plugin_module.energy.EnergyIntegrator()
+    plugin_module._plugin.onDeviceRemoved("sn_device", plugin_module._plugin.inverterTemperatureUnit)
+    assert not any(key[0] == "sn_device" for key in plugin_module._energyIntegrators), "Energy integrators of a removed device should be dropped"
+    plugin_module._plugin.createDevices("sn_device")
+    assert plugin_module._plugin.inverterTemperatureUnit in created_units, "Removed unit should be created again"
     print("test_create_devices passed")
 
 
+def test_parse_station_ids(plugin_module):
+    print("\nRunning test_parse_station_ids()")
+    station_ids = plugin_module.parseStationIds(" id-1; id-2 ,id-1;; ")
+    assert station_ids == ["id-1", "id-2"], f"Unexpected station IDs: {station_ids}"
+    assert plugin_module.parseStationIds("") == [], "Empty parameter should give no stations"
+    print("test_parse_station_ids passed")
+
+
+def test_parse_accounts(plugin_module):
+    print("\nRunning test_parse_accounts()")
+    accounts = plugin_module.parseAccounts("a@example.com", "pass;word", "id-1|id-2")
+    assert accounts == [("a@example.com", "pass;word", ["id-1", "id-2"])], f"Unexpected single account: {accounts}"
+    accounts = plugin_module.parseAccounts("a@example.com; b@example.com", "pwd-a;pwd-b", "id-1;id-2 | id-3;id-1")
+    assert accounts == [("a@example.com", "pwd-a", ["id-1", "id-2"]), ("b@example.com", "pwd-b", ["id-3"])], f"Unexpected accounts: {accounts}"
+    accounts = plugin_module.parseAccounts("a@example.com;b@example.com", "pwd-a;pwd-b", "")
+    assert [stationIds for username, password, stationIds in accounts] == [[], []], "Without IDs the stations should be discovered"
+    for usernames, passwords, stations in (("a;b", "pwd", "id-1|id-2"), ("a;b", "pwd-a;pwd-b", "id-1;id-2"), ("", "pwd", "id-1")):
+        try:
+            plugin_module.parseAccounts(usernames, passwords, stations)
+        except ValueError:
+            continue
+        raise AssertionError(f"Invalid accounts should be rejected: {usernames}, {stations}")
+    print("test_parse_accounts passed")
+
+
+def test_discover_stations(plugin_module):
+    print("\nRunning test_discover_stations()")
+    fakeDomoticz_module.configuration_store.clear()
+    plugin = plugin_module._plugin
+    listRequests = []
+
+    class DiscoveringAccount:
+        Username = "owner@example.com"
+        stationIds = []
+        def discoverStations(self):
+            listRequests.append(1)
+            return ["st-1", "st-2"]
+    account = DiscoveringAccount()
+    plugin.accounts = [account]
+    plugin.discoveries = {}
+    plugin.restoreDiscoveries()
+    plugin.discoverStations(account)
+    plugin.discoverStations(account)
+    assert account.stationIds == ["st-1", "st-2"] and len(listRequests) == 1, "Station list should be requested once"
+    plugin.persistDiscoveries()
+    cached = fakeDomoticz_module.configuration_store["discovered stations"][account.Username]
+    assert cached["stations"] == ["st-1", "st-2"], f"Unexpected cached stations: {cached}"
+
+    plugin.staleDiscoveries.add(account.Username)
+    plugin.discoverStations(account)
+    assert len(listRequests) == 1, "A stale station list should not be requested again within the min interval"
+    plugin.discoveries[account.Username] = (time.time() - plugin_module._MinDiscoveryInterval, ["st-1"])
+    plugin.discoverStations(account)
+    assert len(listRequests) == 2 and account.Username not in plugin.staleDiscoveries, "A stale station list should be requested again"
+
+    restarted = DiscoveringAccount()
+    restarted.stationIds = []
+    plugin.accounts = [restarted]
+    plugin.discoveries = {}
+    plugin.restoreDiscoveries()
+    assert restarted.stationIds == ["st-1", "st-2"], "Cached stations should be used after a restart"
+    plugin.discoverStations(restarted)
+    assert len(listRequests) == 2, "Cached stations should not be requested again"
+    plugin.accounts, plugin.discoveries = [], {}
+    print("test_discover_stations passed")
+
+
+def test_circuit_per_poll(plugin_module):
+    print("\nRunning test_circuit_per_poll()")
+    from concurrent.futures import Future
+    from breaker import CircuitBreaker, CLOSED, OPEN, HALF_OPEN
+    plugin = plugin_module._plugin
+    exceptions = plugin_module.exceptions
+
+    class FailingAccount:
+        tokenAvailable = True
+        def __init__(self, Username, stationIds, breaker):
+            self.Username, self.stationIds, self.breaker = Username, stationIds, breaker
+        def stationDataRequestV2(self, stationId):
+            raise exceptions.TransientFailure("SEMS down")
+        def timedTokenRequest(self):
+            raise exceptions.AuthenticationFailure("invalid password or username")
+
+    class InlineExecutor:
+        def submit(self, task, *args):
+            future = Future()
+            try:
+                future.set_result(task(*args))
+            except Exception as exp:
+                future.set_exception(exp)
+            return future
+
+    savedExecutor, savedPoller = plugin.stationExecutor, plugin.poller
+    plugin.stationExecutor, plugin.poller = InlineExecutor(), plugin_module.Poller()
+    try:
+        account = FailingAccount("down@example.com", ["st-1", "st-2", "st-3", "st-4"], CircuitBreaker(failureThreshold=3))
+        plugin.requestStations([account])
+        assert account.breaker.state == CLOSED, "Failing stations of one poll should count as one failure"
+        plugin.requestStations([account])
+        plugin.requestStations([account])
+        assert account.breaker.state == OPEN, "The circuit should open after 3 failed polls"
+
+        idle = FailingAccount("idle@example.com", [], CircuitBreaker(failureThreshold=1, baseDelay=0))
+        idle.breaker.recordFailure()
+        assert idle.breaker.allowRequest() and idle.breaker.state == HALF_OPEN
+        plugin.requestStations([idle])
+        assert idle.breaker.state == OPEN and idle.breaker.allowRequest(), "An unused probe should let the next poll try again"
+
+        idle.tokenAvailable = False
+        plugin.requestStations([idle])
+        assert idle.breaker.state == OPEN, "A failed login should reopen the circuit"
+    finally:
+        plugin.stationExecutor, plugin.poller = savedExecutor, savedPoller
+    print("test_circuit_per_poll passed")
+
+
+def test_inverter_command(plugin_module):
+    print("\nRunning test_inverter_command()")
+    plugin = plugin_module._plugin
+    unit_number = plugin.inverterStateCommand
+    plugin_module.Devices = {"sn_cmd": FakeDevice("sn_cmd")}
+    plugin_module.Devices["sn_cmd"].Units[unit_number] = FakeUnit("Inverter state control", "sn_cmd", unit_number)
+    sent = []
+
+    class ControlledAccount:
+        def changeInverterStatus(self, stationId, inverterSn, mode):
+            sent.append((stationId, inverterSn, mode))
+
+    class InlineExecutor:
+        def submit(self, task, *args):
+            task(*args)
+
+    plugin.inverterAccounts["sn_cmd"] = ControlledAccount()
+    plugin.inverterStations["sn_cmd"] = "st-cmd"
+    plugin.stationExecutor = InlineExecutor()
+    plugin.commands = plugin_module.CommandQueue()
+    plugin.onCommand("sn_cmd", unit_number, "Set Level", 40, None)
+    plugin.onCommand("sn_cmd", unit_number, "Set Level", 20, None)
+    plugin.onCommand("sn_cmd", unit_number, "Set Level", 30, None)
+    assert sent == [] and len(plugin.commands) == 1, "onCommand should only queue the command"
+    assert plugin_module.Devices["sn_cmd"].Units[unit_number].sValue == "20", "Selector should show the requested level"
+
+    plugin.sendCommands()
+    plugin.sendCommands()
+    assert sent == [("st-cmd", "sn_cmd", 2)], f"Only the last command should be sent once: {sent}"
+    plugin.applyCommandResults()
+    assert plugin.runAgain == 1 and "sn_cmd" in plugin.sentCommands, "An accepted command should be confirmed by a poll"
+    plugin.confirmCommand("sn_cmd", "generating", time.monotonic() - 60)
+    assert "sn_cmd" in plugin.sentCommands, "A poll started before the command should not confirm it"
+    plugin.confirmCommand("sn_cmd", "generating", time.monotonic())
+    assert "sn_cmd" in plugin.sentCommands, "A state not matching the command should not confirm it"
+    plugin.confirmCommand("sn_cmd", "waiting", time.monotonic())
+    assert "sn_cmd" not in plugin.sentCommands, "The waiting state should confirm the command"
+    plugin.stationExecutor = None
+    print("test_inverter_command passed")
+
+
+def test_local_inverters(plugin_module):
+    print("\nRunning test_local_inverters()")
+    addresses = plugin_module.parseLocalAddresses("5000;2500.0 ; 192.168.1.20; inverter.lan:8898; 192.168.1.300; -bad.lan;")
+    assert addresses == [("192.168.1.20", 8899), ("inverter.lan", 8898)], f"Unexpected local addresses: {addresses}"
+
+    class ReadInverter:
+        serialNumber = "sn_local"
+        def isFresh(self, maxAge):
+            return True
+    plugin = plugin_module._plugin
+    plugin.localInverters = [ReadInverter()]
+    plugin.inverterStations = {"sn_local": "st-local"}
+    assert not plugin.semsNeeded(), "SEMS should not be polled when all inverters are read locally"
+    plugin.inverterStations["sn_sems"] = "st-local"
+    assert plugin.semsNeeded(), "SEMS should be polled for an inverter not read locally"
+
+    updated = []
+    original = plugin.updateInverter
+    plugin.updateInverter = lambda snapshot, polledAt=None: updated.append(snapshot.sn)
+    from GoodWe import PowerStation
+    station = PowerStation(stationData={
+        "info": {"powerstation_id": "st-local", "stationname": "local", "address": "", "status": 1},
+        "inverter": [{"sn": "sn_local", "name": "local", "status": 1}, {"sn": "sn_sems", "name": "sems", "status": 1}]})
+    plugin.updateDevices(station)
+    plugin.updateInverter = original
+    plugin.localInverters, plugin.inverterStations = [], {}
+    assert updated == ["sn_sems"], f"SEMS data of a locally read inverter should be skipped: {updated}"
+    print("test_local_inverters passed")
+
+
+def test_publish_metrics(plugin_module):
+    print("\nRunning test_publish_metrics()")
+    import tempfile
+    plugin_module.Devices = {}
+    plugin = plugin_module._plugin
+    plugin.accounts = [plugin_module.GoodWeSEMSPlus("eu.semsportal.com", "443", "test@example.com", "password")]
+    plugin.metrics.record("fetch", 0.120)
+    plugin.metricsMode = "Both"
+    plugin.lastMetrics = 0
+    homeFolder = plugin_module.Parameters.get("HomeFolder")
+    with tempfile.TemporaryDirectory() as folder:
+        plugin_module.Parameters["HomeFolder"] = folder
+        try:
+            plugin.publishMetrics()
+            units = plugin_module.Devices[plugin_module._MetricsDevice].Units
+            fetch_unit = units[plugin_module.PHASES.index("fetch") + 1]
+            assert fetch_unit.sValue == "120.0", f"Unexpected fetch p95: {fetch_unit.sValue}"
+            metrics_file = plugin_module.os.path.join(folder, plugin_module._MetricsFile)
+            with open(metrics_file) as f:
+                assert 'phase="fetch"' in f.read(), "Metrics file should contain the fetch phase"
+        finally:
+            plugin_module.Parameters["HomeFolder"] = homeFolder
+            plugin.metricsMode = "No"
+    print("test_publish_metrics passed")
+
+
 def test_check_version(plugin_module):
     print("\nRunning test_check_version()")
     fakeDomoticz_module.configuration_store.clear()
@@ -221,7 +501,15 @@ def main():
     tests = [
         test_update_device,
         test_calculate_new_energy,
+        test_energy_backfill,
         test_create_devices,
+        test_parse_station_ids,
+        test_parse_accounts,
+        test_discover_stations,
+        test_circuit_per_poll,
+        test_inverter_command,
+        test_local_inverters,
+        test_publish_metrics,
         test_check_version,
     ]
 
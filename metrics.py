@@ -0,0 +1,140 @@
+# Copyright 2021 Jan-Jaap Kostelijk
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is furnished
+# to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS
+# FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR
+# COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN
+# AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION
+# WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+
+# this module measures how long the phases of a poll take: login, HTTP fetch, JSON decode,
+# parsing of the station data, unit creation, unit updates and reads on the local network. The last durations of each
+# phase are kept to report rolling percentiles, published as Domoticz custom units and/or
+# as a Prometheus text file which the node exporter textfile collector can scrape.
+
+import collections
+import math
+import os
+import threading
+import time
+
+PHASES = ("login", "fetch", "decode", "parse", "poll", "create", "update", "local")
+_Window = 100 #number of durations per phase the percentiles are calculated on
+
+def percentile(ordered, fraction):
+    """Return the nearest rank percentile of a sorted list"""
+    if not ordered:
+        return 0.0
+    return ordered[min(len(ordered) - 1, max(0, math.ceil(fraction * len(ordered)) - 1))]
+
+class PhaseStats:
+    """
+    A class to summarize the recent durations of one phase, in seconds:
+    count and total are over all durations, p50, p95 and max over the last durations
+    """
+    __slots__ = ("count", "total", "p50", "p95", "max")
+
+    def __init__(self, count, total, durations):
+        ordered = sorted(durations)
+        self.count = count
+        self.total = total
+        self.p50 = percentile(ordered, 0.5)
+        self.p95 = percentile(ordered, 0.95)
+        self.max = ordered[-1] if ordered else 0.0
+
+    def __repr__(self):
+        return "PhaseStats(count: {}, p50: {:.1f} ms, p95: {:.1f} ms, max: {:.1f} ms)".format(
+            self.count, self.p50 * 1000, self.p95 * 1000, self.max * 1000)
+
+class _Timer:
+    __slots__ = ("_metrics", "_phase", "_start")
+
+    def __init__(self, metrics, phase):
+        self._metrics = metrics
+        self._phase = phase
+
+    def __enter__(self):
+        self._start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self._metrics.record(self._phase, time.perf_counter() - self._start)
+        return False
+
+class Metrics:
+    """
+    A class to collect the durations of the poll phases, safe to use from the poller and the Domoticz thread.
+    Use record(phase, seconds) with time.perf_counter() in hot paths, or 'with metrics.timed(phase):'.
+    """
+
+    def __init__(self, window=_Window):
+        self._lock = threading.Lock()
+        self._window = window
+        self._durations = {phase: collections.deque(maxlen=window) for phase in PHASES}
+        self._counts = dict.fromkeys(PHASES, 0)
+        self._totals = dict.fromkeys(PHASES, 0.0)
+
+    def record(self, phase, seconds):
+        with self._lock:
+            durations = self._durations.get(phase)
+            if durations is None:
+                durations = self._durations[phase] = collections.deque(maxlen=self._window)
+                self._counts[phase] = 0
+                self._totals[phase] = 0.0
+            durations.append(seconds)
+            self._counts[phase] += 1
+            self._totals[phase] += seconds
+
+    def timed(self, phase):
+        return _Timer(self, phase)
+
+    def summary(self):
+        """Return the PhaseStats of each phase with at least one duration"""
+        with self._lock:
+            recent = {phase: (self._counts[phase], self._totals[phase], list(durations))
+                      for phase, durations in self._durations.items() if durations}
+        return {phase: PhaseStats(*values) for phase, values in recent.items()}
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+def prometheusText(summary, counters, hardware):
+    """
+    Return the metrics in the Prometheus text exposition format.
+    counters: name: (type, help, value) of additional metrics, for example unit writes
+    """
+    label = 'hardware="' + _escape(hardware) + '"'
+    lines = ["# HELP goodwe_phase_seconds Duration of the phases of a SEMS poll, over the last polls",
+             "# TYPE goodwe_phase_seconds summary"]
+    for phase, stats in summary.items():
+        phaseLabel = label + ',phase="' + phase + '"'
+        lines.append('goodwe_phase_seconds{%s,quantile="0.5"} %.6f' % (phaseLabel, stats.p50))
+        lines.append('goodwe_phase_seconds{%s,quantile="0.95"} %.6f' % (phaseLabel, stats.p95))
+        lines.append('goodwe_phase_seconds_sum{%s} %.6f' % (phaseLabel, stats.total))
+        lines.append('goodwe_phase_seconds_count{%s} %d' % (phaseLabel, stats.count))
+    lines += ["# HELP goodwe_phase_max_seconds Longest duration of a phase, over the last polls",
+              "# TYPE goodwe_phase_max_seconds gauge"]
+    for phase, stats in summary.items():
+        lines.append('goodwe_phase_max_seconds{%s,phase="%s"} %.6f' % (label, phase, stats.max))
+    for name, (metricType, description, value) in counters.items():
+        lines += ["# HELP " + name + " " + description, "# TYPE " + name + " " + metricType,
+                  "%s{%s} %s" % (name, label, value)]
+    return "\n".join(lines) + "\n"
+
+def writeAtomic(path, text):
+    """write a file through a temporary file, so a scraper never reads a half written file"""
+    temporary = path + ".tmp"
+    with open(temporary, "w") as f:
+        f.write(text)
+    os.replace(temporary, path)
@@ -35,9 +35,9 @@
                     <li>Go to the plant status page for the station you want to add to Domoticz</li>
                     <li>Get the station ID from the URL, this is the sequence of characters after: https://www.semsportal.com/PowerStation/PowerStatusSnMin/, in the pattern:
                     (8 char)-(4 char)-(4 char)-(4 char)-(12 char), also known as a UUID </li>
-                    <li>Add the power station ID to the hardware configuration (mandatory)</li>
+                    <li>Add the power station ID to the hardware configuration. Multiple stations can be added separated by ';'</li>
                 </ol>
-                <li>Not possible at this moment: If you want all of your stations added to Domoticz you only have to enter your login information below</li>
+                <li>If you want all of your stations added to Domoticz you only have to enter your login information below and leave the power station ID empty</li>
             </ol>
         </ul>
     </description>
@@ -50,9 +50,15 @@
             </options>
         </param>
         <param field="Port" label="SEMS API Port" width="30px" required="true" default="443"/>
-        <param field="Username" label="E-Mail address" width="300px" required="true"/>
-        <param field="Password" label="Password" width="100px" required="true" password="true"/>
-        <param field="Mode1" label="Power Station ID (mandatory)" width="300px"/>
+        <param field="Username" label="E-Mail address(es)" width="300px" required="true">
+            <description>One or more SEMS accounts, separated by ';'</description>
+        </param>
+        <param field="Password" label="Password(s)" width="100px" required="true" password="true">
+            <description>With several accounts: the passwords in the same order, separated by ';'</description>
+        </param>
+        <param field="Mode1" label="Power Station ID(s)" width="300px">
+            <description>Optional: one or more power station IDs, separated by ';'. With several accounts the stations of each account are separated by '|', in the order of the accounts. Without IDs all stations of the account are polled</description>
+        </param>
         <param field="Mode2" label="Refresh interval" width="75px">
             <options>
                 <option label="10s" value="1"/>
@@ -64,8 +70,8 @@
                 <option label="30m" value="180"/>
             </options>
         </param>
-        <param field="Mode3" label="Peak power [W]" width="300px">
-            <description>Optional: Peak power, supply values (separated by ';'): total power; power per string</description>
+        <param field="Mode3" label="Local inverter address(es)" width="300px">
+            <description>Optional: IP addresses of inverters on the local network (separated by ';', add ':port' when not 8899). They are read every 10 seconds over UDP, SEMS is only used for inverters which do not answer</description>
         </param>
         <param field="Mode4" label="use SEMS + API" width="75px">
             <options>
@@ -73,6 +79,15 @@
                 <option label="Yes" value="Yes" default="true"/>
             </options>
         </param>
+        <param field="Mode5" label="Performance metrics" width="75px">
+            <description>Optional: publish the duration of the poll phases as Domoticz units and/or as the Prometheus text file goodwe_metrics.prom in the plugin folder</description>
+            <options>
+                <option label="No" value="No" default="true"/>
+                <option label="Devices" value="Devices"/>
+                <option label="File" value="File"/>
+                <option label="Both" value="Both"/>
+            </options>
+        </param>
         <param field="Mode6" label="Log level" width="75px">
             <options>
                 <option label="Verbose" value="Verbose"/>
@@ -83,7 +98,6 @@
     </params>
 </plugin>
 """
-import json
 #import Domoticz
 try:
 	import DomoticzEx as Domoticz
@@ -94,244 +108,548 @@ except ImportError:
     Domoticz = Domoticz()
     debug = True
 import os
-import sys, time
-from datetime import datetime, timedelta
-from GoodWe import GoodWe, GoodWeSEMSPlus
+import re
+import ipaddress
+import time
+import math
+import queue
+from concurrent.futures import ThreadPoolExecutor
+from GoodWe import GoodWe, GoodWeSEMSPlus, createSession
+from poller import Poller
+from deviceupdate import UpdateCache, ExactPolicy
+from units import UNITS, unitNumbers, compileUpdates, energyStrings
+import energy
+from scheduler import PollScheduler
+from metrics import Metrics, PHASES, prometheusText, writeAtomic
+from history import SnapshotRing
+from commands import CommandQueue
+from localinverter import LocalInverter, DefaultPort
 import exceptions
 import logging
 
+_MaxStationWorkers = 4 #max stations requested in parallel, matches the HTTP connection pool per host
+_HostsPerAccount = 2 #login and API host of an account, kept in the shared HTTP connection pool
+_CheckpointInterval = 15 * 60 #seconds between storing the energy counters in the plugin configuration
+_HeartbeatInterval = 10 #seconds, Domoticz default heartbeat
+_MetricsInterval = 60 #seconds between publishing the performance metrics
+_MetricsDevice = "GoodWe metrics" #DeviceID of the performance metrics units
+_MetricsFile = "goodwe_metrics.prom"
+_HistoryFile = "goodwe_history_%s.ring" #per hardware ID, in the plugin folder
+_MinEnergyGap = 15 * 60 #seconds, a longer period without power samples is filled from the SEMS history
+_DiscoveryTTL = 24 * 3600 #seconds the discovered stations of an account are used before the station list is requested again
+_MinDiscoveryInterval = 15 * 60 #seconds, min time between two station list requests of an account
+_CommandModes = {1: "reboot", 2: "waiting/off", 4: "restart"} #InverterStatus of SaveRemoteControlInverter by selector level / 10
+_ExpectedStates = {2: ("waiting", "offline")} #inverter states confirming a command, other commands are confirmed by any state
+_ConfirmTimeout = 15 * 60 #seconds after which a command not confirmed by the inverter state is reported
+_LocalFreshness = 60 #seconds a reading on the local network replaces the SEMS data of an inverter
+_HostLabel = re.compile(r"^[A-Za-z0-9]([A-Za-z0-9-]{0,61}[A-Za-z0-9])?$") #one label of a hostname
+
 class GoodWeSEMSPlugin:
     httpConn = None
     runAgain = 6
     devicesUpdated = False
-    goodWeAccount = None
+    session = None
+    poller = None
+    localPoller = None
+    stationExecutor = None
+    scheduler = None
+    lastCheckpoint = 0
+    metrics = None
+    metricsMode = "No"
+    lastMetrics = 0
+    history = None
+    maxEnergyGap = None
     logger = None    
     
     baseDeviceIndex = 0
     maxDeviceIndex = 0
 
     def __init__(self):
-        startNum = 0
-        self.inverterTemperatureUnit = 1 + startNum
-        self.inverterStateUnit = 9 + startNum
-        self.outputCurrentUnit = 2 + startNum
-        self.outputVoltageUnit = 3 + startNum
-        self.outputPowerUnit = 4 + startNum
-        self.inputVoltage1Unit = 5 + startNum
-        self.inputAmps1Unit = 6 + startNum
-        self.inputPower1Unit = 14 + startNum
-        self.inputPower2Unit = 15 + startNum
-        self.inputPower3Unit = 16 + startNum
-        self.inputPower4Unit = 17 + startNum
-        self.inputVoltage2Unit = 7 + startNum
-        self.inputVoltage3Unit = 10 + startNum
-        self.inputVoltage4Unit = 12 + startNum
-        self.inputAmps2Unit = 8 + startNum
-        self.inputAmps3Unit = 11 + startNum
-        self.inputAmps4Unit = 13 + startNum
-        self.outputFreq1Unit = 18 + startNum
-        self.inverterStateCommand = 19 + startNum
+        for key, unit in unitNumbers().items():
+            setattr(self, key, unit)
+        self.unitUpdates = compileUpdates()
+        self.createdDevices = set()
+        self.inverterStates = {}
+        self.accounts = [] #GoodWe accounts, each with its own token and station IDs
+        self.inverterAccounts = {} #inverter serial number: account of its station
+        self.inverterStations = {} #inverter serial number: power station ID
+        self.commands = CommandQueue()
+        self.commandResults = queue.Queue() #(InverterCommand, exception or None) of sent commands
+        self.sentCommands = {} #inverter serial number: (InverterCommand, time accepted by SEMS) until confirmed by a poll
+        self.lastPollStart = None
+        self.localInverters = [] #LocalInverter read directly, SEMS is the fallback for these
+        self.persistedTokens = {} #account: timestamp of the token stored in the plugin configuration
+        self.discoveries = {} #account without configured station IDs: (time of the station list, station IDs)
+        self.persistedDiscoveries = {}
+        self.staleDiscoveries = set() #accounts of which a discovered station ID stopped resolving
+        self.metrics = Metrics()
+        self.energyStrings = energyStrings()
+        self.backfills = queue.Queue() #(DeviceID, Unit, energy in Wh) of finished backfills
         self.enabled = False
         return
 
-    def establishToken(self):
-        logging.debug("establishToken, token availability: '" + str(self.goodWeAccount.tokenAvailable)+ "'")
-        if not self.goodWeAccount.tokenAvailable:
-            self.goodWeAccount.powerStationList = {}
-            self.goodWeAccount.powerStationIndex = 0
+    def establishToken(self, account):
+        logging.debug("establishToken for account '%s', token availability: '%s'", account.Username, account.tokenAvailable)
+        if not account.tokenAvailable:
+            account.powerStationList = {}
+            account.powerStationIndex = 0
             self.devicesUpdated = False
             try:
-                self.goodWeAccount.tokenRequest()
-                return True
-            except (exceptions.GoodweException, exceptions.FailureWithMessage, exceptions.FailureWithoutMessage) as exp:
-                logging.error("Failed to request data: " + str(exp))
+                account.timedTokenRequest()
+            except exceptions.GoodweException as exp:
+                logging.error("Failed to request data: %s", exp)
                 Domoticz.Error("Failed to request data: " + str(exp))
                 return False
-        else:
-            return True
+        return account.tokenAvailable
+
+    def restoreToken(self):
+        """reuse the tokens of a previous run, so a restart does not need a new login"""
+        tokenStates = getConfigItem("SEMS tokens", {})
+        for account in self.accounts:
+            if account.importToken(tokenStates.get(account.Username)):
+                self.persistedTokens[account.Username] = account.tokenTimestamp
 
-    def getDeviceData(self):            
-        if self.goodWeAccount.tokenAvailable:
+    def persistToken(self):
+        """store newly received tokens in the plugin configuration, runs on the Domoticz thread"""
+        tokenStates = {}
+        for account in self.accounts:
+            tokenState = account.exportToken()
+            if tokenState is not None:
+                tokenStates[account.Username] = tokenState
+        if all(self.persistedTokens.get(user) == tokenState["timestamp"] for user, tokenState in tokenStates.items()):
+            return
+        setConfigItem(Key="SEMS tokens", Value=tokenStates)
+        self.persistedTokens = {user: tokenState["timestamp"] for user, tokenState in tokenStates.items()}
+        logging.debug("%d SEMS tokens stored in plugin configuration", len(tokenStates))
+
+    def discoverStations(self, account):
+        """request the station list of an account without configured station IDs when it expired, runs on the poller thread"""
+        discoveredAt, stationIds = self.discoveries[account.Username]
+        age = time.time() - discoveredAt
+        if age < _DiscoveryTTL and not (account.Username in self.staleDiscoveries and age >= _MinDiscoveryInterval):
+            return
+        self.staleDiscoveries.discard(account.Username)
+        try:
+            stationIds = account.discoverStations()
+        except (exceptions.AuthenticationFailure, exceptions.TransientFailure, exceptions.PermanentFailure) as exp:
+            logging.error("Failed to discover the power stations of account '%s': %s", account.Username, exp)
+            Domoticz.Error("Failed to discover the power stations of account '" + account.Username + "': " + str(exp))
+            #keep the previous stations and try again after the min interval
+            self.discoveries[account.Username] = (time.time() - _DiscoveryTTL + _MinDiscoveryInterval, stationIds)
+            return
+        if len(stationIds) == 0:
+            logging.error("No power station found for account '%s'", account.Username)
+            Domoticz.Error("No power station found for account '" + account.Username + "'")
+        #a station shared with another account is polled once
+        polledByOthers = {stationId for other in self.accounts if other is not account for stationId in other.stationIds}
+        stationIds = [stationId for stationId in stationIds if stationId not in polledByOthers]
+        logging.info("Discovered %d power station(s) of account '%s' not polled for another account: %s", len(stationIds), account.Username, ", ".join(stationIds))
+        self.discoveries[account.Username] = (time.time(), stationIds)
+        account.stationIds = stationIds
+
+    def restoreDiscoveries(self):
+        """use the stations discovered in a previous run for the accounts without configured station IDs"""
+        cached = getConfigItem("discovered stations", {})
+        for account in self.accounts:
+            if len(account.stationIds) > 0:
+                continue
+            entry = cached.get(account.Username)
             try:
-                DeviceData = self.goodWeAccount.stationDataRequestV2(Parameters["Mode1"])
-            except (exceptions.TooManyRetries, exceptions.FailureWithErrorCode, exceptions.FailureWithoutErrorCode) as exp:
-                logging.error("Failed to request data: " + str(exp))
-                Domoticz.Error("Failed to request data: " + str(exp))
-                return None
-            return DeviceData
+                discoveredAt, stationIds = float(entry["time"]), list(entry["stations"])
+            except (TypeError, KeyError, ValueError):
+                discoveredAt, stationIds = 0.0, []
+            self.discoveries[account.Username] = (discoveredAt, stationIds)
+            account.stationIds = stationIds
+        self.persistedDiscoveries = dict(self.discoveries)
+
+    def persistDiscoveries(self):
+        """store newly discovered stations in the plugin configuration, runs on the Domoticz thread"""
+        discoveries = dict(self.discoveries)
+        if discoveries == self.persistedDiscoveries:
+            return
+        setConfigItem(Key="discovered stations", Value={user: {"time": discoveredAt, "stations": stationIds}
+                                                       for user, (discoveredAt, stationIds) in discoveries.items()})
+        self.persistedDiscoveries = discoveries
+
+    def getDeviceData(self, account, stationId):
+        """request the data of a station on a station worker, failures are raised as the classified exceptions"""
+        try:
+            return account.stationDataRequestV2(stationId)
+        except exceptions.PermanentFailure:
+            if account.Username in self.discoveries:
+                #the station may be removed from the account, request the station list again
+                self.staleDiscoveries.add(account.Username)
+            raise
+
+    def fetchStationData(self):
+        """login and request the data of all stations, runs on the poller thread so must not touch Devices"""
+        accounts = []
+        for account in self.accounts:
+            if account.breaker.allowRequest():
+                accounts.append(account)
+            else:
+                logging.debug("SEMS circuit of account '%s' open, next request in %d seconds", account.Username, account.breaker.retryIn())
+        if len(accounts) == 0:
+            return None
+        with self.metrics.timed("poll"):
+            return self.requestStations(accounts)
+
+    def requestStations(self, accounts):
+        """
+        request the stations of the accounts on the shared station workers, each account logs in on its own.
+        The circuit breaker of an account records one outcome per poll: success when SEMS answered a request.
+        """
+        futures = []
+        answered = {} #account: True when SEMS answered a station request of this poll
+        for account in accounts:
+            if self.poller.stopping:
+                account.breaker.releaseProbe()
+                continue
+            if self.establishToken(account) == False:
+                logging.error("token not established for account '%s'", account.Username)
+                Domoticz.Error("token not established for account '" + account.Username + "'")
+                account.breaker.recordFailure()
+                continue
+            if account.Username in self.discoveries:
+                self.discoverStations(account)
+            if len(account.stationIds) == 0:
+                account.breaker.releaseProbe()
+                continue
+            answered[account] = False
+            try:
+                futures.extend((account, stationId, self.stationExecutor.submit(self.getDeviceData, account, stationId)) for stationId in account.stationIds)
+            except RuntimeError:
+                #the station workers were shut down by onStop after the poller stop timed out
+                break
+        stations = []
+        for account, stationId, future in futures:
+            try:
+                DeviceData = future.result()
+                answered[account] = True
+            except exceptions.GoodweException as exp:
+                if isinstance(exp, exceptions.PermanentFailure):
+                    #SEMS answered, so the portal itself is available
+                    answered[account] = True
+                logging.error("Failed to request data for station '%s': %s", stationId, exp)
+                Domoticz.Error("Failed to request data for station '" + stationId + "': " + str(exp))
+                continue
+            except Exception as exp:
+                if not self.poller.stopping:
+                    logging.exception("Failed to process data for station '%s': %s", stationId, exp)
+                continue
+            if not account.stationChanged(stationId, DeviceData):
+                continue
+            with self.metrics.timed("parse"):
+                stations.append(account.createStationV2(DeviceData))
+            for serialNumber in stations[-1].inverters:
+                self.inverterAccounts[serialNumber] = account
+                self.inverterStations[serialNumber] = stationId
+            self.recordHistory(stations[-1])
+        for account, succeeded in answered.items():
+            if succeeded:
+                account.breaker.recordSuccess()
+            elif self.poller.stopping:
+                account.breaker.releaseProbe()
+            else:
+                account.breaker.recordFailure()
+        return stations or None
+
+    def recordHistory(self, theStation):
+        """store the snapshots of a station in the history file, runs on the poller thread"""
+        if self.history is None:
+            return
+        now = time.time()
+        for theInverter in theStation.inverters.values():
+            self.history.append(theInverter.snapshot, now)
 
     def startDeviceUpdateV2(self):
-        if self.establishToken() == False:
-            logging.error("token not established")
-            Domoticz.Error("token not established")
+        """hand a device update to the poller thread, the result is processed on a next heartbeat"""
+        if self.poller.busy:
+            logging.debug("previous device update still in progress, skipping this one")
             return
-        DeviceData = self.getDeviceData()
-        if DeviceData == None:
-            logging.error("DeviceData == None")
-            Domoticz.Error("DeviceData == None")
+        if not self.semsNeeded():
+            logging.debug("all inverters are read on the local network, skipping the SEMS poll")
             return
-        self.goodWeAccount.createStationV2(DeviceData)
-        self.updateDevices(DeviceData)
-
-    def updateDevices(self, apiData):
-        theStation = self.goodWeAccount.powerStationList[1]
-        for inverter in apiData["inverter"]:
-            logging.debug("inverter found with SN: '" + inverter["sn"] + "'")
-            if inverter["sn"] in theStation.inverters:
-                #theStation.inverters[inverter["sn"]].createDevices(Devices)
-                self.createDevices(inverter["sn"])
-                
-                theInverter = theStation.inverters[inverter["sn"]]
-
-                if len(inverter['fault_message']) > 0:
-                    Domoticz.Log("Fault message from GoodWe inverter (SN: " + inverter["sn"] + "): '" + str(inverter['fault_message']) + "'")
-                    logging.info("Fault message from GoodWe inverter (SN: " + inverter["sn"] + "): '" + str(inverter['fault_message']) + "'")
-                Domoticz.Log("Status of GoodWe inverter (SN: " + inverter["sn"] + "): '" + str(inverter["status"]) + ' ' + self.goodWeAccount.INVERTER_STATE[inverter["status"]] + "'")
-                logging.info("Status of GoodWe inverter (SN: " + inverter["sn"] + "): '" + str(inverter["status"]) + ' ' + self.goodWeAccount.INVERTER_STATE[inverter["status"]] + "'")
-                UpdateDevice(inverter["sn"], theInverter.inverterStateUnit, inverter["status"]+1, str((inverter["status"]+2)*10), AlwaysUpdate=True)
-                #Devices[inverter["sn"]].Unit[theInverter.inverterStateUnit].Update(nValue=inverter["status"]+1, sValue=str((inverter["status"]+2)*10))
-                if self.goodWeAccount.INVERTER_STATE[inverter["status"]] == 'generating':
-                    logging.debug("inverter generating, log temp")
-                    UpdateDevice(inverter["sn"],theInverter.inverterTemperatureUnit, 0, str(inverter["tempperature"]))
-                    UpdateDevice(inverter["sn"],theInverter.outputFreq1Unit, 0, str(inverter["d"]["fac1"]))
-
-                UpdateDevice(inverter["sn"], theInverter.outputCurrentUnit, 0, str(inverter["output_current"]), AlwaysUpdate=True)
-                UpdateDevice(inverter["sn"], theInverter.outputVoltageUnit, 0, str(inverter["output_voltage"]), AlwaysUpdate=True)
-                UpdateDevice(inverter["sn"], theInverter.outputPowerUnit, 0, str(inverter["output_power"]) + ";" + str(inverter["etotal"] * 1000), AlwaysUpdate=True)
-                inputVoltage,inputAmps = inverter["pv_input_1"].split('/')
-                inputPower = float(inputVoltage[:-1]) * float(inputAmps[:-1]) #calculate the power based on P = I * V in Watt
-                UpdateDevice(inverter["sn"], theInverter.inputVoltage1Unit, 0, inputVoltage, AlwaysUpdate=True)
-                UpdateDevice(inverter["sn"], theInverter.inputAmps1Unit, 0, inputAmps, AlwaysUpdate=True)
-
-                newCounter = calculateNewEnergy(inverter["sn"], theInverter.inputPower1Unit, inputPower)
-                UpdateDevice(inverter["sn"],theInverter.inputPower1Unit, 0, "{:5.1f};{:10.2f}".format(inputPower, newCounter), AlwaysUpdate=True)
-
-                if "pv_input_2" in inverter:
-                    logging.debug("Second string found")
-                    inputVoltage,inputAmps = inverter["pv_input_2"].split('/')
-                    UpdateDevice(inverter["sn"],theInverter.inputVoltage2Unit, 0, inputVoltage, AlwaysUpdate=True)
-                    UpdateDevice(inverter["sn"],theInverter.inputAmps2Unit, 0, inputAmps, AlwaysUpdate=True)
-                    inputPower = (float(inputVoltage[:-1])) * (float(inputAmps[:-1]))
-                    newCounter = calculateNewEnergy(inverter["sn"], theInverter.inputPower2Unit, inputPower)
-                    UpdateDevice(inverter["sn"],theInverter.inputPower2Unit, 0, "{:5.1f};{:10.2f}".format(inputPower, newCounter), AlwaysUpdate=True)
-                if "pv_input_3" in inverter:
-                    logging.debug("Third string found")
-                    inputVoltage,inputAmps = inverter["pv_input_3"].split('/')
-                    UpdateDevice(inverter["sn"],theInverter.inputVoltage3Unit, 0, inputVoltage, AlwaysUpdate=True)
-                    UpdateDevice(inverter["sn"],theInverter.inputAmps3Unit, 0, inputAmps, AlwaysUpdate=True)
-                    inputPower = float(inputVoltage[:-1]) * float(inputAmps[:-1])
-                    newCounter = calculateNewEnergy(inverter["sn"], theInverter.inputPower3Unit, inputPower)
-                    UpdateDevice(inverter["sn"],theInverter.inputPower3Unit, 0, "{:5.1f};{:10.2f}".format(inputPower, newCounter), AlwaysUpdate=True)
-                if "pv_input_4" in inverter:
-                    logging.debug("Fourth string found")
-                    inputVoltage,inputAmps = inverter["pv_input_4"].split('/')
-                    UpdateDevice(inverter["sn"],theInverter.inputVoltage4Unit, 0, inputVoltage, AlwaysUpdate=True)
-                    UpdateDevice(inverter["sn"],theInverter.inputAmps4Unit, 0, inputAmps, AlwaysUpdate=True)
-                    inputPower = float(inputVoltage[:-1]) * float(inputAmps[:-1])
-                    newCounter = calculateNewEnergy(inverter["sn"], theInverter.inputPower4Unit, inputPower)
-                    UpdateDevice(inverter["sn"],theInverter.inputPower4Unit, 0, "{:5.1f};{:10.2f}".format(inputPower, newCounter), AlwaysUpdate=True)
-                #log data of battery
-                Domoticz.Debug("Battery values: battery: '{0}', bms_status: '{1}', battery_power: '{2}'".format(inverter["battery"],inverter["bms_status"],inverter["battery_power"]))
-                logging.debug("Battery values: battery: '{0}', bms_status: '{1}', battery_power: '{2}'".format(inverter["battery"],inverter["bms_status"],inverter["battery_power"]))
+        self.lastPollStart = time.monotonic()
+        self.poller.submit(self.fetchStationData)
 
-    def createDevices(self, serialNumber):
-        #create domoticz devices
-        logging.debug("creating units for device with serial number: "+ serialNumber)
-        thisDevice = Domoticz.Device(DeviceID=serialNumber) #use serial number as identifier for Domoticz.Device instance
-        #numDevs = len(Devices[serialNumber].Units)
-        if serialNumber not in Devices or self.inverterTemperatureUnit not in Devices[serialNumber].Units:
-            Domoticz.Unit(Name="Inverter temperature (SN: " + serialNumber + ")", DeviceID=serialNumber,
-                            Unit=(self.inverterTemperatureUnit), Type=80, Subtype=5).Create()
-        #if self.outputCurrentUnit not in Devices:
-        if serialNumber not in Devices or self.outputCurrentUnit not in Devices[serialNumber].Units:
-            Domoticz.Unit(Name="Inverter output current (SN: " + serialNumber + ")", DeviceID=serialNumber,
-                            Unit=(self.outputCurrentUnit), Type=243, Subtype=23).Create()
-        if serialNumber not in Devices or self.outputVoltageUnit not in Devices[serialNumber].Units:
-            Domoticz.Unit(Name="Inverter output voltage (SN: " + serialNumber + ")", DeviceID=serialNumber,
-                            Unit=(self.outputVoltageUnit), Type=243, Subtype=8).Create()
-        if serialNumber not in Devices or self.outputPowerUnit not in Devices[serialNumber].Units:
-            Domoticz.Unit(Name="Inverter output power (SN: " + serialNumber + ")", DeviceID=serialNumber,
-                            Unit=(self.outputPowerUnit), Type=243, Subtype=29,
-                            Switchtype=4, Used=1).Create()
-                            
-        if serialNumber not in Devices or self.inverterStateUnit not in Devices[serialNumber].Units:
-            Options = {"LevelActions": "|||",
-                  "LevelNames": "|Offline|Waiting|Generating|Error",
-                  "LevelOffHidden": "true",
-                  "SelectorStyle": "1"}
-            Domoticz.Unit(Name="Inverter state (SN: " + serialNumber + ")",
-                            Unit=(self.inverterStateUnit), TypeName="Selector Switch", Image=1,
-                            Options=Options, Used=1, DeviceID=serialNumber).Create()
-                            
-        if serialNumber not in Devices or self.inputVoltage1Unit not in Devices[serialNumber].Units:
-            Domoticz.Unit(Name="Inverter input 1 voltage (SN: " + serialNumber + ")",
-                            Unit=(self.inputVoltage1Unit), Type=243, Subtype=8, 
-                            DeviceID=serialNumber).Create()
-        if serialNumber not in Devices or self.inputAmps1Unit not in Devices[serialNumber].Units:
-            Domoticz.Unit(Name="Inverter input 1 Current (SN: " + serialNumber + ")",
-                            Unit=(self.inputAmps1Unit), Type=243, Subtype=23,
-                            Switchtype=4, Used=0, DeviceID=serialNumber).Create()
-        if serialNumber not in Devices or self.inputPower1Unit not in Devices[serialNumber].Units:
-            Domoticz.Unit(Name="Inverter input 1 power (SN: " + serialNumber + ")",
-                            Unit=(self.inputPower1Unit), Type=243, Subtype=29,
-                            Switchtype=4, Used=1, DeviceID=serialNumber).Create()
-        if serialNumber not in Devices or self.inputVoltage2Unit not in Devices[serialNumber].Units:
-            Domoticz.Unit(Name="Inverter input 2 voltage (SN: " + serialNumber + ")",
-                            Unit=(self.inputVoltage2Unit), Type=243, Subtype=8, Used=0, 
-                            DeviceID=serialNumber).Create()
-        #input string 2.. 4 are optional. Set devices to not-used
-        if serialNumber not in Devices or self.inputAmps2Unit not in Devices[serialNumber].Units:
-            Domoticz.Unit(Name="Inverter input 2 Current (SN: " + serialNumber + ")",
-                            Unit=(self.inputAmps2Unit), Type=243, Subtype=23,
-                            Switchtype=4, Used=0, DeviceID=serialNumber).Create()
-        if serialNumber not in Devices or self.inputVoltage3Unit not in Devices[serialNumber].Units:
-            Domoticz.Unit(Name="Inverter input 3 voltage (SN: " + serialNumber + ")",
-                            Unit=(self.inputVoltage3Unit), Type=243, Subtype=8, Used=0, 
-                            DeviceID=serialNumber).Create()
-        if serialNumber not in Devices or self.inputAmps3Unit not in Devices[serialNumber].Units:
-            Domoticz.Unit(Name="Inverter input 3 Current (SN: " + serialNumber + ")",
-                            Unit=(self.inputAmps3Unit), Type=243, Subtype=23,
-                            Switchtype=4, Used=0, DeviceID=serialNumber).Create()
-        if serialNumber not in Devices or self.inputVoltage4Unit not in Devices[serialNumber].Units:
-            Domoticz.Unit(Name="Inverter input 4 voltage (SN: " + serialNumber + ")",
-                            Unit=(self.inputVoltage4Unit), Type=243, Subtype=8, Used=0, 
-                            DeviceID=serialNumber).Create()
-        if serialNumber not in Devices or self.inputAmps4Unit not in Devices[serialNumber].Units:
-            Domoticz.Unit(Name="Inverter input 4 Current (SN: " + serialNumber + ")",
-                            Unit=(self.inputAmps4Unit), Type=243, Subtype=23,
-                            Switchtype=4, Used=0, DeviceID=serialNumber).Create()
-        if serialNumber not in Devices or self.inputPower2Unit not in Devices[serialNumber].Units:
-            Domoticz.Unit(Name="Inverter input 2 power (SN: " + serialNumber + ")",
-                            Unit=(self.inputPower2Unit), Type=243, Subtype=29,
-                            Switchtype=4, Used=0, DeviceID=serialNumber).Create()
-        if serialNumber not in Devices or self.inputPower3Unit not in Devices[serialNumber].Units:
-            Domoticz.Unit(Name="Inverter input 3 power (SN: " + serialNumber + ")",
-                            Unit=(self.inputPower3Unit), Type=243, Subtype=29,
-                            Switchtype=4, Used=0, DeviceID=serialNumber).Create()
-        if serialNumber not in Devices or self.inputPower4Unit not in Devices[serialNumber].Units:
-            Domoticz.Unit(Name="Inverter input 4 power (SN: " + serialNumber + ")",
-                            Unit=(self.inputPower4Unit), Type=243, Subtype=29,
-                            Switchtype=4, Used=0, DeviceID=serialNumber).Create()
-        if serialNumber not in Devices or self.outputFreq1Unit not in Devices[serialNumber].Units:
-            Domoticz.Unit(Name="Inverter output frequency 1 (SN: " + serialNumber + ")",
-                            Unit=(self.outputFreq1Unit), TypeName="Custom",
-                            Used=0, DeviceID=serialNumber).Create()
-        if serialNumber not in Devices or self.inverterStateCommand not in Devices[serialNumber].Units:
-
-            Options = {"LevelActions": "|||",
-                  "LevelNames": "|Reboot|Waiting/off|N/A|Restart",
-                  "LevelOffHidden": "true",
-                  "SelectorStyle": "1"}
-            Domoticz.Unit(Name="Inverter state control (SN: " + serialNumber + ")",
-                            Unit=(self.inverterStateCommand), TypeName="Selector Switch", Image=1,
-                            Options=Options, Used=0, DeviceID=serialNumber).Create()
-
-        if serialNumber in Devices:
-            Domoticz.Debug("Number of Units: " + str(len(Devices[serialNumber].Units)) + ", number of units: " + str(len(Devices[serialNumber].Units)) + ")")
+    def scheduleTokenRefresh(self):
+        """refresh a token on the poller thread between polls, before SEMS rejects it"""
+        if self.poller.busy:
+            return
+        for account in self.accounts:
+            if account.tokenNeedsRefresh():
+                self.poller.submit(account.refreshExpiringToken)
+                return
+
+    def nextRun(self):
+        """number of heartbeats until the next poll, based on the inverter states of the last poll"""
+        interval = self.scheduler.nextInterval(self.inverterStates.values())
+        return max(1, math.ceil(interval / _HeartbeatInterval))
+
+    def processResults(self):
+        if self.localPoller is not None:
+            for readAt, snapshots in self.localPoller.results():
+                for snapshot in snapshots:
+                    with self.metrics.timed("update"):
+                        self.updateInverter(snapshot, readAt)
+        for stations in self.poller.results():
+            for theStation in stations:
+                with self.metrics.timed("update"):
+                    self.updateDevices(theStation)
+            if self.scheduler.shouldSpeedUp(self.inverterStates.values()):
+                self.runAgain = min(self.runAgain, int(Parameters["Mode2"]))
+        self.applyCommandResults()
+        self.applyBackfills()
+        self.scheduleBackfill()
+        self.persistToken()
+        self.persistDiscoveries()
+        if time.monotonic() - self.lastCheckpoint >= _CheckpointInterval:
+            saveEnergyCheckpoints()
+            self.lastCheckpoint = time.monotonic()
+        self.publishMetrics()
+
+    def sendCommands(self):
+        """send the next queued inverter command on a station worker, the queue spaces the writes to SEMS"""
+        if self.stationExecutor is None:
+            return
+        command = self.commands.next()
+        if command is None:
+            return
+        account = self.inverterAccounts[command.serialNumber]
+        stationId = self.inverterStations[command.serialNumber]
+        self.stationExecutor.submit(self.sendCommand, account, stationId, command)
+
+    def sendCommand(self, account, stationId, command):
+        """send an inverter command to SEMS, runs on a station worker so must not touch Devices"""
+        logging.debug("sending command %s of station '%s'", command, stationId)
+        try:
+            account.changeInverterStatus(stationId, command.serialNumber, command.mode)
+        except (exceptions.AuthenticationFailure, exceptions.TransientFailure, exceptions.PermanentFailure) as exp:
+            self.commandResults.put((command, exp))
+        except Exception as exp:
+            logging.exception("Failed to send command %s: %s", command, exp)
+            self.commandResults.put((command, exp))
         else:
-            Domoticz.Debug("no Device with Serial Number found")
-        #Domoticz.Log("Number of Devices: " + str(len(Devices[serialNumber].Units)) + ", created for GoodWe inverter (SN: " + serialNumber + ")")
-        
+            self.commandResults.put((command, None))
+
+    def applyCommandResults(self):
+        """handle the answers of SEMS to sent commands, an accepted command is confirmed by the next poll"""
+        while True:
+            try:
+                command, error = self.commandResults.get_nowait()
+            except queue.Empty:
+                return
+            self.commands.done(command.serialNumber)
+            name = _CommandModes[command.mode]
+            if error is not None:
+                logging.error("Failed to send command '%s' to inverter '%s': %s", name, command.serialNumber, error)
+                Domoticz.Error("Failed to send command '" + name + "' to inverter '" + command.serialNumber + "': " + str(error))
+                continue
+            logging.info("command '%s' accepted by SEMS for inverter '%s', waiting for the inverter state", name, command.serialNumber)
+            self.sentCommands[command.serialNumber] = (command, time.monotonic())
+            self.runAgain = 1 #poll on the next heartbeat to confirm the command
+
+    def confirmCommand(self, serialNumber, state, polledAt):
+        """report the state of an inverter in the first poll started after SEMS accepted a command for it"""
+        sent = self.sentCommands.get(serialNumber)
+        if sent is None or polledAt is None or polledAt < sent[1]:
+            return
+        command, acceptedAt = sent
+        name = _CommandModes[command.mode]
+        expected = _ExpectedStates.get(command.mode)
+        if expected is None or state in expected:
+            del self.sentCommands[serialNumber]
+            message = "Inverter (SN: %s) reports state '%s' after command '%s'" % (serialNumber, state, name)
+            Domoticz.Log(message)
+            logging.info(message)
+        elif time.monotonic() - acceptedAt > _ConfirmTimeout:
+            del self.sentCommands[serialNumber]
+            message = "Inverter (SN: %s) still reports state '%s' %d minutes after command '%s'" % (serialNumber, state, _ConfirmTimeout // 60, name)
+            Domoticz.Error(message)
+            logging.warning(message)
+
+    def scheduleBackfill(self):
+        """fill the energy gaps found in the last poll from the snapshot or SEMS history, on the station workers"""
+        gaps = takeEnergyGaps()
+        if len(gaps) > 0 and self.stationExecutor is not None:
+            logging.info("filling %d energy gaps from the history: %s", len(gaps), gaps)
+            self.stationExecutor.submit(self.backfill, gaps)
+
+    def backfill(self, gaps):
+        """
+        integrate the power history of each gap, the snapshot history is used when it covers the gap and SEMS is
+        asked otherwise. Runs on a station worker so must not touch Devices
+        """
+        stopEvent = self.poller.stopEvent if self.poller is not None else None
+        for gap in gaps:
+            if stopEvent is not None and stopEvent.is_set():
+                return
+            samples = self.localHistory(gap)
+            if samples is None:
+                account = self.inverterAccounts.get(gap.device)
+                try:
+                    samples = account.stringPowerHistory(gap.device, self.energyStrings[gap.unit], gap.start, gap.end, stopEvent) if account is not None else []
+                except Exception as exp:
+                    logging.exception("Failed to request the history of %s: %s", gap.device, exp)
+                    samples = []
+            if stopEvent is not None and stopEvent.is_set():
+                return #the history may be incomplete
+            energyWh = energy.backfillEnergy(gap, samples)
+            logging.debug("backfill of %s from %d history samples: %.2f Wh", gap, len(samples), energyWh)
+            self.backfills.put((gap.device, gap.unit, energyWh))
+
+    def localHistory(self, gap):
+        """the power samples of the string of a gap from the snapshot history, None when they do not cover the gap"""
+        if self.history is None:
+            return None
+        samples = self.history.stringPower(gap.device, self.energyStrings[gap.unit], gap.start, gap.end)
+        if not energy.coversGap(gap, samples, self.maxEnergyGap):
+            return None
+        logging.debug("%s covered by %d samples of the snapshot history", gap, len(samples))
+        return samples
+
+    def applyBackfills(self):
+        """add the energy of finished backfills to the energy counters and write them"""
+        while True:
+            try:
+                Device, Unit, energyWh = self.backfills.get_nowait()
+            except queue.Empty:
+                return
+            integrator = _energyIntegrators.get((Device, Unit))
+            if integrator is None:
+                continue
+            integrator.energy += energyWh
+            UpdateDevice(Device, Unit, 0, "{:5.1f};{:10.2f}".format(integrator.power, integrator.energy), AlwaysUpdate=True)
+
+    def publishMetrics(self):
+        """publish the rolling phase durations as Domoticz units and/or a Prometheus text file"""
+        if self.metricsMode not in ("Devices", "File", "Both") or time.monotonic() - self.lastMetrics < _MetricsInterval:
+            return
+        self.lastMetrics = time.monotonic()
+        summary = self.metrics.summary()
+        if self.metricsMode in ("Devices", "Both"):
+            self.updateMetricsDevices(summary)
+        if self.metricsMode in ("File", "Both"):
+            counters = {
+                "goodwe_unit_writes_total": ("counter", "Domoticz unit writes", _updateCache.written),
+                "goodwe_unit_writes_skipped_total": ("counter", "Domoticz unit writes skipped as the value did not change enough", _updateCache.skipped),
+                "goodwe_unchanged_polls_total": ("counter", "Station polls skipped as SEMS did not refresh the data", sum(account.unchangedStations for account in self.accounts)),
+                "goodwe_commands_coalesced_total": ("counter", "Inverter commands replaced by a later command before being sent", self.commands.coalesced),
+                "goodwe_circuit_open": ("gauge", "Accounts of which the SEMS requests are suspended after repeated failures", sum(account.breaker.state != "closed" for account in self.accounts)),
+            }
+            path = os.path.join(Parameters["HomeFolder"], _MetricsFile)
+            try:
+                writeAtomic(path, prometheusText(summary, counters, Parameters["Name"]))
+            except OSError as exp:
+                logging.error("Failed to write metrics file '%s': %s", path, exp)
+
+    def updateMetricsDevices(self, summary):
+        """write the p95 duration in ms of each phase to a custom unit, created when missing"""
+        for unit, phase in enumerate(PHASES, start=1):
+            if _MetricsDevice not in Devices or unit not in Devices[_MetricsDevice].Units:
+                Domoticz.Unit(Name="SEMS " + phase + " p95", DeviceID=_MetricsDevice, Unit=unit,
+                              TypeName="Custom", Options={"Custom": "1;ms"}, Used=0).Create()
+            stats = summary.get(phase)
+            if stats is not None:
+                UpdateDevice(_MetricsDevice, unit, 0, "%.1f" % (stats.p95 * 1000))
+
+    def updateDevices(self, theStation):
+        """update the Domoticz units of all inverters of a station from their parsed snapshots"""
+        localInverters = self.locallyRead()
+        for theInverter in theStation.inverters.values():
+            if theInverter.snapshot.sn in localInverters:
+                logging.debug("inverter '%s' is read on the local network, SEMS data skipped", theInverter.snapshot.sn)
+                continue
+            self.updateInverter(theInverter.snapshot, self.lastPollStart)
+
+    def updateInverter(self, snapshot, polledAt=None):
+        """update the Domoticz units of an inverter from a snapshot of SEMS or the local network, requested at polledAt"""
+        serialNumber = snapshot.sn
+        logging.debug("inverter found with SN: '%s'", serialNumber)
+        self.createDevices(serialNumber)
+
+        if len(snapshot.faultMessage) > 0:
+            message = "Fault message from GoodWe inverter (SN: %s): '%s'" % (serialNumber, snapshot.faultMessage)
+            Domoticz.Log(message)
+            logging.info(message)
+        state = GoodWe.INVERTER_STATE.get(snapshot.status, 'unknown')
+        message = "Status of GoodWe inverter (SN: %s): '%s %s'" % (serialNumber, snapshot.status, state)
+        Domoticz.Log(message)
+        logging.info(message)
+        generating = state == 'generating'
+        self.inverterStates[serialNumber] = state
+        self.confirmCommand(serialNumber, state, polledAt)
+
+        for unit, formatter, policy, energy, generatingOnly in self.unitUpdates:
+            if generatingOnly and not generating:
+                continue
+            value = formatter(snapshot)
+            if value is None:
+                continue
+            if energy:
+                newCounter = calculateNewEnergy(serialNumber, unit, value, self.maxEnergyGap)
+                UpdateDevice(serialNumber, unit, 0, "{:5.1f};{:10.2f}".format(value, newCounter), Policy=policy)
+            else:
+                UpdateDevice(serialNumber, unit, value[0], value[1], Policy=policy)
+
+        #log data of battery
+        if debugEnabled():
+            message = "Battery values: battery: '%s', bms_status: '%s', battery_power: '%s'" % (snapshot.battery, snapshot.bmsStatus, snapshot.batteryPower)
+            Domoticz.Debug(message)
+            logging.debug(message)
+
+    def locallyRead(self):
+        """serial numbers of the inverters read on the local network recently, SEMS is not needed for them"""
+        return {inverter.serialNumber for inverter in self.localInverters if inverter.isFresh(_LocalFreshness)}
+
+    def startLocalUpdate(self):
+        """read the local inverters on their own poller, so a slow SEMS poll does not delay them"""
+        if len(self.localInverters) > 0 and not self.localPoller.busy:
+            self.localPoller.submit(self.fetchLocalData)
+
+    def fetchLocalData(self):
+        """read the snapshots of the local inverters, runs on the local poller thread so must not touch Devices"""
+        snapshots = []
+        readAt = time.monotonic()
+        with self.metrics.timed("local"):
+            for inverter in self.localInverters:
+                wasFresh = inverter.isFresh(_LocalFreshness)
+                try:
+                    snapshots.append(inverter.readSnapshot())
+                except exceptions.TransientFailure as exp:
+                    if wasFresh and not inverter.isFresh(_LocalFreshness):
+                        logging.warning("%s, using SEMS for inverter '%s'", exp, inverter.serialNumber)
+                    else:
+                        logging.debug("%s", exp)
+        if self.history is not None:
+            now = time.time()
+            for snapshot in snapshots:
+                self.history.append(snapshot, now)
+        return (readAt, snapshots) if len(snapshots) > 0 else None
+
+    def semsNeeded(self):
+        """False when every inverter SEMS reported is read on the local network, the SEMS poll is skipped then"""
+        return len(self.inverterStations) == 0 or not set(self.inverterStations) <= self.locallyRead()
+
+    def createDevices(self, serialNumber):
+        """create the domoticz units of an inverter, only checked once per serial number"""
+        if serialNumber in self.createdDevices:
+            return
+        logging.debug("creating units for device with serial number: %s", serialNumber)
+        start = time.perf_counter()
+        for spec in UNITS:
+            if serialNumber not in Devices or spec.unit not in Devices[serialNumber].Units:
+                Domoticz.Unit(Name=spec.name + " (SN: " + serialNumber + ")", DeviceID=serialNumber,
+                                Unit=spec.unit, **spec.create).Create()
+        self.createdDevices.add(serialNumber)
+        self.metrics.record("create", time.perf_counter() - start)
+
+        if debugEnabled():
+            if serialNumber in Devices:
+                Domoticz.Debug("Number of Units: %d for GoodWe inverter (SN: %s)" % (len(Devices[serialNumber].Units), serialNumber))
+            else:
+                Domoticz.Debug("no Device with Serial Number found")
 
     def onStart(self):
         self.logger = logging.getLogger('root')
@@ -362,7 +680,7 @@ class GoodWeSEMSPlugin:
             DumpConfigToLog()
         Domoticz.Status("Starting Goodwe SEMS API plugin, logging to file {0}".format(self.log_filename))
 
-        logging.info("starting plugin version "+Parameters["Version"])
+        logging.info("starting plugin version %s", Parameters["Version"])
 
         #check upgrading of version needs actions
         self.version = Parameters["Version"]
@@ -370,98 +688,166 @@ class GoodWeSEMSPlugin:
         if not self.enabled:
             return False
 
-        if Parameters["Mode4"] == "Yes":
-            self.goodWeAccount = GoodWeSEMSPlus(Parameters["Address"], Parameters["Port"], Parameters["Username"], Parameters["Password"])
-        else:
-            self.goodWeAccount = GoodWe(Parameters["Address"], Parameters["Port"], Parameters["Username"], Parameters["Password"])
+        try:
+            accountParameters = parseAccounts(Parameters["Username"], Parameters["Password"], Parameters["Mode1"])
+        except ValueError as exp:
+            Domoticz.Error("Invalid account configuration: " + str(exp))
+            logging.error("Invalid account configuration: %s", exp)
+            self.enabled = False
+            return
+        #all accounts share one HTTP connection pool and one set of station workers
+        self.session = createSession(hosts=_HostsPerAccount * len(accountParameters))
+        accountClass = GoodWeSEMSPlus if Parameters["Mode4"] == "Yes" else GoodWe
+        self.accounts = []
+        for username, password, stationIds in accountParameters:
+            account = accountClass(Parameters["Address"], Parameters["Port"], username, password, session=self.session)
+            account.metrics = self.metrics
+            account.stationIds = stationIds
+            self.accounts.append(account)
+        self.metricsMode = Parameters.get("Mode5") or "No"
         self.runAgain = int(Parameters["Mode2"])
+        self.scheduler = PollScheduler(int(Parameters["Mode2"]) * _HeartbeatInterval, getLocation())
+        self.maxEnergyGap = max(_MinEnergyGap, 3 * int(Parameters["Mode2"]) * _HeartbeatInterval)
+        self.restoreToken()
+        self.restoreDiscoveries()
+        loadEnergyCheckpoints()
+        self.lastCheckpoint = time.monotonic()
+        self.history = openHistory()
+        self.poller = Poller()
+        self.localInverters = [LocalInverter(host, port) for host, port in parseLocalAddresses(Parameters.get("Mode3") or "")]
+        if len(self.localInverters) > 0:
+            logging.info("Reading %d inverter(s) on the local network: %s", len(self.localInverters), self.localInverters)
+            self.localPoller = Poller(name="GoodWeLocal")
+            self.localPoller.start()
 
-        if len(Parameters["Mode1"]) == 0:
-            Domoticz.Error("No Power Station ID provided, exiting")
-            logging.error("No Power Station ID provided, exiting")
-            return
-            
+        for account in self.accounts:
+            if account.Username in self.discoveries:
+                logging.info("Polling the discovered power station(s) of account '%s': %s", account.Username, ", ".join(account.stationIds) or "not discovered yet")
+            else:
+                logging.info("Polling %d power station(s) of account '%s': %s", len(account.stationIds), account.Username, ", ".join(account.stationIds))
+
+        #threads are started when needed, so stations discovered later are requested in parallel as well
+        self.stationExecutor = ThreadPoolExecutor(max_workers=_MaxStationWorkers, thread_name_prefix="GoodWeStation")
+        self.poller.start()
         self.startDeviceUpdateV2()
 
     def onStop(self):
         Domoticz.Log("onStop - Plugin is stopping.")
         logging.info("onStop - Plugin is stopping.")
+        if len(self.commands) > 0:
+            logging.warning("%d inverter command(s) not sent to SEMS before stopping", len(self.commands))
+        #stop the tasks in flight before their next request, closing the sessions drops the idle connections
+        for poller in (self.localPoller, self.poller):
+            if poller is not None:
+                poller.requestStop()
+        for account in self.accounts:
+            account.closeSession()
+        if self.session is not None:
+            self.session.close()
+            self.session = None
+        if self.localPoller is not None:
+            self.localPoller.stop()
+        for inverter in self.localInverters:
+            inverter.close()
+        if self.poller is not None:
+            self.poller.stop()
+        #the poll task is done, so it no longer submits station requests
+        if self.stationExecutor is not None:
+            self.stationExecutor.shutdown(wait=True, cancel_futures=True)
+        if self.poller is not None:
+            saveEnergyCheckpoints()
+        if self.history is not None:
+            self.history.close()
         if self.httpConn is not None:
             self.httpConn.Disconnect()
 
     def onConnect(self, Connection, Status, Description):
-        logging.debug("onConnect: Status: '" + str(Status) + "', Description: '" + Description + "'")
+        logging.debug("onConnect: Status: '%s', Description: '%s'", Status, Description)
         if (Status == 0):
             logging.debug("Connected to SEMS portal API successfully.")
             self.startDeviceUpdate(Connection)
         else:
             Domoticz.Log("Failed to connect (" + str(Status) + ") to: " + Parameters["Address"] + ":" + Parameters[
                 "Port"] + " with error: " + Description)
-            logging.info("Failed to connect (" + str(Status) + ") to: " + Parameters["Address"] + ":" + Parameters[
-                "Port"] + " with error: " + Description)
+            logging.info("Failed to connect (%s) to: %s:%s with error: %s", Status, Parameters["Address"], Parameters["Port"], Description)
 
     def onCommand(self, DeviceID, Unit, Command, Level, Hue):
-        logging.debug("onCommand called for Device '" + str(DeviceID) + "', Unit '" + str(Unit) + "': Parameter '" + str(Command) + "', Level: " + str(Level))
+        logging.debug("onCommand called for Device '%s', Unit '%s': Parameter '%s', Level: %s", DeviceID, Unit, Command, Level)
         if Unit == self.inverterStateCommand:
-            mode = Level / 10
-            # self.goodWeAccount.setInverterStatus("54200DSN196R0358","54200DSN196R0358",4)
+            mode = int(Level / 10)
+            if mode not in _CommandModes:
+                logging.error("Inverter state control level %s is not supported", Level)
+                Domoticz.Error("Inverter state control level " + str(Level) + " is not supported")
+                return
+            if DeviceID not in self.inverterAccounts:
+                logging.error("Inverter '%s' not received from SEMS yet, command ignored", DeviceID)
+                Domoticz.Error("Inverter '" + DeviceID + "' not received from SEMS yet, command ignored")
+                return
+            #the command is sent on a next heartbeat, onCommand never waits for SEMS
+            if self.commands.submit(DeviceID, mode):
+                logging.info("command '%s' for inverter '%s' replaces the command not sent yet", _CommandModes[mode], DeviceID)
+            else:
+                logging.info("command '%s' for inverter '%s' queued", _CommandModes[mode], DeviceID)
+            UpdateDevice(DeviceID, Unit, 2, str(Level), AlwaysUpdate=True)
             return
 
+    def onDeviceRemoved(self, DeviceID, Unit):
+        logging.debug("onDeviceRemoved called for Device '%s', Unit '%s'", DeviceID, Unit)
+        _updateCache.forget(DeviceID, Unit)
+        self.createdDevices.discard(DeviceID)
+        for key in [key for key in _energyIntegrators if key[0] == DeviceID]:
+            del _energyIntegrators[key]
+
     def onDisconnect(self, Connection):
-        logging.debug("onDisconnect called for connection to: " + Connection.Address + ":" + Connection.Port)
+        logging.debug("onDisconnect called for connection to: %s:%s", Connection.Address, Connection.Port)
         self.httpConn = None
 
     def onHeartbeat(self):
         if self.enabled:
+            self.processResults()
+            self.startLocalUpdate()
+            self.sendCommands()
+            self.scheduleTokenRefresh()
             if Parameters["Mode4"] == "Yes":
-                if len(Parameters["Mode1"]) == 0:
-                    Domoticz.Error("No Power Station ID provided, exiting")
-                    logging.error("No Power Station ID provided, exiting")
-                    return
-
                 self.runAgain = self.runAgain - 1
                 if self.runAgain <= 0:
                     logging.debug("onHeartbeat called, starting SEMS+ device update.")
                     self.startDeviceUpdateV2()
-                    self.runAgain = int(Parameters["Mode2"])
+                    self.runAgain = self.nextRun()
                 return
 
             if self.httpConn is not None and (self.httpConn.Connecting() or self.httpConn.Connected()) and not self.devicesUpdated:
                 logging.debug("onHeartbeat called, Connection is alive.")
-            elif len(Parameters["Mode1"]) == 0:
-                Domoticz.Error("No Power Station ID provided, exiting")
-                logging.error("No Power Station ID provided, exiting")
-                return
             else:
                 self.runAgain = self.runAgain - 1
                 if self.runAgain <= 0:
                     logging.debug("onHeartbeat called, starting device update.")
                     self.startDeviceUpdateV2()
-                    self.runAgain = int(Parameters["Mode2"])
+                    self.runAgain = self.nextRun()
 
     def checkVersion(self, version):
         """checks actual version against stored version as 'Ma.Mi.Pa' and checks if updates needed"""
         #read version from stored configuration
         ConfVersion = getConfigItem("plugin version", "0.0.0")
         Domoticz.Log("Starting version: " + version )
-        logging.info("Starting version: " + version )
+        logging.info("Starting version: %s", version)
         MaCurrent,MiCurrent,PaCurrent = version.split('.')
         MaConf,MiConf,PaConf = ConfVersion.split('.')
-        logging.debug("checking versions: current '{0}', config '{1}'".format(version, ConfVersion))
+        logging.debug("checking versions: current '%s', config '%s'", version, ConfVersion)
         can_continue = True
         if int(MaConf) < int(MaCurrent):
             Domoticz.Log("Major version upgrade: {0} -> {1}".format(MaConf,MaCurrent))
-            logging.info("Major version upgrade: {0} -> {1}".format(MaConf,MaCurrent))
+            logging.info("Major version upgrade: %s -> %s", MaConf, MaCurrent)
             #add code to perform MAJOR upgrades
             if int(MaConf) < 4:
                 can_continue = self.updateToEx()
         elif int(MiConf) < int(MiCurrent):
             Domoticz.Debug("Minor version upgrade: {0} -> {1}".format(MiConf,MiCurrent))
-            logging.debug("Minor version upgrade: {0} -> {1}".format(MiConf,MiCurrent))
+            logging.debug("Minor version upgrade: %s -> %s", MiConf, MiCurrent)
             #add code to perform MINOR upgrades
         elif int(PaConf) < int(PaCurrent):
             Domoticz.Debug("Patch version upgrade: {0} -> {1}".format(PaConf,PaCurrent))
-            logging.debug("Patch version upgrade: {0} -> {1}".format(PaConf,PaCurrent))
+            logging.debug("Patch version upgrade: %s -> %s", PaConf, PaCurrent)
             #add code to perform PATCH upgrades, if any
         if ConfVersion != version and can_continue:
             #store new version info
@@ -480,7 +866,7 @@ class GoodWeSEMSPlugin:
 
     def _setVersion(self, major, minor, patch):
         #set configs
-        logging.debug("Setting version to {0}.{1}.{2}".format(major, minor, patch))
+        logging.debug("Setting version to %s.%s.%s", major, minor, patch)
         setConfigItem(Key="MajorVersion", Value=major)
         setConfigItem(Key="MinorVersion", Value=minor)
         setConfigItem(Key="patchVersion", Value=patch)
@@ -488,31 +874,147 @@ class GoodWeSEMSPlugin:
 
 global _plugin
 _plugin = GoodWeSEMSPlugin()
+_updateCache = UpdateCache()
+_energyIntegrators = {} #(DeviceID, Unit): EnergyIntegrator
+_energyCheckpoints = {} #energyKey: checkpoint stored in the plugin configuration
+_energyGaps = [] #EnergyGap found since the last backfill
 
-def calculateNewEnergy(Device, Unit, inputPower):
-    try:
-        #read power currently on display (comes from previous update) in Watt and energy counter uptill now in Wh
-        previousPower,currentCount = Devices[Device].Units[Unit].sValue.split(";") 
-    except:
-        #in case no values there, just assume zero
-        previousPower = 0 #Watt
-        currentCount = 0 #Wh
-    dt_format = "%Y-%m-%d %H:%M:%S"
-    dt_string = Devices[Device].Units[Unit].LastUpdate
-    if len(dt_string) > 0:
-        lastUpdateDT = datetime.fromtimestamp(time.mktime(time.strptime(dt_string, dt_format)))
+def calculateNewEnergy(Device, Unit, inputPower, maxGap=None):
+    """
+    add the energy produced since the previous poll to the energy counter (Wh) of a PV string and return the counter.
+    When the previous sample is more than maxGap seconds old the gap is left to a backfill from the SEMS history.
+    """
+    key = (Device, Unit)
+    integrator = _energyIntegrators.get(key)
+    if integrator is None:
+        #cold start: rebuild from the stored checkpoint or the values on display
+        theUnit = Devices[Device].Units[Unit]
+        integrator = energy.coldStart(theUnit.sValue, theUnit.LastUpdate, _energyCheckpoints.get(energyKey(Device, Unit)))
+        _energyIntegrators[key] = integrator
+        logging.debug("energy integrator for %s unit %s started: %s", Device, Unit, integrator)
+    now = time.monotonic()
+    elapsed = now - integrator.stamp
+    if maxGap is not None and elapsed > maxGap and (integrator.power > 0 or inputPower > 0):
+        end = time.time()
+        _energyGaps.append(energy.EnergyGap(Device, Unit, end - elapsed, end, integrator.power, inputPower))
+        integrator.restart(inputPower, now)
+        newCounter = integrator.energy
     else:
-        lastUpdateDT = datetime.now()
-    elapsedTime = datetime.now() - lastUpdateDT
-    logging.debug("Test power, previousPower: {}, last update: {:%Y-%m-%d %H:%M}, elapsedTime: {}, elapsedSeconds: {:6.2f}".format(previousPower, lastUpdateDT, elapsedTime, elapsedTime.total_seconds()))
-    
-    #average current and previous power (Watt) and multiply by elapsed time (hour) to get Watt hour
-    previousPower = str(previousPower).replace("w","").replace("W","")
-    newCount = round(((float(previousPower) + inputPower ) / 2) * elapsedTime.total_seconds()/3600,2)
-    newCounter = newCount + float(currentCount) #add the amount of energy since last update to the already logged energy
-    logging.debug("Test power, previousPower: {}, currentCount: {:6.2f}, newCounter: {:6.2f}, added: {:6.2f}".format(previousPower, float(currentCount), newCounter, newCount))
+        newCounter = integrator.update(inputPower, now)
+    logging.debug("energy of %s unit %s, power: %6.1f, newCounter: %6.2f", Device, Unit, inputPower, newCounter)
     return newCounter
 
+def takeEnergyGaps():
+    """Return and forget the energy gaps found since the last call"""
+    gaps = _energyGaps[:]
+    del _energyGaps[:len(gaps)]
+    return gaps
+
+def energyKey(Device, Unit):
+    """key of an energy checkpoint in the plugin configuration"""
+    return "{0}:{1}".format(Device, Unit)
+
+def loadEnergyCheckpoints():
+    _energyCheckpoints.clear()
+    _energyCheckpoints.update(getConfigItem("energy checkpoints", {}))
+
+def saveEnergyCheckpoints():
+    checkpoints = {energyKey(Device, Unit): integrator.checkpoint() for (Device, Unit), integrator in _energyIntegrators.items()}
+    if len(checkpoints) > 0:
+        setConfigItem(Key="energy checkpoints", Value=checkpoints)
+        logging.debug("stored %d energy checkpoints", len(checkpoints))
+
+def getLocation():
+    """latitude and longitude from the Domoticz settings, None when not configured"""
+    try:
+        latitude, longitude = Settings["Location"].split(";")
+        return float(latitude), float(longitude)
+    except (NameError, KeyError, AttributeError, ValueError):
+        logging.debug("Domoticz location not available, polling without daylight schedule")
+        return None
+
+def openHistory():
+    """open the snapshot history of this hardware, None when it can not be used"""
+    folder = Parameters.get("HomeFolder")
+    if not folder:
+        return None
+    path = os.path.join(folder, _HistoryFile % Parameters.get("HardwareID", Parameters["Name"]))
+    try:
+        return SnapshotRing(path)
+    except (OSError, ValueError) as exp:
+        logging.error("Failed to open snapshot history '%s': %s", path, exp)
+        Domoticz.Error("Failed to open snapshot history: " + str(exp))
+        return None
+
+def parseAccounts(usernameParameter, passwordParameter, stationParameter):
+    """
+    Return (username, password, station IDs) of each account. Usernames and passwords are separated by ';',
+    the station IDs of the accounts by '|'. A single account keeps its password as entered, it may contain a ';'.
+    An account without station IDs polls the stations discovered from its station list.
+    """
+    usernames = [username.strip() for username in usernameParameter.split(";") if len(username.strip()) > 0]
+    if len(usernames) == 0:
+        raise ValueError("no username provided")
+    if len(usernames) == 1:
+        return [(usernames[0], passwordParameter, parseStationIds(stationParameter.replace("|", ";")))]
+    passwords = passwordParameter.split(";")
+    stationGroups = stationParameter.split("|") if len(stationParameter.strip()) > 0 else [""] * len(usernames)
+    if len(passwords) != len(usernames):
+        raise ValueError("{0} usernames but {1} passwords provided".format(len(usernames), len(passwords)))
+    if len(stationGroups) != len(usernames):
+        raise ValueError("{0} usernames but {1} groups of power station IDs separated by '|' provided".format(len(usernames), len(stationGroups)))
+    accounts = []
+    polled = set()
+    for username, password, stationGroup in zip(usernames, passwords, stationGroups):
+        stationIds = [stationId for stationId in parseStationIds(stationGroup) if stationId not in polled]
+        polled.update(stationIds)
+        accounts.append((username, password, stationIds))
+    return accounts
+
+def parseLocalAddresses(addressParameter):
+    """
+    split the local inverter parameter in a list of (host, port). Numbers are skipped, previous versions
+    used this parameter for the peak power, and so is anything else which is no IP address or hostname.
+    """
+    addresses = []
+    for address in addressParameter.replace(",", ";").split(";"):
+        address = address.strip()
+        host, _, port = address.partition(":")
+        if len(host) == 0:
+            continue
+        if not validHost(host):
+            try:
+                float(host)
+                logging.info("ignoring local inverter address '%s', the peak power of a previous version", host)
+            except ValueError:
+                logging.error("ignoring local inverter address '%s', not an IP address or hostname", address)
+                Domoticz.Error("Ignoring local inverter address '" + address + "', not an IP address or hostname")
+            continue
+        try:
+            addresses.append((host, int(port) if port else DefaultPort))
+        except ValueError:
+            logging.error("invalid port in local inverter address '%s'", address)
+            Domoticz.Error("Invalid port in local inverter address '" + address + "'")
+    return addresses
+
+def validHost(host):
+    """True when host is an IPv4 address or a hostname, the last label of a hostname is not numeric"""
+    try:
+        return ipaddress.ip_address(host).version == 4
+    except ValueError:
+        pass
+    labels = host.rstrip(".").split(".")
+    return len(host) <= 253 and all(_HostLabel.match(label) for label in labels) and not labels[-1].isdigit()
+
+def parseStationIds(stationParameter):
+    """split the power station parameter in a list of unique station IDs"""
+    stationIds = []
+    for stationId in stationParameter.replace(",", ";").split(";"):
+        stationId = stationId.strip()
+        if len(stationId) > 0 and stationId not in stationIds:
+            stationIds.append(stationId)
+    return stationIds
+
 def onStart():
     global _plugin
     _plugin.onStart()
@@ -533,6 +1035,10 @@ def onNotification(Name, Subject, Text, Status, Priority, Sound, ImageFile):
     global _plugin
     _plugin.onNotification(Name, Subject, Text, Status, Priority, Sound, ImageFile)
 
+def onDeviceRemoved(DeviceID, Unit):
+    global _plugin
+    _plugin.onDeviceRemoved(DeviceID, Unit)
+
 def onDisconnect(Connection):
     global _plugin
     _plugin.onDisconnect(Connection)
@@ -550,6 +1056,10 @@ def LogMessage(Message):
         Domoticz.Log("File written")
         logging.info("File written")
 
+def debugEnabled():
+    """True when debug logging is enabled, used to skip building debug messages for Domoticz.Debug"""
+    return logging.getLogger().isEnabledFor(logging.DEBUG)
+
 def DumpConfigToLog():
     Domoticz.Debug("Parameters count: " + str(len(Parameters)))
     for x in Parameters:
@@ -567,29 +1077,31 @@ def DumpConfigToLog():
 
 def DumpHTTPResponseToLog(httpDict):
     if isinstance(httpDict, dict):
-        logging.debug("HTTP Details (" + str(len(httpDict)) + "):")
+        logging.debug("HTTP Details (%d):", len(httpDict))
         for x in httpDict:
             if isinstance(httpDict[x], dict):
-                logging.debug("--->'" + x + " (" + str(len(httpDict[x])) + "):")
+                logging.debug("--->'%s (%d):", x, len(httpDict[x]))
                 for y in httpDict[x]:
-                    logging.debug("------->'" + y + "':'" + str(httpDict[x][y]) + "'")
+                    logging.debug("------->'%s':'%s'", y, httpDict[x][y])
             else:
-                logging.debug("--->'" + x + "':'" + str(httpDict[x]) + "'")
+                logging.debug("--->'%s':'%s'", x, httpDict[x])
 
-def UpdateDevice(Device, Unit, nValue, sValue, AlwaysUpdate=False):
+def UpdateDevice(Device, Unit, nValue, sValue, AlwaysUpdate=False, Policy=None):
+    """write a unit value, compared against the last written value in memory instead of the Domoticz database"""
     # Make sure that the Domoticz device still exists (they can be deleted) before updating it
-    if (Device in Devices):
-        logging.debug("Updating device '"+Devices[Device].Units[Unit].Name+ "' with current sValue '"+Devices[Device].Units[Unit].sValue+"' to '" +sValue+"'")
-        if (Devices[Device].Units[Unit].nValue != nValue) or (Devices[Device].Units[Unit].sValue != sValue) or AlwaysUpdate:
-            #try:
-                Devices[Device].Units[Unit].nValue = nValue
-                Devices[Device].Units[Unit].sValue = sValue
-                Devices[Device].Units[Unit].Update()
-                
-                logging.debug("Update "+str(nValue)+":'"+str(sValue)+"' ("+Devices[Device].Units[Unit].Name+")")
-            # except:
-                # Domoticz.Error("Update of device failed: "+str(Unit)+"!")
-                # logging.error("Update of device failed: "+str(Unit)+"!")
+    if (Device in Devices) and (Unit in Devices[Device].Units):
+        key = (Device, Unit)
+        now = time.monotonic()
+        if AlwaysUpdate or _updateCache.shouldWrite(key, nValue, sValue, Policy or ExactPolicy, now):
+            theUnit = Devices[Device].Units[Unit]
+            theUnit.nValue = nValue
+            theUnit.sValue = sValue
+            theUnit.Update()
+            _updateCache.remember(key, nValue, sValue, now)
+            _updateCache.written += 1
+            logging.debug("Update %s:'%s' (%s)", nValue, sValue, theUnit.Name)
+        else:
+            _updateCache.skipped += 1
     return
 
 # Configuration Helpers
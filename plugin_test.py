@@ -1,8 +1,31 @@
 import unittest
 from GoodWe import GoodWe
+from GoodWe import GoodWeSEMSPlus
 from GoodWe import PowerStation
 from GoodWe import Inverter
+from GoodWe import InverterSnapshot
+from poller import Poller
+from fakeSEMS import FakeSEMS, FakeStation
+import GoodWe as goodwe
+from breaker import CircuitBreaker
+import metrics
+from history import SnapshotRing
+from commands import CommandQueue
+from fakeInverter import FakeInverter
+import localinverter
+import os
+import tempfile
+import breaker
+import exceptions
+import requests
+from deviceupdate import UpdatePolicy, UpdateCache
+import units
+import energy
+import scheduler
+from datetime import date, datetime, timezone
 import logging
+import time
+import threading
 
 
 class BasicInverterTest(unittest.TestCase):
@@ -28,6 +51,58 @@ class BasicInverterTest(unittest.TestCase):
     def test_invType(self):
         self.assertEqual(self.inverter.type, "name_simple")
 
+    def test_invUnitNumbers(self):
+        self.assertEqual(self.inverter.inverterTemperatureUnit, 1)
+        self.assertEqual(self.inverter.inputPower1Unit, 14)
+        self.assertEqual(self.inverter.inverterStateCommand, 19)
+
+
+class UnitsTableTest(unittest.TestCase):
+    def test_unitNumbersUnique(self):
+        numbers = [spec.unit for spec in units.UNITS]
+        self.assertEqual(len(numbers), len(set(numbers)))
+        self.assertEqual(sorted(numbers), list(range(1, 20)))
+
+    def test_formatters(self):
+        snapshot = InverterSnapshot({"sn": "sn1", "status": 1, "pv_input_2": "231.5V/4.2A", "output_power": 500, "etotal": 12.5})
+        updates = {unit: formatter for unit, formatter, policy, energy, generatingOnly in units.compileUpdates()}
+        self.assertEqual(updates[9](snapshot), (2, "30"))
+        self.assertEqual(updates[7](snapshot), (0, "231.5"))
+        self.assertEqual(updates[8](snapshot), (0, "4.2"))
+        self.assertAlmostEqual(updates[15](snapshot), 972.3)
+        self.assertEqual(updates[4](snapshot), (0, "500.0;12500.0"))
+        self.assertIsNone(updates[5](snapshot), "missing string 1 gives no value")
+        self.assertIsNone(updates[1](snapshot), "missing temperature gives no value")
+        self.assertNotIn(19, updates)
+
+    def test_outputPowerWithoutTotal(self):
+        updates = {unit: formatter for unit, formatter, policy, energy, generatingOnly in units.compileUpdates()}
+        snapshot = InverterSnapshot({"sn": "sn1", "status": 1, "output_power": 500})
+        self.assertIsNone(updates[4](snapshot), "missing total energy skips the kWh update")
+
+
+class InverterSnapshotTest(unittest.TestCase):
+    def test_parse(self):
+        snapshot = InverterSnapshot({
+            "sn": "sn1", "status": 1, "tempperature": 41.5, "d": {"fac1": 50.01},
+            "output_current": "1.2", "output_voltage": 231.0, "output_power": 650, "etotal": 1234.5,
+            "pv_input_1": "300.5V/1.2A", "pv_input_2": "310V/0.8A", "fault_message": "",
+        })
+        self.assertEqual(snapshot.status, 1)
+        self.assertEqual(snapshot.temperature, 41.5)
+        self.assertEqual(snapshot.frequency, 50.01)
+        self.assertEqual(snapshot.outputCurrent, 1.2)
+        self.assertEqual(snapshot.numStrings, 2)
+        self.assertEqual(snapshot.inputVoltage[1], 310.0)
+        self.assertAlmostEqual(snapshot.inputPower[0], 360.6)
+        self.assertTrue(snapshot.hasInput(1))
+        self.assertFalse(snapshot.hasInput(2))
+
+    def test_compact(self):
+        snapshot = InverterSnapshot({"sn": "sn1", "status": -1})
+        self.assertFalse(hasattr(snapshot, "__dict__"))
+        self.assertEqual(snapshot.numStrings, 0)
+
 
 class PowerStationTest(unittest.TestCase):
     powerStation = None
@@ -149,6 +224,702 @@ class PowerStationTest(unittest.TestCase):
         self.powerStation = None
 
 
+class MultiStationTest(unittest.TestCase):
+    def stationData(self, stationId, serial):
+        return {
+            "info": {"powerstation_id": stationId, "stationname": "name " + stationId, "address": "", "status": 1},
+            "inverter": [{"sn": serial, "name": "inv " + serial, "status": 1}],
+        }
+
+    def test_stationsKeyedById(self):
+        account = GoodWe("eu.semsportal.com", "443", "user", "pwd")
+        account.createStationV2(self.stationData("station-a", "sn_a"))
+        account.createStationV2(self.stationData("station-b", "sn_b"))
+        self.assertEqual(account.numStations, 2)
+        self.assertIn("sn_b", account.powerStationList["station-b"].inverters)
+        self.assertEqual(GoodWe("eu.semsportal.com", "443", "user2", "pwd").numStations, 0)
+
+    def test_unchangedStationSkipped(self):
+        account = GoodWe("eu.semsportal.com", "443", "user", "pwd")
+        data = self.stationData("station-a", "sn_a")
+        self.assertTrue(account.stationChanged("station-a", data, now=100))
+        data["info"]["time"] = "later"
+        self.assertFalse(account.stationChanged("station-a", data, now=110))
+        self.assertTrue(account.stationChanged("station-b", self.stationData("station-b", "sn_a"), now=110))
+        data["inverter"][0]["status"] = 0
+        self.assertTrue(account.stationChanged("station-a", data, now=120))
+        self.assertTrue(account.stationChanged("station-a", data, now=120 + units.MaxUpdateInterval))
+        self.assertEqual(account.unchangedStations, 1)
+
+    def test_tokenRefreshedOnce(self):
+        account = GoodWe("eu.semsportal.com", "443", "user", "pwd")
+        logins = []
+        def fakeTokenRequest():
+            logins.append(1)
+            account.token = {"token": "new"}
+            account.tokenAvailable = True
+        account.tokenRequest = fakeTokenRequest
+        expired = account.token
+        account.refreshToken(expired)
+        account.refreshToken(expired)
+        self.assertEqual(len(logins), 1)
+
+
+class TokenPersistenceTest(unittest.TestCase):
+    def loggedInAccount(self):
+        account = GoodWeSEMSPlus("eu.semsportal.com", "443", "user", "pwd")
+        account.token = {"token": "abc", "api": "https://eu-gateway.semsportal.com/web/sems", "region": "eu"}
+        account.base_url = account.token["api"]
+        account.tokenAvailable = True
+        account.tokenTimestamp = 1700000000.0
+        return account
+
+    def test_exportImport(self):
+        tokenState = self.loggedInAccount().exportToken()
+        account = GoodWeSEMSPlus("eu.semsportal.com", "443", "user", "pwd")
+        self.assertTrue(account.importToken(tokenState))
+        self.assertTrue(account.tokenAvailable)
+        self.assertEqual(account.token["region"], "eu")
+        self.assertEqual(account.base_url, "https://eu-gateway.semsportal.com/web/sems")
+        self.assertEqual(account.tokenTimestamp, 1700000000.0)
+
+    def test_importBoundsLifetime(self):
+        tokenState = self.loggedInAccount().exportToken()
+        tokenState["lifetime"] = 3 * 86400
+        account = GoodWeSEMSPlus("eu.semsportal.com", "443", "user", "pwd")
+        account.importToken(tokenState)
+        self.assertEqual(account.tokenLifetime, goodwe._DefaultTokenLifetime)
+
+    def test_importRejectsOtherAccount(self):
+        tokenState = self.loggedInAccount().exportToken()
+        self.assertFalse(GoodWeSEMSPlus("eu.semsportal.com", "443", "other", "pwd").importToken(tokenState))
+        self.assertFalse(GoodWe("eu.semsportal.com", "443", "user", "pwd").importToken(tokenState))
+        self.assertFalse(GoodWeSEMSPlus("eu.semsportal.com", "443", "user", "pwd").importToken({}))
+
+    def test_noExportWithoutToken(self):
+        self.assertIsNone(GoodWeSEMSPlus("eu.semsportal.com", "443", "user", "pwd").exportToken())
+
+
+class LoginFlowTest(unittest.TestCase):
+    def setUp(self):
+        self.account = GoodWeSEMSPlus("eu.semsportal.com", "443", "user", "pwd")
+        self.calls = []
+
+    def flows(self, newToken, legacyToken):
+        def newLogin():
+            self.calls.append("new")
+            return newToken
+        def legacyLogin():
+            self.calls.append("legacy")
+            return legacyToken
+        self.account._get_new_login_token = newLogin
+        self.account._get_legacy_login_token = legacyLogin
+
+    def test_fallbackRemembered(self):
+        self.flows(None, {"token": "legacy", "api": "https://eu.semsportal.com/api"})
+        self.account.tokenRequest()
+        self.assertEqual(self.calls, ["new", "legacy"])
+        self.assertEqual(self.account.loginFlow, "legacy")
+        self.calls.clear()
+        self.account.tokenRequest()
+        self.assertEqual(self.calls, ["legacy"])
+        self.assertEqual(self.account.exportToken()["login_flow"], "legacy")
+
+    def test_flowRestoredWithToken(self):
+        self.flows(None, {"token": "legacy", "api": "https://eu.semsportal.com/api"})
+        self.account.tokenRequest()
+        account = GoodWeSEMSPlus("eu.semsportal.com", "443", "user", "pwd")
+        account.importToken(self.account.exportToken())
+        self.assertEqual(account.loginFlow, "legacy")
+
+
+class TokenRefreshTest(unittest.TestCase):
+    def setUp(self):
+        self.account = GoodWeSEMSPlus("eu.semsportal.com", "443", "user", "pwd")
+        self.account.token = {"token": "old"}
+        self.account.tokenAvailable = True
+        self.account.tokenLifetime = 1000
+        self.logins = []
+
+    def login(self, succeed):
+        def fakeTokenRequest():
+            self.logins.append(succeed)
+            if succeed:
+                self.account.token = {"token": "new"}
+                self.account.tokenTimestamp = time.time()
+            else:
+                self.account.tokenAvailable = False
+        self.account.tokenRequest = fakeTokenRequest
+
+    def test_freshTokenNotRefreshed(self):
+        self.account.tokenTimestamp = time.time() - 100
+        self.assertFalse(self.account.tokenNeedsRefresh())
+
+    def test_refreshAheadOfExpiry(self):
+        self.account.tokenTimestamp = time.time() - 900
+        self.login(True)
+        self.assertTrue(self.account.tokenNeedsRefresh())
+        self.account.refreshExpiringToken()
+        self.assertEqual(self.account.token, {"token": "new"})
+        self.assertFalse(self.account.tokenNeedsRefresh())
+
+    def test_failedRefreshKeepsValidToken(self):
+        self.account.tokenTimestamp = time.time() - 900
+        self.login(False)
+        self.account.refreshExpiringToken()
+        self.assertTrue(self.account.tokenAvailable)
+        self.assertEqual(self.account.token, {"token": "old"})
+        self.assertFalse(self.account.tokenNeedsRefresh(), "retry of a failed refresh should be delayed")
+
+    def test_learnLifetimeFromRejection(self):
+        self.account.tokenTimestamp = time.time() - 600
+        self.account.tokenLastValid = time.time() - 30
+        self.account.learnTokenLifetime()
+        self.assertAlmostEqual(self.account.tokenLifetime, 570, delta=5)
+
+    def test_learnLifetimeOfIdleToken(self):
+        self.account.tokenTimestamp = time.time() - 3 * 86400
+        self.account.tokenLastValid = self.account.tokenTimestamp + 1200
+        self.account.learnTokenLifetime()
+        self.assertAlmostEqual(self.account.tokenLifetime, 1200, delta=5)
+        self.account.tokenLastValid = None
+        self.account.learnTokenLifetime()
+        self.assertEqual(self.account.tokenLifetime, goodwe._MinTokenLifetime, "a token never used says nothing about its lifetime")
+        self.account.tokenLastValid = time.time()
+        self.account.learnTokenLifetime()
+        self.assertEqual(self.account.tokenLifetime, goodwe._DefaultTokenLifetime)
+
+
+class RequestHeadersTest(unittest.TestCase):
+    def test_headersCachedPerToken(self):
+        account = GoodWeSEMSPlus("eu.semsportal.com", "443", "user", "pwd")
+        account.token = {"token": "first"}
+        headers = account.apiRequestHeadersV2()
+        self.assertIs(account.apiRequestHeadersV2(), headers)
+        self.assertEqual(headers["token"], '{"token": "first"}')
+        account.token = {"token": "second"}
+        self.assertEqual(account.apiRequestHeadersV2()["token"], '{"token": "second"}')
+
+    def test_legacyHeaders(self):
+        account = GoodWe("eu.semsportal.com", "443", "user", "pwd")
+        self.assertNotIn("Content-Type", account.apiRequestHeadersV2())
+        self.assertIn('"client": "web"', account.apiRequestHeadersV2()["token"])
+
+    def test_apiUrlResolvedPerToken(self):
+        account = GoodWeSEMSPlus("eu.semsportal.com", "443", "user", "pwd")
+        account.token = {"token": "first", "region": "eu"}
+        account.base_url = "https://eu-gateway.semsportal.com/web/sems"
+        resolved = []
+        resolve = account._resolve_api_base_for_url_part
+        account._resolve_api_base_for_url_part = lambda *args: resolved.append(args) or resolve(*args)
+        stationUrl = "/v3/PowerStation/GetMonitorDetailByPowerstationId"
+        self.assertEqual(account._apiUrl(stationUrl), "https://eu.semsportal.com/api" + stationUrl)
+        self.assertEqual(account._apiUrl(stationUrl), "https://eu.semsportal.com/api" + stationUrl)
+        self.assertEqual(len(resolved), 1)
+        account.token = {"token": "second", "region": "us"}
+        self.assertEqual(account._apiUrl(stationUrl), "https://us.semsportal.com/api" + stationUrl)
+        account.base_url = "https://semsplus.goodwe.com/api"
+        self.assertEqual(account._apiUrl(stationUrl), "https://semsplus.goodwe.com/api" + stationUrl)
+        self.assertEqual(len(resolved), 3)
+
+
+class UpdateCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.cache = UpdateCache()
+        self.cache.remember(("sn", 1), 0, "231.5V", now=1000)
+
+    def test_firstValueWritten(self):
+        self.assertTrue(self.cache.shouldWrite(("sn", 2), 0, "1.0", UpdatePolicy(deadband=10), now=1000))
+
+    def test_deadband(self):
+        policy = UpdatePolicy(deadband=1.0, maxInterval=300)
+        self.assertFalse(self.cache.shouldWrite(("sn", 1), 0, "231.5V", policy, now=1010))
+        self.assertFalse(self.cache.shouldWrite(("sn", 1), 0, "232.0V", policy, now=1010))
+        self.assertTrue(self.cache.shouldWrite(("sn", 1), 0, "233.0V", policy, now=1010))
+
+    def test_intervals(self):
+        policy = UpdatePolicy(minInterval=60, maxInterval=300)
+        self.assertFalse(self.cache.shouldWrite(("sn", 1), 0, "240.0V", policy, now=1030))
+        self.assertTrue(self.cache.shouldWrite(("sn", 1), 0, "240.0V", policy, now=1070))
+        self.assertFalse(self.cache.shouldWrite(("sn", 1), 0, "231.5V", policy, now=1070))
+        self.assertTrue(self.cache.shouldWrite(("sn", 1), 0, "231.5V", policy, now=1300))
+
+    def test_stateChange(self):
+        policy = UpdatePolicy(minInterval=60, forceOnStateChange=True)
+        self.assertTrue(self.cache.shouldWrite(("sn", 1), 1, "231.5V", policy, now=1001))
+        self.assertFalse(self.cache.shouldWrite(("sn", 1), 1, "231.5V", UpdatePolicy(minInterval=60), now=1001))
+
+    def test_forget(self):
+        self.cache.forget("sn")
+        self.assertTrue(self.cache.shouldWrite(("sn", 1), 0, "231.5V", now=1010))
+
+
+class EnergyIntegratorTest(unittest.TestCase):
+    def test_backfill(self):
+        gap = energy.EnergyGap("sn", 14, 0.0, 3600.0, 100.0, 300.0)
+        self.assertAlmostEqual(energy.backfillEnergy(gap, []), 200.0)
+        samples = [(1800.0, 1000.0), (-60.0, 5000.0), (7200.0, 5000.0)]
+        self.assertAlmostEqual(energy.backfillEnergy(gap, samples), (100 + 1000) / 4 + (1000 + 300) / 4)
+
+    def test_coversGap(self):
+        gap = energy.EnergyGap("sn", 14, 0.0, 3600.0, 100.0, 300.0)
+        self.assertFalse(energy.coversGap(gap, [], 900))
+        self.assertTrue(energy.coversGap(gap, [(stamp, 500.0) for stamp in range(900, 3600, 900)], 900))
+        self.assertFalse(energy.coversGap(gap, [(900.0, 500.0), (2700.0, 500.0)], 900))
+
+    def test_trapezoid(self):
+        integrator = energy.EnergyIntegrator(power=100.0, energy=10.0, stamp=1000.0)
+        self.assertAlmostEqual(integrator.update(300.0, now=1000.0 + 1800), 10.0 + 100.0)
+        self.assertAlmostEqual(integrator.update(300.0, now=1000.0 + 3600), 10.0 + 100.0 + 150.0)
+
+    def test_fromUnit(self):
+        lastUpdate = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(time.time() - 3600))
+        integrator = energy.EnergyIntegrator.fromUnit(" 10.0;    100.00", lastUpdate)
+        self.assertEqual(integrator.power, 10.0)
+        self.assertAlmostEqual(integrator.update(20.0), 115.0, delta=0.1)
+
+    def test_fromEmptyUnit(self):
+        integrator = energy.EnergyIntegrator.fromUnit("", "")
+        self.assertEqual(integrator.energy, 0.0)
+
+    def test_coldStartPrefersNewerCheckpoint(self):
+        lastUpdate = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(time.time() - 3600))
+        integrator = energy.coldStart("10;100", lastUpdate, [50.0, 120.0, time.time() - 60])
+        self.assertEqual(integrator.energy, 120.0)
+        integrator = energy.coldStart("10;100", lastUpdate, [50.0, 90.0, time.time() - 7200])
+        self.assertEqual(integrator.energy, 100.0)
+        integrator = energy.coldStart("10;100", lastUpdate, ["bad"])
+        self.assertEqual(integrator.energy, 100.0)
+
+
+class FakeSEMSTest(unittest.TestCase):
+    def setUp(self):
+        self.portal = FakeSEMS([FakeStation("st-1", inverters=2, strings=3)], tokenRequests=2).start()
+        self.urls = goodwe.NEW_LOGIN_URL, goodwe.OLD_LOGIN_URL
+        goodwe.NEW_LOGIN_URL, goodwe.OLD_LOGIN_URL = self.portal.newLoginUrl, self.portal.oldLoginUrl
+        self.account = GoodWeSEMSPlus("eu.semsportal.com", "443", "user", "pwd")
+
+    def tearDown(self):
+        goodwe.NEW_LOGIN_URL, goodwe.OLD_LOGIN_URL = self.urls
+        self.account.closeSession()
+        self.portal.stop()
+
+    def test_pollCycle(self):
+        self.account.tokenRequest()
+        self.assertTrue(self.account.tokenAvailable)
+        for i in range(3):
+            station = self.account.createStationV2(self.account.stationDataRequestV2("st-1"))
+        self.assertEqual(station.numInverters, 2)
+        self.assertEqual(station.inverters["st-1-inv001"].snapshot.numStrings, 3)
+        self.assertEqual(self.portal.stats()["tokens"], 2) #the token expired after 2 requests
+        self.account.setInverterStatus("st-1", "st-1-inv001", 2)
+        self.assertEqual(self.portal.commands, [("st-1", "st-1-inv001", 2)])
+
+    def test_loginFallback(self):
+        self.portal.failLogin = "new"
+        self.account.tokenRequest()
+        self.assertEqual(self.account.loginFlow, "legacy")
+        with self.assertRaises(exceptions.PermanentFailure):
+            self.account.stationDataRequestV2("unknown-station")
+
+    def test_invalidCredentials(self):
+        self.portal.failLogin = "legacy"
+        account = GoodWe("eu.semsportal.com", "443", "user", "wrong", session=self.account.session)
+        account.base_url = self.portal.url + "/api"
+        with self.assertRaises(exceptions.AuthenticationFailure):
+            account.tokenRequest()
+
+    def test_discoverStations(self):
+        self.portal.stations["st-2"] = FakeStation("st-2")
+        self.account.tokenRequest()
+        self.assertEqual(self.account.discoverStations(), ["st-1", "st-2"])
+
+    def test_changeInverterStatus(self):
+        self.account.tokenRequest()
+        self.portal.expireTokens()
+        self.account.changeInverterStatus("st-1", "st-1-inv002", 4)
+        self.assertEqual(self.portal.commands, [("st-1", "st-1-inv002", 4)])
+        self.assertEqual(self.portal.stats()["tokens"], 2)
+
+    def test_stringPowerHistory(self):
+        self.account.tokenRequest()
+        end = time.time()
+        samples = self.account.stringPowerHistory("st-1-inv001", 0, end - 3600, end)
+        self.assertGreaterEqual(len(samples), 11)
+        self.assertTrue(all(power == 700.0 and end - 3600 <= stamp <= end for stamp, power in samples))
+
+    def test_historyStopped(self):
+        self.account.tokenRequest()
+        stopEvent = threading.Event()
+        stopEvent.set()
+        end = time.time()
+        before = self.portal.requestCount
+        self.assertEqual(self.account.stringPowerHistory("st-1-inv001", 0, end - 3 * 86400, end, stopEvent), [])
+        self.assertEqual(self.portal.requestCount, before, "no history requests after stop")
+
+    def test_historyTokenRefreshed(self):
+        self.account.tokenRequest()
+        self.portal.expireTokens()
+        end = time.time()
+        self.assertGreaterEqual(len(self.account.inverterHistory("st-1-inv001", "Vpv1", end - 3600, end)), 11)
+        self.assertEqual(self.portal.stats()["tokens"], 2)
+        self.account.historyRequest = lambda serialNumber, column, date: {"code": 42, "msg": "no such inverter"}
+        self.assertEqual(self.account.inverterHistory("st-1-inv001", "Vpv1", end - 3600, end), [])
+
+
+class LocalInverterTest(unittest.TestCase):
+    def setUp(self):
+        self.fake = FakeInverter("5010KDTU000042", strings=3).start()
+        self.inverter = localinverter.LocalInverter(self.fake.host, self.fake.port, timeout=0.2, retries=1)
+
+    def tearDown(self):
+        self.inverter.close()
+        self.fake.stop()
+
+    def test_frames(self):
+        self.assertEqual(localinverter.readRequest(0x7F, 30100, 73).hex(), "7f0375940049d5c2")
+        response = localinverter.readResponse(0x7F, b"\x01\x02")
+        self.assertEqual(localinverter.parseResponse(response, 0x7F, 1), b"\x01\x02")
+        self.assertIsNone(localinverter.parseResponse(response[:-1] + b"\x00", 0x7F, 1))
+        self.assertIsNone(localinverter.parseResponse(response, 0xF7, 1))
+        self.assertIsNone(localinverter.parseResponse(response, 0x7F, 2))
+
+    def test_readSnapshot(self):
+        snapshot = self.inverter.readSnapshot()
+        self.assertEqual(snapshot.sn, "5010KDTU000042")
+        self.assertEqual(snapshot.status, 1)
+        self.assertEqual(snapshot.numStrings, 3)
+        self.assertEqual(list(snapshot.inputVoltage[:3]), [350.0] * 3)
+        self.assertEqual(snapshot.inputPower[0], 875.0)
+        self.assertEqual((snapshot.outputPower, snapshot.etotal, snapshot.temperature, snapshot.frequency), (1600.0, 12345.6, 40.0, 50.0))
+        self.assertEqual(self.inverter.readSnapshot().outputPower, 1610.0)
+        self.assertTrue(self.inverter.isFresh(60))
+
+    def test_silentInverter(self):
+        self.inverter.readSnapshot()
+        self.fake.silent = True
+        with self.assertRaises(exceptions.TransientFailure):
+            self.inverter.readSnapshot()
+        self.assertFalse(self.inverter.isFresh(60, now=time.monotonic() + 61))
+
+
+class CommandQueueTest(unittest.TestCase):
+    def test_coalescedPerInverter(self):
+        commands = CommandQueue(minInterval=30)
+        self.assertFalse(commands.submit("sn_a", 2, now=0))
+        self.assertFalse(commands.submit("sn_b", 1, now=1))
+        self.assertTrue(commands.submit("sn_a", 4, now=2))
+        self.assertEqual(len(commands), 2)
+        self.assertEqual(commands.coalesced, 1)
+        self.assertEqual(commands.next(now=3), ("sn_a", 4, 0))
+
+    def test_rateLimited(self):
+        commands = CommandQueue(minInterval=30)
+        commands.submit("sn_a", 2, now=0)
+        commands.submit("sn_b", 2, now=0)
+        self.assertEqual(commands.next(now=0).serialNumber, "sn_a")
+        self.assertIsNone(commands.next(now=29))
+        self.assertEqual(commands.next(now=30).serialNumber, "sn_b")
+        self.assertIsNone(commands.next(now=100))
+
+    def test_oneCommandInFlightPerInverter(self):
+        commands = CommandQueue(minInterval=0)
+        commands.submit("sn_a", 2, now=0)
+        commands.next(now=0)
+        commands.submit("sn_a", 4, now=1)
+        self.assertIsNone(commands.next(now=1))
+        commands.done("sn_a")
+        self.assertEqual(commands.next(now=2).mode, 4)
+
+
+class SnapshotRingTest(unittest.TestCase):
+    def setUp(self):
+        folder = tempfile.TemporaryDirectory()
+        self.addCleanup(folder.cleanup)
+        self.path = os.path.join(folder.name, "history.ring")
+
+    def snapshot(self, sn, power):
+        return InverterSnapshot({"sn": sn, "status": 1, "output_power": power, "etotal": 100.5,
+                                 "pv_input_1": "300V/2A", "pv_input_2": "310V/1.5A"})
+
+    def test_ringWrapsAround(self):
+        ring = SnapshotRing(self.path, capacity=3)
+        for i in range(5):
+            ring.append(self.snapshot("sn_a", i), timestamp=1000 + i)
+        self.assertEqual(len(ring), 3)
+        self.assertEqual([record.outputPower for record in ring.records()], [4.0, 3.0, 2.0])
+        newest = ring.record(0)
+        self.assertEqual(newest.sn, "sn_a")
+        self.assertEqual(newest.inputPower[:2], (600.0, 465.0))
+        self.assertNotEqual(newest.inputVoltage[2], newest.inputVoltage[2]) #missing string is NaN
+        with self.assertRaises(IndexError):
+            ring.record(3)
+        ring.close()
+
+    def test_reopenKeepsRecords(self):
+        ring = SnapshotRing(self.path, capacity=4)
+        ring.append(self.snapshot("sn_a", 10), timestamp=1000)
+        ring.append(self.snapshot("sn_b", 20), timestamp=1010)
+        ring.close()
+        ring = SnapshotRing(self.path, capacity=4)
+        self.assertEqual(len(ring), 2)
+        self.assertEqual([record.sn for record in ring.records(sn="sn_a")], ["sn_a"])
+        self.assertEqual([record.sn for record in ring.records(since=1005)], ["sn_b"])
+        ring.close()
+        ring = SnapshotRing(self.path, capacity=8)
+        self.assertEqual(len(ring), 0) #resized file starts empty
+        ring.close()
+
+    def test_stringPower(self):
+        ring = SnapshotRing(self.path, capacity=8)
+        for i in range(4):
+            ring.append(self.snapshot("sn_a" if i != 2 else "sn_b", 10), timestamp=1000 + 60 * i)
+        self.assertEqual(ring.stringPower("sn_a", 0, 1030, 1200), [(1060.0, 600.0), (1180.0, 600.0)])
+        self.assertEqual(ring.stringPower("sn_a", 2, 0, 1200), [], "missing string gives no samples")
+        ring.close()
+
+
+class MetricsTest(unittest.TestCase):
+    def test_rollingPercentiles(self):
+        collected = metrics.Metrics(window=10)
+        for i in range(1, 21):
+            collected.record("fetch", i / 1000)
+        stats = collected.summary()["fetch"]
+        self.assertEqual(stats.count, 20)
+        self.assertAlmostEqual(stats.p50, 0.015)
+        self.assertAlmostEqual(stats.p95, 0.020)
+        self.assertAlmostEqual(stats.max, 0.020)
+        self.assertNotIn("login", collected.summary())
+
+    def test_timed(self):
+        collected = metrics.Metrics()
+        with collected.timed("update"):
+            time.sleep(0.01)
+        self.assertGreaterEqual(collected.summary()["update"].max, 0.009)
+
+    def test_prometheusText(self):
+        collected = metrics.Metrics()
+        collected.record("fetch", 0.25)
+        text = metrics.prometheusText(collected.summary(), {"goodwe_circuit_open": ("gauge", "circuit open", 0)}, 'Solar "roof"')
+        self.assertIn('goodwe_phase_seconds{hardware="Solar \\"roof\\"",phase="fetch",quantile="0.95"} 0.250000', text)
+        self.assertIn('goodwe_phase_seconds_count{hardware="Solar \\"roof\\"",phase="fetch"} 1', text)
+        self.assertIn("# TYPE goodwe_circuit_open gauge", text)
+        self.assertTrue(text.endswith("\n"))
+
+
+class CircuitBreakerTest(unittest.TestCase):
+    def setUp(self):
+        self.breaker = CircuitBreaker(failureThreshold=2, baseDelay=100, maxDelay=300)
+
+    def test_opensAfterThreshold(self):
+        self.breaker.recordFailure(now=0)
+        self.assertTrue(self.breaker.allowRequest(now=1))
+        self.breaker.recordFailure(now=1)
+        self.assertEqual(self.breaker.state, breaker.OPEN)
+        self.assertFalse(self.breaker.allowRequest(now=2))
+        self.assertTrue(50 <= self.breaker.retryIn(now=1) <= 100)
+
+    def test_releasedProbe(self):
+        self.breaker.recordFailure(now=0)
+        self.breaker.recordFailure(now=0)
+        self.assertTrue(self.breaker.allowRequest(now=100))
+        self.breaker.releaseProbe()
+        self.assertEqual(self.breaker.state, breaker.OPEN)
+        self.assertTrue(self.breaker.allowRequest(now=100), "the next poll should probe again")
+
+    def test_halfOpenProbe(self):
+        self.breaker.recordFailure(now=0)
+        self.breaker.recordFailure(now=0)
+        self.assertTrue(self.breaker.allowRequest(now=100))
+        self.assertEqual(self.breaker.state, breaker.HALF_OPEN)
+        self.assertFalse(self.breaker.allowRequest(now=100))
+        self.breaker.recordSuccess()
+        self.assertEqual(self.breaker.state, breaker.CLOSED)
+        self.assertTrue(self.breaker.allowRequest(now=100))
+
+    def test_backoffGrowsWithJitter(self):
+        delays = []
+        now = 0
+        for i in range(4):
+            self.breaker.recordFailure(now=now)
+            self.breaker.recordFailure(now=now)
+            delays.append(self.breaker.retryIn(now=now))
+            now += 1000
+            self.breaker.allowRequest(now=now)
+        self.assertTrue(50 <= delays[0] <= 100)
+        self.assertTrue(100 <= delays[1] <= 200)
+        self.assertTrue(150 <= delays[2] <= 300)
+        self.assertTrue(150 <= delays[3] <= 300)
+
+
+class StationRequestTest(unittest.TestCase):
+    def setUp(self):
+        self.account = GoodWe("eu.semsportal.com", "443", "user", "pwd")
+        self.account.tokenAvailable = True
+        self.responses = []
+        def fakeStationDataRequest(stationId):
+            response = self.responses.pop(0)
+            if isinstance(response, Exception):
+                raise response
+            return response
+        self.account.stationDataRequest = fakeStationDataRequest
+        self.account.tokenRequest = lambda: setattr(self.account, "token", {"token": "new"})
+
+    def test_success(self):
+        self.responses = [{"code": 0, "data": {"inverter": []}}]
+        self.assertEqual(self.account.stationDataRequestV2("st"), {"inverter": []})
+
+    def test_transientFailure(self):
+        self.responses = [requests.exceptions.ConnectionError("down"), False]
+        for i in range(2):
+            with self.assertRaises(exceptions.TransientFailure):
+                self.account.stationDataRequestV2("st")
+
+    def test_permanentFailure(self):
+        self.responses = [{"code": 42, "msg": "no such station"}]
+        with self.assertRaises(exceptions.PermanentFailure):
+            self.account.stationDataRequestV2("st")
+
+    def test_tokenRefreshedOnce(self):
+        self.responses = [{"code": 100002}, {"code": 0, "data": {"inverter": []}}]
+        self.assertEqual(self.account.stationDataRequestV2("st"), {"inverter": []})
+        self.assertEqual(self.account.token, {"token": "new"})
+        self.responses = [{"code": 100002}, {"code": 100002}]
+        with self.assertRaises(exceptions.AuthenticationFailure):
+            self.account.stationDataRequestV2("st")
+
+    def test_stationList(self):
+        self.account.stationListRequest = lambda: self.responses.pop(0)
+        self.responses = [{"code": 100001}, {"code": 0, "data": {"list": [{"id": "st-a"}, {"powerstation_id": "st-b"}, {"id": "st-a"}, {}]}}]
+        self.assertEqual(self.account.discoverStations(), ["st-a", "st-b"])
+        self.assertEqual(self.account.token, {"token": "new"})
+        self.responses = [{"code": 0, "data": None}]
+        self.assertEqual(self.account.discoverStations(), [])
+        self.responses = [{"code": 42}]
+        with self.assertRaises(exceptions.PermanentFailure):
+            self.account.discoverStations()
+
+
+class PollSchedulerTest(unittest.TestCase):
+    amsterdam = (52.37, 4.9)
+
+    def epoch(self, *args):
+        return datetime(*args, tzinfo=timezone.utc).timestamp()
+
+    def test_sunTimes(self):
+        sunrise, sunset = scheduler.sunTimes(date(2024, 6, 21), *self.amsterdam)
+        self.assertAlmostEqual(sunrise, self.epoch(2024, 6, 21, 3, 18), delta=300)
+        self.assertAlmostEqual(sunset, self.epoch(2024, 6, 21, 20, 6), delta=300)
+
+    def test_generatingUsesBaseInterval(self):
+        poll = scheduler.PollScheduler(60, self.amsterdam)
+        self.assertEqual(poll.nextInterval(["generating", "offline"], now=self.epoch(2024, 6, 21, 1, 0)), 60)
+        self.assertEqual(poll.nextInterval([], now=self.epoch(2024, 6, 21, 1, 0)), 60)
+
+    def test_idleDaytimeBacksOff(self):
+        poll = scheduler.PollScheduler(60, self.amsterdam)
+        noon = self.epoch(2024, 6, 21, 12, 0)
+        self.assertEqual(poll.nextInterval(["waiting"], now=noon), 120)
+        self.assertEqual(poll.nextInterval(["waiting"], now=noon), 240)
+        self.assertEqual(poll.nextInterval(["waiting"], now=noon), 240)
+        self.assertEqual(poll.nextInterval(["generating"], now=noon), 60)
+
+    def test_idleNightWaitsForSunrise(self):
+        poll = scheduler.PollScheduler(60, self.amsterdam)
+        self.assertEqual(poll.nextInterval(["offline"], now=self.epoch(2024, 6, 20, 23, 0)), 3600)
+        interval = poll.nextInterval(["offline"], now=self.epoch(2024, 6, 21, 2, 0))
+        self.assertAlmostEqual(interval, 48 * 60, delta=300) #sunrise 03:18 minus the margin
+
+    def test_withoutLocationOnlyBacksOff(self):
+        poll = scheduler.PollScheduler(60)
+        self.assertEqual(poll.nextInterval(["offline"], now=self.epoch(2024, 6, 21, 1, 0)), 120)
+
+
+class SessionPoolTest(unittest.TestCase):
+    def setUp(self):
+        self.account = GoodWeSEMSPlus("eu.semsportal.com", "443", "user", "pwd")
+
+    def test_sessionReused(self):
+        self.assertIs(self.account.session, self.account.session)
+
+    def test_sessionRebuiltOnHostChange(self):
+        self.account._checkSessionHost("https://eu-gateway.semsportal.com/web/sems")
+        first = self.account.session
+        self.account._checkSessionHost("https://eu-gateway.semsportal.com/web/sems/v2")
+        self.assertIs(self.account.session, first)
+        self.account._checkSessionHost("https://au-gateway.semsportal.com/web/sems")
+        self.assertIsNot(self.account.session, first)
+
+    def test_sharedSession(self):
+        shared = goodwe.createSession(hosts=8)
+        other = GoodWe("eu.semsportal.com", "443", "other", "pwd", session=shared)
+        account = GoodWeSEMSPlus("eu.semsportal.com", "443", "user", "pwd", session=shared)
+        account._checkSessionHost("https://eu-gateway.semsportal.com/web/sems")
+        account._checkSessionHost("https://au-gateway.semsportal.com/web/sems")
+        account.closeSession()
+        self.assertIs(account.session, shared)
+        self.assertIs(other.session, shared)
+        self.assertIsNot(self.account.session, shared)
+        shared.close()
+
+    def test_noRetries(self):
+        retries = self.account.session.get_adapter("https://eu.semsportal.com").max_retries
+        self.assertEqual(retries.total, 0, "logins and commands must not be sent twice")
+
+    def tearDown(self):
+        self.account.closeSession()
+
+
+class PollerTest(unittest.TestCase):
+    def setUp(self):
+        self.poller = Poller(name="TestPoller")
+        self.poller.start()
+
+    def waitIdle(self):
+        for i in range(100):
+            if not self.poller.busy:
+                return
+            time.sleep(0.01)
+
+    def test_resultHandedBack(self):
+        self.assertTrue(self.poller.submit(lambda: {"data": 1}))
+        self.poller.submit(lambda: None)
+        self.waitIdle()
+        self.assertEqual(self.poller.results(), [{"data": 1}])
+        self.assertEqual(self.poller.results(), [])
+
+    def test_failingTaskKeepsWorkerAlive(self):
+        self.poller.submit(lambda: 1 / 0)
+        self.poller.submit(lambda: "ok")
+        self.waitIdle()
+        self.assertEqual(self.poller.results(), ["ok"])
+
+    def test_stopCancelsInFlight(self):
+        self.poller.submit(lambda: self.poller.stopEvent.wait(10) and "cancelled")
+        time.sleep(0.05)
+        self.poller.stop()
+        self.assertFalse(self.poller.busy)
+        self.assertEqual(self.poller.results(), [])
+        self.assertFalse(self.poller.submit(lambda: "late"))
+
+    def test_stopWaitsForTask(self):
+        finished = threading.Event()
+        self.poller.submit(lambda: time.sleep(0.2) or finished.set())
+        time.sleep(0.05)
+        self.poller.stop()
+        self.assertTrue(finished.is_set(), "stop should return only after the task in flight has finished")
+
+    def test_stopIsBounded(self):
+        self.poller.submit(lambda: time.sleep(1))
+        time.sleep(0.05)
+        started = time.monotonic()
+        self.poller.stop(timeout=0.1)
+        self.assertLess(time.monotonic() - started, 0.5)
+
+    def tearDown(self):
+        self.poller.stop()
+
+
 def main():
     logging.basicConfig(format='%(asctime)s - %(levelname)-8s - %(filename)-18s - %(message)s', filename="goodwe_test.log",level=logging.DEBUG)
     logging.info("==== starting test run ====")
@@ -0,0 +1,117 @@
+# Copyright 2021 Jan-Jaap Kostelijk
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is furnished
+# to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS
+# FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR
+# COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN
+# AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION
+# WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+
+# this module runs the blocking SEMS requests (login, data requests) on a worker thread
+# so the Domoticz plugin thread is never blocked by a slow or failing SEMS portal.
+# Results are handed back through a queue which is drained on the Domoticz heartbeat,
+# Domoticz devices are only touched from the Domoticz thread.
+
+import logging
+import queue
+import threading
+
+_StopTimeout = 15 #seconds to wait for the task in flight on stop, the worker is a daemon thread
+
+class Poller:
+    """
+    A class to run tasks on a background worker thread.
+    A task is a callable without arguments, a result other than None is put on the results queue.
+    """
+
+    def __init__(self, name="GoodWePoller"):
+        self._name = name
+        self._tasks = queue.Queue()
+        self._results = queue.Queue()
+        self._pending = 0
+        self._lock = threading.Lock()
+        self._thread = None
+        self.stopEvent = threading.Event()
+
+    def start(self):
+        if self._thread is not None and self._thread.is_alive():
+            return
+        self.stopEvent.clear()
+        self._thread = threading.Thread(name=self._name, target=self._run, daemon=True)
+        self._thread.start()
+        logging.debug("poller thread '%s' started", self._name)
+
+    def requestStop(self):
+        """Cancel pending tasks and tell the task in flight to stop, without waiting for it."""
+        self.stopEvent.set()
+        while True:
+            try:
+                self._tasks.get_nowait()
+            except queue.Empty:
+                break
+        self._tasks.put(None)
+
+    def stop(self, timeout=_StopTimeout):
+        """Cancel pending tasks and wait for the task in flight to finish, at most timeout seconds."""
+        self.requestStop()
+        if self._thread is not None:
+            self._thread.join(timeout)
+            if self._thread.is_alive():
+                logging.error("poller thread '%s' did not stop within %s seconds, its request is abandoned", self._name, timeout)
+            self._thread = None
+        with self._lock:
+            self._pending = 0
+        logging.debug("poller thread '%s' stopped", self._name)
+
+    @property
+    def stopping(self):
+        return self.stopEvent.is_set()
+
+    @property
+    def busy(self):
+        """True when a task is queued or running."""
+        with self._lock:
+            return self._pending > 0
+
+    def submit(self, task):
+        if self.stopping:
+            return False
+        with self._lock:
+            self._pending += 1
+        self._tasks.put(task)
+        return True
+
+    def results(self):
+        """Return all finished results, without blocking."""
+        finished = []
+        while True:
+            try:
+                finished.append(self._results.get_nowait())
+            except queue.Empty:
+                return finished
+
+    def _run(self):
+        while not self.stopping:
+            task = self._tasks.get()
+            if task is None:
+                break
+            try:
+                result = task()
+                if result is not None and not self.stopping:
+                    self._results.put(result)
+            except Exception as exp:
+                logging.exception("poller task failed: %s", exp)
+            finally:
+                with self._lock:
+                    self._pending = max(0, self._pending - 1)
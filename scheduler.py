@@ -0,0 +1,107 @@
+# Copyright 2021 Jan-Jaap Kostelijk
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is furnished
+# to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS
+# FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR
+# COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN
+# AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION
+# WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+
+# this module decides when the SEMS portal is polled next.
+# While an inverter is generating the configured refresh interval is used. When all inverters
+# are offline or waiting the interval is increased, at night (sunrise and sunset are calculated
+# from the Domoticz location) polling waits until shortly before sunrise.
+
+import logging
+import math
+import time
+from datetime import datetime, timedelta, timezone
+
+_SunMargin = 30 * 60 #seconds before sunrise and after sunset that are still treated as daylight
+_MaxBackoff = 4 #max factor on the refresh interval while all inverters are idle during daylight
+_MaxNightInterval = 60 * 60 #seconds, max interval at night
+_IdleStates = ('offline', 'waiting')
+
+def sunTimes(day, latitude, longitude):
+    """
+    Return (sunrise, sunset) of a UTC date as epoch seconds, calculated with the sunrise equation.
+    During polar night sunrise equals sunset, during midnight sun the whole day is returned.
+    """
+    n = day.toordinal() - datetime(2000, 1, 1).toordinal() #days since J2000
+    meanSolarTime = n - longitude / 360.0
+    anomaly = math.radians((357.5291 + 0.98560028 * meanSolarTime) % 360)
+    center = 1.9148 * math.sin(anomaly) + 0.02 * math.sin(2 * anomaly) + 0.0003 * math.sin(3 * anomaly)
+    eclipticLongitude = math.radians((math.degrees(anomaly) + center + 180 + 102.9372) % 360)
+    transit = 2451545.0 + meanSolarTime + 0.0053 * math.sin(anomaly) - 0.0069 * math.sin(2 * eclipticLongitude)
+    sinDeclination = math.sin(eclipticLongitude) * math.sin(math.radians(23.4397))
+    cosDeclination = math.cos(math.asin(sinDeclination))
+    phi = math.radians(latitude)
+    cosHourAngle = (math.sin(math.radians(-0.833)) - math.sin(phi) * sinDeclination) / (math.cos(phi) * cosDeclination)
+    transitEpoch = (transit - 2440587.5) * 86400
+    if cosHourAngle > 1:
+        return transitEpoch, transitEpoch
+    if cosHourAngle < -1:
+        return transitEpoch - 43200, transitEpoch + 43200
+    halfDay = math.degrees(math.acos(cosHourAngle)) / 360.0 * 86400
+    return transitEpoch - halfDay, transitEpoch + halfDay
+
+def _daylightWindows(now, latitude, longitude):
+    today = datetime.fromtimestamp(now, timezone.utc).date()
+    for offset in (-1, 0, 1):
+        sunrise, sunset = sunTimes(today + timedelta(days=offset), latitude, longitude)
+        if sunset > sunrise:
+            yield sunrise - _SunMargin, sunset + _SunMargin
+
+def isDaylight(now, latitude, longitude):
+    return any(start <= now <= end for start, end in _daylightWindows(now, latitude, longitude))
+
+def secondsUntilDaylight(now, latitude, longitude):
+    """Return the seconds until the next daylight window starts, None when there is none soon (polar night)"""
+    starts = [start for start, end in _daylightWindows(now, latitude, longitude) if start > now]
+    return min(starts) - now if starts else None
+
+class PollScheduler:
+    """
+    A class to calculate the interval until the next poll, based on the state of the inverters and daylight.
+    baseInterval: configured refresh interval in seconds
+    location: (latitude, longitude) of the Domoticz installation, None if unknown
+    """
+
+    def __init__(self, baseInterval, location=None):
+        self.baseInterval = baseInterval
+        self.location = location
+        self._backoff = 1
+
+    def nextInterval(self, states, now=None):
+        """Return the seconds until the next poll, given the state names of all inverters of the last poll"""
+        if now is None:
+            now = time.time()
+        states = list(states)
+        if len(states) == 0 or any(state not in _IdleStates for state in states):
+            self._backoff = 1
+            return self.baseInterval
+        if self.location is not None and not isDaylight(now, *self.location):
+            untilDaylight = secondsUntilDaylight(now, *self.location)
+            if untilDaylight is None:
+                untilDaylight = _MaxNightInterval
+            interval = min(max(untilDaylight, self.baseInterval), max(_MaxNightInterval, self.baseInterval))
+            logging.debug("all inverters idle at night, next poll in %d seconds", interval)
+            return interval
+        self._backoff = min(self._backoff * 2, _MaxBackoff)
+        logging.debug("all inverters idle, backing off to %d times the refresh interval", self._backoff)
+        return self.baseInterval * self._backoff
+
+    def shouldSpeedUp(self, states):
+        """True when an inverter left the idle states, so a pending long interval should be shortened"""
+        return any(state not in _IdleStates for state in states)
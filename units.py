@@ -0,0 +1,157 @@
+# Copyright 2021 Jan-Jaap Kostelijk
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is furnished
+# to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS
+# FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR
+# COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN
+# AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION
+# WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+
+# this module describes the Domoticz units created for each inverter.
+# The table below is the single definition of the unit numbers, how a unit is created
+# and how its value is taken from the parsed inverter snapshot (GoodWe.InverterSnapshot).
+# Unit numbers must never change, Domoticz keeps the history of a unit by its number.
+
+from deviceupdate import UpdatePolicy
+
+MaxUpdateInterval = 300 #seconds, unchanged values are written at least this often so Domoticz graphs and timeouts keep working
+
+class UnitSpec:
+    """
+    A class to describe one Domoticz unit of an inverter:
+    key: attribute name of the unit number on Inverter and the plugin
+    unit: Domoticz unit number
+    name: name of the unit, the serial number of the inverter is added
+    create: keyword arguments for Domoticz.Unit
+    policy: UpdatePolicy deciding when a changed value is written
+    source: attribute of the inverter snapshot the value is taken from, None if never updated
+    formatter: function(snapshot) returning (nValue, sValue) or None when the value is missing, for energy units the power in Watt
+    energy: the unit is a kWh unit, its energy counter is calculated by the plugin
+    generatingOnly: only update the unit when the inverter is generating
+    """
+    __slots__ = ("key", "unit", "name", "create", "policy", "source", "formatter", "energy", "generatingOnly")
+
+    def __init__(self, key, unit, name, create, policy=None, source=None, formatter=None, energy=False, generatingOnly=False):
+        self.key = key
+        self.unit = unit
+        self.name = name
+        self.create = create
+        self.policy = policy
+        self.source = source
+        self.formatter = formatter
+        self.energy = energy
+        self.generatingOnly = generatingOnly
+
+    def __repr__(self):
+        return "UnitSpec(" + str(self.unit) + ": '" + self.name + "')"
+
+def formatValue(value):
+    """format a float value as sValue, None when the value is missing (NaN)"""
+    if value != value:
+        return None
+    return str(value)
+
+def _state(snapshot):
+    return snapshot.status + 1, str((snapshot.status + 2) * 10)
+
+def _field(attribute):
+    def formatter(snapshot):
+        sValue = formatValue(getattr(snapshot, attribute))
+        return None if sValue is None else (0, sValue)
+    return formatter
+
+def _outputPower(snapshot):
+    if snapshot.outputPower != snapshot.outputPower or snapshot.etotal != snapshot.etotal:
+        return None
+    return 0, formatValue(snapshot.outputPower) + ";" + formatValue(snapshot.etotal * 1000)
+
+def _input(attribute, index):
+    def formatter(snapshot):
+        sValue = formatValue(getattr(snapshot, attribute)[index])
+        return None if sValue is None else (0, sValue)
+    return formatter
+
+def _inputPower(index):
+    def formatter(snapshot):
+        inputPower = snapshot.inputPower[index]
+        return None if inputPower != inputPower else inputPower
+    return formatter
+
+_statePolicy = UpdatePolicy(maxInterval=MaxUpdateInterval, forceOnStateChange=True)
+_voltagePolicy = UpdatePolicy(deadband=1.0, maxInterval=MaxUpdateInterval)
+_currentPolicy = UpdatePolicy(deadband=0.1, maxInterval=MaxUpdateInterval)
+_powerPolicy = UpdatePolicy(deadband=5.0, maxInterval=MaxUpdateInterval)
+
+_StateOptions = {"LevelActions": "|||",
+                 "LevelNames": "|Offline|Waiting|Generating|Error",
+                 "LevelOffHidden": "true",
+                 "SelectorStyle": "1"}
+_StateCommandOptions = {"LevelActions": "|||",
+                        "LevelNames": "|Reboot|Waiting/off|N/A|Restart",
+                        "LevelOffHidden": "true",
+                        "SelectorStyle": "1"}
+
+#units in order of creation, input string 2.. 4 are optional and created as not-used
+UNITS = (
+    UnitSpec("inverterTemperatureUnit", 1, "Inverter temperature", dict(Type=80, Subtype=5),
+             UpdatePolicy(deadband=0.5, minInterval=60, maxInterval=MaxUpdateInterval), "temperature", _field("temperature"), generatingOnly=True),
+    UnitSpec("outputCurrentUnit", 2, "Inverter output current", dict(Type=243, Subtype=23),
+             _currentPolicy, "outputCurrent", _field("outputCurrent")),
+    UnitSpec("outputVoltageUnit", 3, "Inverter output voltage", dict(Type=243, Subtype=8),
+             _voltagePolicy, "outputVoltage", _field("outputVoltage")),
+    UnitSpec("outputPowerUnit", 4, "Inverter output power", dict(Type=243, Subtype=29, Switchtype=4, Used=1),
+             _powerPolicy, "outputPower", _outputPower),
+    UnitSpec("inverterStateUnit", 9, "Inverter state", dict(TypeName="Selector Switch", Image=1, Options=_StateOptions, Used=1),
+             _statePolicy, "status", _state),
+    UnitSpec("inputVoltage1Unit", 5, "Inverter input 1 voltage", dict(Type=243, Subtype=8),
+             _voltagePolicy, "inputVoltage", _input("inputVoltage", 0)),
+    UnitSpec("inputAmps1Unit", 6, "Inverter input 1 Current", dict(Type=243, Subtype=23, Switchtype=4, Used=0),
+             _currentPolicy, "inputCurrent", _input("inputCurrent", 0)),
+    UnitSpec("inputPower1Unit", 14, "Inverter input 1 power", dict(Type=243, Subtype=29, Switchtype=4, Used=1),
+             _powerPolicy, "inputPower", _inputPower(0), energy=True),
+    UnitSpec("inputVoltage2Unit", 7, "Inverter input 2 voltage", dict(Type=243, Subtype=8, Used=0),
+             _voltagePolicy, "inputVoltage", _input("inputVoltage", 1)),
+    UnitSpec("inputAmps2Unit", 8, "Inverter input 2 Current", dict(Type=243, Subtype=23, Switchtype=4, Used=0),
+             _currentPolicy, "inputCurrent", _input("inputCurrent", 1)),
+    UnitSpec("inputVoltage3Unit", 10, "Inverter input 3 voltage", dict(Type=243, Subtype=8, Used=0),
+             _voltagePolicy, "inputVoltage", _input("inputVoltage", 2)),
+    UnitSpec("inputAmps3Unit", 11, "Inverter input 3 Current", dict(Type=243, Subtype=23, Switchtype=4, Used=0),
+             _currentPolicy, "inputCurrent", _input("inputCurrent", 2)),
+    UnitSpec("inputVoltage4Unit", 12, "Inverter input 4 voltage", dict(Type=243, Subtype=8, Used=0),
+             _voltagePolicy, "inputVoltage", _input("inputVoltage", 3)),
+    UnitSpec("inputAmps4Unit", 13, "Inverter input 4 Current", dict(Type=243, Subtype=23, Switchtype=4, Used=0),
+             _currentPolicy, "inputCurrent", _input("inputCurrent", 3)),
+    UnitSpec("inputPower2Unit", 15, "Inverter input 2 power", dict(Type=243, Subtype=29, Switchtype=4, Used=0),
+             _powerPolicy, "inputPower", _inputPower(1), energy=True),
+    UnitSpec("inputPower3Unit", 16, "Inverter input 3 power", dict(Type=243, Subtype=29, Switchtype=4, Used=0),
+             _powerPolicy, "inputPower", _inputPower(2), energy=True),
+    UnitSpec("inputPower4Unit", 17, "Inverter input 4 power", dict(Type=243, Subtype=29, Switchtype=4, Used=0),
+             _powerPolicy, "inputPower", _inputPower(3), energy=True),
+    UnitSpec("outputFreq1Unit", 18, "Inverter output frequency 1", dict(TypeName="Custom", Used=0),
+             UpdatePolicy(deadband=0.05, maxInterval=MaxUpdateInterval), "frequency", _field("frequency"), generatingOnly=True),
+    UnitSpec("inverterStateCommand", 19, "Inverter state control", dict(TypeName="Selector Switch", Image=1, Options=_StateCommandOptions, Used=0)),
+)
+
+def unitNumbers():
+    """Return the unit number of each unit by its key"""
+    return {spec.key: spec.unit for spec in UNITS}
+
+def energyStrings():
+    """Return the PV input string (0 based) of each energy unit by its unit number"""
+    return {spec.unit: index for index, spec in enumerate(spec for spec in UNITS if spec.energy)}
+
+def compileUpdates():
+    """Return the units which get a value as (unit, formatter, policy, energy, generatingOnly) tuples"""
+    return tuple((spec.unit, spec.formatter, spec.policy, spec.energy, spec.generatingOnly)
+                 for spec in UNITS if spec.formatter is not None)